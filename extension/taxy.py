@@ -13,15 +13,65 @@ class taxy:
         # Load config values
         self.camera_url = config.get("nozzle_cam_url")
         self.server_url = config.get("server_url")
+        # Named context on the server for this printer's camera, when several printers share one server
+        self.server_context = config.get("server_context", "")
+        if self.server_context:
+            self.server_url = self.server_url.rstrip("/") + "/context/" + self.server_context
         self.speed = config.getfloat("move_speed", 1800.0, above=10.0)
         self.calib_iterations = config.getint(
             "calib_iterations", 1, minval=1, maxval=25
         )
         self.calib_value = config.getfloat("calib_value", 1.0, above=0.25)
         self.save_training_images = config.getboolean("save_training_images", False)
+        # files: one .jpg/.json pair per frame, archive: deduplicated sharded dataset store
+        self.training_store = config.getchoice("training_store", {"files": "files", "archive": "archive"}, "files")
+        # archive store only: all frames, or only low-confidence and blob fallback detections
+        self.training_filter = config.getchoice("training_filter", {"all": "all", "uncertain": "uncertain"}, "all")
         self.detection_tolerance = config.getint(
             "detection_tolerance", 0, minval=0, maxval=5
         )
+        # sequential: confirm the position over consecutive frames, batch: from one batched burst of frames,
+        # converge: until the confidence interval of a robust running estimate is below convergence_target
+        self.detection_mode = config.getchoice(
+            "detection_mode", {"sequential": "sequential", "batch": "batch", "converge": "converge"}, "sequential"
+        )
+        self.batch_size = config.getint("batch_size", 5, minval=1, maxval=16)
+        self.convergence_target = config.getfloat("convergence_target", 0.25, above=0.0)
+        # Mean frame difference (gray levels) below which the image counts as still after a move
+        self.settle_threshold = config.getfloat("settle_threshold", 1.0, above=0.0)
+        # Full detections per second in the preview, the nozzle is tracked in between (0 = every frame)
+        self.preview_inference_fps = config.getfloat("preview_inference_fps", 2.0, minval=0.0)
+        # Search a window around the last detection before the full frame
+        self.roi_detection = config.getboolean("roi_detection", False)
+        # Decode frames for the model at reduced resolution (JPEG DCT scaling) instead of full size
+        self.reduced_decode = config.getboolean("reduced_decode", False)
+        # Bytes the server reads from the camera at a time
+        self.camera_chunk_size = config.getint("camera_chunk_size", 65536, minval=1024)
+        # Keep one MJPEG stream connection open instead of a snapshot request per frame
+        self.camera_stream = config.getboolean("camera_stream", False)
+        # Stream URL, empty derives it from nozzle_cam_url (snapshot -> stream)
+        self.camera_stream_url = config.get("camera_stream_url", "")
+        # Threads running the blob detection stages concurrently, 0 runs them one after another
+        self.blob_workers = config.getint("blob_workers", 0, minval=0, maxval=8)
+        # Threads running the AI inferences of all printers on the server in turn
+        self.inference_workers = config.getint("inference_workers", 1, minval=1, maxval=8)
+        # AI model file on the server to use, empty keeps the server's choice
+        self.model = config.get("model", "")
+        # Inference runtime settings sent to the server, unset options keep the server's defaults
+        self.runtime = {
+            "intra_op_threads": config.getint("inference_intra_op_threads", None, minval=0),
+            "inter_op_threads": config.getint("inference_inter_op_threads", None, minval=0),
+            # One of: disable, basic, extended, all (validated by the server)
+            "graph_optimization": config.get("inference_graph_optimization", None),
+            "execution_providers": config.getlist("inference_execution_providers", None),
+            "allow_spinning": config.getboolean("inference_allow_spinning", None),
+            "tflite_num_threads": config.getint("inference_tflite_threads", None, minval=1),
+            "use_xnnpack": config.getboolean("inference_xnnpack", None),
+            "dynamic_input_size": config.getint("inference_dynamic_input_size", None, minval=32),
+            "cpu_affinity": config.getintlist("inference_cpu_affinity", None),
+            "niceness": config.getint("inference_niceness", None, minval=-20, maxval=19),
+        }
+        self.runtime = {k: (list(v) if isinstance(v, tuple) else v) for k, v in self.runtime.items() if v is not None}
 
         # Initialize variables
         self.mpp = None  # Average mm per pixel
@@ -121,12 +171,29 @@ class taxy:
     def cmd_SEND_SERVER_CFG(self, gcmd):
         try:
             _camera_url = gcmd.get("CAMERA_URL", self.camera_url)
+            _model = gcmd.get("MODEL", self.model)
             rr = utl.send_srv_command(
                 self.server_url,
                 "/set_server_cfg",
                 camera_url=_camera_url,
                 save_training_images=self.save_training_images,
+                training_store=self.training_store,
+                training_filter=self.training_filter,
                 detection_tolerance=self.detection_tolerance,
+                detection_mode=self.detection_mode,
+                batch_size=self.batch_size,
+                convergence_target=self.convergence_target,
+                settle_threshold=self.settle_threshold,
+                preview_inference_fps=self.preview_inference_fps,
+                roi_detection=self.roi_detection,
+                reduced_decode=self.reduced_decode,
+                camera_chunk_size=self.camera_chunk_size,
+                camera_stream=self.camera_stream,
+                camera_stream_url=self.camera_stream_url,
+                blob_workers=self.blob_workers,
+                inference_workers=self.inference_workers,
+                model=_model,
+                runtime=self.runtime,
             )
             gcmd.respond_info("kTAY8 Server response: %s" % str(rr))
         except Exception as e:
@@ -209,7 +276,7 @@ class taxy:
         ##############################
         logging.debug("*** calling SIMPLE_NOZZLE_POSITION")
         try:
-            _response = utl.get_nozzle_position(self.server_url, self.reactor)
+            _response = utl.get_nozzle_position(self.server_url, self.reactor, self.pm.get_active_tool())
             if _response is None:
                 raise self.gcode.error("Did not find nozzle, aborting")
             else:
@@ -258,7 +325,7 @@ class taxy:
 
         try:
             self.pm.ensureHomed()
-            _rr = utl.get_nozzle_position(self.server_url, self.reactor)
+            _rr = utl.get_nozzle_position(self.server_url, self.reactor, self.pm.get_active_tool())
 
             # If we did not get a response at first query, abort
             if _rr is None:
@@ -383,7 +450,7 @@ class taxy:
 
             self.pm.moveAbsolute(X=guessPosition[0], Y=guessPosition[1])
             try:
-                _rr = utl.get_nozzle_position(self.server_url, self.reactor)
+                _rr = utl.get_nozzle_position(self.server_url, self.reactor, self.pm.get_active_tool())
             except NozzleNotFoundException:
                 pass
 
@@ -418,7 +485,7 @@ class taxy:
                 raise self.gcode.error("Camera is not calibrated, aborting")
 
             for _retries in range(retries):
-                _rr = utl.get_nozzle_position(self.server_url, self.reactor)
+                _rr = utl.get_nozzle_position(self.server_url, self.reactor, self.pm.get_active_tool())
 
                 if _rr is None:
                     if _not_found_retries > 3:
@@ -547,7 +614,7 @@ class taxy:
     def move_relative_and_get_nozzle_position(self, X, Y, gcmd):
         self.pm.moveRelative(X=X, Y=Y)
 
-        _request_result = utl.get_nozzle_position(self.server_url, self.reactor)
+        _request_result = utl.get_nozzle_position(self.server_url, self.reactor, self.pm.get_active_tool())
 
         if _request_result is None:
             return None, None
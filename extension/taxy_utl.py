@@ -19,6 +19,9 @@ import urllib.request
 from email.message import Message  # For headers in server_request
 
 __SERVER_REQUEST_TIMEOUT = 2
+# Interval for polling the result of a nozzle detection request, in seconds
+__POLL_INTERVAL_MIN = 0.05
+__POLL_INTERVAL_MAX = 0.2
 __FRAME_WIDTH = 1280
 __FRAME_HEIGHT = 720
 
@@ -62,7 +65,8 @@ def calculate_offset_from_matrix(server_url, _v):
     return rr.body
 
 
-def get_nozzle_position(server_url, reactor):
+# tool: name of the active tool, lets the server remember which detection works for each tool
+def get_nozzle_position(server_url, reactor, tool=None):
     ##############################
     # Get nozzle position
     ##############################
@@ -70,7 +74,10 @@ def get_nozzle_position(server_url, reactor):
     _request_id = None
 
     # First load the server response and check that it is working
-    _response = server_request(server_url + "/getNozzlePosition", timeout=__SERVER_REQUEST_TIMEOUT)
+    _url = server_url + "/getNozzlePosition"
+    if tool is not None:
+        _url += "?tool=" + urllib.parse.quote(str(tool))
+    _response = server_request(_url, timeout=__SERVER_REQUEST_TIMEOUT)
     if _response.status != 200:
         raise Exception(
             "When getting nozzle position, server sent statuscode %s: %s"
@@ -91,6 +98,9 @@ def get_nozzle_position(server_url, reactor):
     _request_id = _response["request_id"]
 
     start_time = time.time()
+    # Poll quickly at first, the server usually answers soon now that it does not sleep between frames,
+    # then back off to the previous 200ms
+    _poll_interval = __POLL_INTERVAL_MIN
     while True:
         #
         # Check if the request is done
@@ -115,8 +125,9 @@ def get_nozzle_position(server_url, reactor):
                     "Nozzle detection timed out after 60 seconds, Server still looking for nozzle."
                 )
 
-            # Pause for 200ms to avoid busy loop, this equals checking 5 times per second
-            _ = reactor.pause(reactor.monotonic() + 0.200)
+            # Pause to avoid busy loop
+            _ = reactor.pause(reactor.monotonic() + _poll_interval)
+            _poll_interval = min(_poll_interval * 1.5, __POLL_INTERVAL_MAX)
             continue
         # If nozzles were found, return the position
         elif _response["statuscode"] == 200:
@@ -348,6 +359,13 @@ class taxy_pm:
 
         return [raw_position.x, raw_position.y, raw_position.z]
 
+    # Name of the active extruder (e.g. "extruder1"), None if it cannot be read
+    def get_active_tool(self):
+        try:
+            return self.toolhead.get_extruder().get_name()
+        except Exception:
+            return None
+
 
 class Server_Response(typing.NamedTuple):
     body: str
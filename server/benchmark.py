@@ -0,0 +1,199 @@
+# Inference latency benchmark for the detector backends (ONNX, TFLite, blob cascade).
+# Each backend runs in its own process so its peak memory can be measured on its own.
+#
+# Usage: python benchmark.py [--models best.onnx best.tflite] [--images ../collected_images] [--output bench.json]
+import glob, os, sys, json, time, platform, resource, datetime, cv2, numpy as np
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+# Size of frame to use (same as the camera frames of the server)
+_FRAME_WIDTH = 1280
+_FRAME_HEIGHT = 720
+
+# Stages reported for the AI backends, in pipeline order
+_AI_STAGES = ("preprocess", "inference", "decode", "nms", "overlay", "total")
+# Stages reported for the blob cascade
+_BLOB_STAGES = ("detect", "overlay", "total")
+
+
+def load_frames(images_dir, limit, synthetic):
+    frames = []
+    for path in sorted(glob.glob(os.path.join(images_dir, "*.jpg")))[:limit]:
+        frame = cv2.imread(path, cv2.IMREAD_COLOR)
+        if frame is not None:
+            frames.append(cv2.resize(frame, (_FRAME_WIDTH, _FRAME_HEIGHT), interpolation=cv2.INTER_AREA))
+    if frames:
+        return frames, "images:" + os.path.abspath(images_dir)
+
+    # Synthetic frames: a dark nozzle-like disc near the center of a noisy gray background
+    rng = np.random.default_rng(0)
+    for i in range(synthetic):
+        frame = np.full((_FRAME_HEIGHT, _FRAME_WIDTH, 3), 150, dtype=np.uint8)
+        frame = cv2.add(frame, rng.integers(0, 30, frame.shape, dtype=np.uint8))
+        center = (_FRAME_WIDTH // 2 + int(rng.integers(-40, 40)), _FRAME_HEIGHT // 2 + int(rng.integers(-40, 40)))
+        cv2.circle(frame, center, 14, (20, 20, 20), -1, cv2.LINE_AA)
+        frames.append(frame)
+    return frames, "synthetic:%i" % synthetic
+
+
+def percentiles(values):
+    values = np.asarray(values, dtype=np.float64)
+    if values.size == 0:
+        return None
+    return {
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "mean_ms": float(values.mean()),
+        "max_ms": float(values.max()),
+    }
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def bench_model(model_path, frames_source, runtime_overrides, iterations, warmup, conf):
+    from nozzle_detector import NozzleDetector, RuntimeConfig
+    frames, _ = load_frames(*frames_source)
+    runtime = RuntimeConfig.from_dict(runtime_overrides)
+
+    load_start = time.time()
+    detector = NozzleDetector(model_path, conf_thres=conf, runtime=runtime)
+    load_time = (time.time() - load_start) * 1000
+
+    for i in range(warmup):
+        detector.infer(frames[i % len(frames)])
+
+    stages = {stage: [] for stage in _AI_STAGES}
+    detections = 0
+    wall_start = time.time()
+    for _ in range(iterations):
+        for frame in frames:
+            timings = dict()
+            start_time = time.time()
+            results, _, _ = detector.infer(frame, timings)
+            overlay_start = time.time()
+            detector.draw_results(frame, results)
+            timings["overlay"] = (time.time() - overlay_start) * 1000
+            timings["total"] = (time.time() - start_time) * 1000
+            for stage in _AI_STAGES:
+                stages[stage].append(timings[stage])
+            detections += 1 if results else 0
+    wall_time = time.time() - wall_start
+    processed = iterations * len(frames)
+
+    return {
+        "backend": detector.ext.lstrip("."),
+        "model": os.path.basename(model_path),
+        "input_size": [int(detector.input_width), int(detector.input_height)],
+        "runtime": detector.runtime_info(),
+        "load_ms": load_time,
+        "frames": processed,
+        "detection_rate": detections / processed,
+        "throughput_fps": processed / wall_time,
+        "stages": {stage: percentiles(values) for stage, values in stages.items()},
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def bench_blob(frames_source, iterations, warmup):
+    from taxy_server_ds import Taxy_Server_Detection_Service as ds
+    from taxy_server_dm import Taxy_Server_Detection_Manager as dm, draw_detection
+    frames, _ = load_frames(*frames_source)
+
+    # A service that never loads a model: nozzleDetection goes straight to the blob cascade
+    service = ds(lambda message: None)
+    manager = dm(lambda message: None, None, detection_service=service)
+
+    for i in range(warmup):
+        manager.nozzleDetection(frames[i % len(frames)])
+
+    stages = {stage: [] for stage in _BLOB_STAGES}
+    detections = 0
+    wall_start = time.time()
+    for _ in range(iterations):
+        for frame in frames:
+            start_time = time.time()
+            result = manager.nozzleDetection(frame)
+            overlay_start = time.time()
+            draw_detection(frame, result)
+            end_time = time.time()
+            stages["detect"].append((overlay_start - start_time) * 1000)
+            stages["overlay"].append((end_time - overlay_start) * 1000)
+            stages["total"].append((end_time - start_time) * 1000)
+            detections += 1 if result.found else 0
+    wall_time = time.time() - wall_start
+    processed = iterations * len(frames)
+
+    return {
+        "backend": "blob",
+        "model": None,
+        "frames": processed,
+        "detection_rate": detections / processed,
+        "throughput_fps": processed / wall_time,
+        "stages": {stage: percentiles(values) for stage, values in stages.items()},
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark the TAXY detector backends")
+    parser.add_argument("--models", nargs="*", default=None, help="Model files (default: all .onnx/.tflite in the current folder)")
+    parser.add_argument("--images", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "collected_images"), help="Folder with .jpg frames")
+    parser.add_argument("--limit", type=int, default=50, help="Maximum number of frames loaded from --images")
+    parser.add_argument("--synthetic", type=int, default=20, help="Synthetic frames used when no images are found")
+    parser.add_argument("--iterations", type=int, default=5, help="Passes over the frames per backend")
+    parser.add_argument("--warmup", type=int, default=3, help="Untimed inferences before measuring")
+    parser.add_argument("--conf", type=float, default=0.5, help="Confidence threshold (same as the server)")
+    parser.add_argument("--runtime", default="{}", help='Runtime settings as JSON, e.g. \'{"intra_op_threads": 2}\'')
+    parser.add_argument("--no-blob", action="store_true", help="Skip the blob cascade backend")
+    parser.add_argument("--output", default=None, help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    models = args.models
+    if models is None:
+        models = sorted(f for f in os.listdir(".") if f.endswith((".onnx", ".tflite")))
+    frames_source = (args.images, args.limit, args.synthetic)
+    _, source_name = load_frames(*frames_source)
+    runtime_overrides = json.loads(args.runtime)
+
+    report = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "host": {"machine": platform.machine(), "platform": platform.platform(), "cpu_count": os.cpu_count(), "python": platform.python_version()},
+        "frames": source_name,
+        "iterations": args.iterations,
+        "runtime_overrides": runtime_overrides,
+        "results": [],
+    }
+
+    # A fresh process per backend, so peak RSS and runtime thread pools do not leak between runs
+    context = multiprocessing.get_context("spawn")
+    jobs = [(bench_model, (model, frames_source, runtime_overrides, args.iterations, args.warmup, args.conf)) for model in models]
+    if not args.no_blob:
+        jobs.append((bench_blob, (frames_source, args.iterations, args.warmup)))
+
+    for func, func_args in jobs:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            try:
+                result = executor.submit(func, *func_args).result()
+            except Exception as e:
+                result = {"backend": func.__name__, "model": func_args[0] if func is bench_model else None, "error": str(e)}
+        report["results"].append(result)
+        total = result.get("stages", {}).get("total") or {}
+        print("%-8s %-28s p50 %7.1fms  p95 %7.1fms  p99 %7.1fms  %6.1f fps  %6.0f MB%s" % (
+            result["backend"], str(result.get("model")), total.get("p50_ms", float("nan")), total.get("p95_ms", float("nan")),
+            total.get("p99_ms", float("nan")), result.get("throughput_fps", float("nan")), result.get("peak_rss_mb", float("nan")),
+            ("  ERROR: " + result["error"]) if "error" in result else ""))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Results written to %s" % args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
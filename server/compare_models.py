@@ -0,0 +1,92 @@
+# Compares the detections of a quantized (INT8/UINT8/FP16) model against its float reference
+# on the same frames, and exits with an error if they disagree.
+#
+# Usage: python compare_models.py best.onnx best_int8.tflite [--images ../collected_images] [--tolerance 2.0]
+import glob, os, sys, json, cv2, numpy as np
+from argparse import ArgumentParser
+from nozzle_detector import NozzleDetector
+
+# Size of frame to use (same as the camera frames of the server)
+_FRAME_WIDTH = 1280
+_FRAME_HEIGHT = 720
+
+
+def load_frames(images_dir, limit):
+    paths = sorted(glob.glob(os.path.join(images_dir, "*.jpg")))[:limit]
+    for path in paths:
+        frame = cv2.imread(path, cv2.IMREAD_COLOR)
+        if frame is None:
+            continue
+        yield path, cv2.resize(frame, (_FRAME_WIDTH, _FRAME_HEIGHT), interpolation=cv2.INTER_AREA)
+
+
+def best_center(results):
+    # Highest scoring detection, as (cx, cy, score)
+    if not results:
+        return None
+    best = max(results, key=lambda r: r["score"])
+    x1, y1, x2, y2 = best["box"]
+    return ((x1 + x2) / 2, (y1 + y2) / 2, best["score"])
+
+
+def compare(reference, candidate, frames, tolerance, score_tolerance):
+    report = {"frames": 0, "both_found": 0, "both_missed": 0, "mismatched": [], "center_errors": [], "score_errors": []}
+    for path, frame in frames:
+        report["frames"] += 1
+        ref = best_center(reference.infer(frame)[0])
+        cand = best_center(candidate.infer(frame)[0])
+
+        if ref is None and cand is None:
+            report["both_missed"] += 1
+            continue
+        if ref is None or cand is None:
+            report["mismatched"].append({"image": path, "reference": ref, "candidate": cand})
+            continue
+
+        report["both_found"] += 1
+        error = float(np.hypot(ref[0] - cand[0], ref[1] - cand[1]))
+        report["center_errors"].append(error)
+        report["score_errors"].append(abs(ref[2] - cand[2]))
+        if error > tolerance or abs(ref[2] - cand[2]) > score_tolerance:
+            report["mismatched"].append({"image": path, "reference": ref, "candidate": cand, "center_error": error})
+    return report
+
+
+def main():
+    parser = ArgumentParser(description="Compare a quantized model against its float reference")
+    parser.add_argument("reference", help="Float model (.onnx or .tflite)")
+    parser.add_argument("candidate", help="Quantized model (.onnx or .tflite)")
+    parser.add_argument("--images", default=os.path.join(os.path.dirname(__file__), "..", "collected_images"), help="Folder with .jpg frames")
+    parser.add_argument("--limit", type=int, default=200, help="Maximum number of frames")
+    parser.add_argument("--conf", type=float, default=0.5, help="Confidence threshold (same as the server)")
+    parser.add_argument("--tolerance", type=float, default=2.0, help="Maximum center distance in pixels")
+    parser.add_argument("--score-tolerance", type=float, default=0.15, help="Maximum confidence difference")
+    args = parser.parse_args()
+
+    reference = NozzleDetector(args.reference, conf_thres=args.conf)
+    candidate = NozzleDetector(args.candidate, conf_thres=args.conf)
+
+    report = compare(reference, candidate, load_frames(args.images, args.limit), args.tolerance, args.score_tolerance)
+    if report["frames"] == 0:
+        print("No frames found in %s" % args.images)
+        return 2
+
+    errors = np.array(report["center_errors"]) if report["center_errors"] else np.zeros(1)
+    summary = {
+        "frames": report["frames"],
+        "both_found": report["both_found"],
+        "both_missed": report["both_missed"],
+        "mismatched": len(report["mismatched"]),
+        "center_error_mean": float(errors.mean()),
+        "center_error_max": float(errors.max()),
+        "score_error_max": float(max(report["score_errors"], default=0.0)),
+    }
+    print(json.dumps(summary, indent=2))
+    for mismatch in report["mismatched"]:
+        print("MISMATCH: %s" % json.dumps(mismatch))
+
+    return 1 if report["mismatched"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
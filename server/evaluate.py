@@ -0,0 +1,243 @@
+# Accuracy and speed regression harness over the frames saved with save_training_images.
+# Replays every saved frame through the full nozzleDetection path (AI model + blob fallback)
+# for each model/config, and fails when accuracy or speed regress past the given thresholds.
+#
+# Reference positions come from a YOLO label file next to the image when one exists
+# (e.g. after annotating), otherwise from the detected position stored in the .json metadata.
+# Frames kept in the dataset store (training_store: archive) are read from its archives.
+#
+# Usage: python evaluate.py --model best.onnx --model new.onnx --model blob [--baseline eval_prev.json] [--output eval.json]
+import glob, os, sys, json, time, datetime, cv2, numpy as np
+from argparse import ArgumentParser
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+# Size of frame to use (same as the camera frames of the server)
+_FRAME_WIDTH = 1280
+_FRAME_HEIGHT = 720
+
+# Config name used to evaluate the blob cascade alone
+_BLOB_ONLY = "blob"
+
+# Detection manager of the current worker process
+_worker_manager = None
+
+
+def load_dataset(images_dir):
+    from taxy_server_dataset import Taxy_Server_Dataset_Store
+
+    samples = []
+    for record in Taxy_Server_Dataset_Store(images_dir).records():
+        position = record.get("detected_position") or {}
+        if position.get("x") is None or position.get("y") is None:
+            continue
+        samples.append({"image": "%s:%s" % (record["shard"], record["image_file"]), "reference": (float(position["x"]), float(position["y"])),
+                        "reference_source": "metadata", "saved_algorithm": record.get("algorithm"),
+                        "archive": (os.path.join(images_dir, record["shard"]), record["offset"], record["size"])})
+
+    for json_path in sorted(glob.glob(os.path.join(images_dir, "*.json"))):
+        try:
+            with open(json_path, "r") as f:
+                metadata = json.load(f)
+        except (OSError, ValueError):
+            continue
+        image_path = os.path.join(images_dir, metadata.get("image_file") or os.path.splitext(os.path.basename(json_path))[0] + ".jpg")
+        if not os.path.isfile(image_path):
+            continue
+
+        reference = reference_from_label(os.path.splitext(image_path)[0] + ".txt")
+        source = "label"
+        if reference is None:
+            position = metadata.get("detected_position") or {}
+            if position.get("x") is None or position.get("y") is None:
+                continue
+            reference = (float(position["x"]), float(position["y"]))
+            source = "metadata"
+        samples.append({"image": image_path, "reference": reference, "reference_source": source, "saved_algorithm": metadata.get("algorithm")})
+    return samples
+
+
+def reference_from_label(label_path):
+    # YOLO label: class cx cy w h, normalized to the image size
+    if not os.path.isfile(label_path):
+        return None
+    with open(label_path, "r") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 5:
+                return (float(parts[1]) * _FRAME_WIDTH, float(parts[2]) * _FRAME_HEIGHT)
+    return None
+
+
+def init_worker(model_path, runtime_overrides):
+    global _worker_manager
+    from taxy_server_ds import Taxy_Server_Detection_Service as ds
+    from taxy_server_dm import Taxy_Server_Detection_Manager as dm
+    from nozzle_detector import RuntimeConfig
+
+    log = lambda message: None
+    if model_path == _BLOB_ONLY:
+        # A service that never loads a model: nozzleDetection goes straight to the blob cascade
+        service = ds(log)
+    else:
+        service = ds(log, model_dir=os.path.dirname(os.path.abspath(model_path)), runtime=RuntimeConfig.from_dict(runtime_overrides))
+        service.select_model(os.path.basename(model_path))
+    _worker_manager = dm(log, None, detection_service=service)
+
+
+def read_archived_image(shard_path, offset, size):
+    with open(shard_path, "rb") as f:
+        f.seek(offset)
+        return cv2.imdecode(np.frombuffer(f.read(size), dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+def evaluate_sample(sample):
+    if "archive" in sample:
+        frame = read_archived_image(*sample["archive"])
+    else:
+        frame = cv2.imread(sample["image"], cv2.IMREAD_COLOR)
+    if frame is None:
+        return dict(sample, error="unreadable image")
+    if frame.shape[:2] != (_FRAME_HEIGHT, _FRAME_WIDTH):
+        frame = cv2.resize(frame, (_FRAME_WIDTH, _FRAME_HEIGHT), interpolation=cv2.INTER_AREA)
+
+    start_time = time.time()
+    detection = _worker_manager.nozzleDetection(frame)
+    latency = (time.time() - start_time) * 1000
+
+    result = dict(sample, latency_ms=latency, found=detection.found, algorithm=str(detection.algorithm) if detection.found else None)
+    if detection.found:
+        center = detection.center
+        result["center"] = (float(center[0]), float(center[1]))
+        result["error_px"] = float(np.hypot(center[0] - sample["reference"][0], center[1] - sample["reference"][1]))
+    return result
+
+
+def summarize(results):
+    evaluated = [r for r in results if "error" not in r]
+    errors = np.array([r["error_px"] for r in evaluated if r["found"]], dtype=np.float64)
+    latencies = np.array([r["latency_ms"] for r in evaluated], dtype=np.float64)
+    misses = sum(1 for r in evaluated if not r["found"])
+
+    def stats(values, prefix):
+        if values.size == 0:
+            return {}
+        return {
+            prefix + "mean": float(values.mean()),
+            prefix + "p50": float(np.percentile(values, 50)),
+            prefix + "p95": float(np.percentile(values, 95)),
+            prefix + "max": float(values.max()),
+        }
+
+    summary = {
+        "frames": len(evaluated),
+        "unreadable": len(results) - len(evaluated),
+        "misses": misses,
+        "miss_rate": misses / len(evaluated) if evaluated else None,
+        "algorithms": dict(Counter(r["algorithm"] for r in evaluated if r["found"])),
+        "error_histogram_px": {
+            "<=0.5": int(np.sum(errors <= 0.5)),
+            "<=1": int(np.sum(errors <= 1)),
+            "<=2": int(np.sum(errors <= 2)),
+            "<=5": int(np.sum(errors <= 5)),
+            ">5": int(np.sum(errors > 5)),
+        },
+    }
+    summary.update(stats(errors, "error_px_"))
+    summary.update(stats(latencies, "latency_ms_"))
+    return summary
+
+
+def check_regressions(name, summary, baseline, args):
+    failures = []
+    if args.max_miss_rate is not None and summary["miss_rate"] is not None and summary["miss_rate"] > args.max_miss_rate:
+        failures.append("%s: miss rate %.3f above %.3f" % (name, summary["miss_rate"], args.max_miss_rate))
+    if args.max_error_p95 is not None and summary.get("error_px_p95", 0) > args.max_error_p95:
+        failures.append("%s: p95 center error %.2fpx above %.2fpx" % (name, summary["error_px_p95"], args.max_error_p95))
+    if args.max_latency_p95 is not None and summary.get("latency_ms_p95", 0) > args.max_latency_p95:
+        failures.append("%s: p95 latency %.1fms above %.1fms" % (name, summary["latency_ms_p95"], args.max_latency_p95))
+
+    if baseline is None:
+        return failures
+    if summary["miss_rate"] is not None and baseline.get("miss_rate") is not None and summary["miss_rate"] > baseline["miss_rate"] + args.miss_rate_margin:
+        failures.append("%s: miss rate regressed %.3f -> %.3f" % (name, baseline["miss_rate"], summary["miss_rate"]))
+    if "error_px_p95" in summary and "error_px_p95" in baseline and summary["error_px_p95"] > baseline["error_px_p95"] + args.error_margin:
+        failures.append("%s: p95 center error regressed %.2fpx -> %.2fpx" % (name, baseline["error_px_p95"], summary["error_px_p95"]))
+    if "latency_ms_p50" in summary and "latency_ms_p50" in baseline and summary["latency_ms_p50"] > baseline["latency_ms_p50"] * (1 + args.latency_margin):
+        failures.append("%s: p50 latency regressed %.1fms -> %.1fms" % (name, baseline["latency_ms_p50"], summary["latency_ms_p50"]))
+    return failures
+
+
+def main():
+    parser = ArgumentParser(description="Replay saved frames through nozzleDetection and check for accuracy/speed regressions")
+    parser.add_argument("--model", action="append", default=None, help="Model file to evaluate, repeatable; 'blob' evaluates the blob cascade alone (default: all models in the current folder)")
+    parser.add_argument("--images", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "collected_images"), help="Folder with the saved .jpg/.json pairs")
+    parser.add_argument("--runtime", default="{}", help='Runtime settings as JSON, e.g. \'{"intra_op_threads": 1}\'')
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2), help="Worker processes (keep equal between compared runs)")
+    parser.add_argument("--baseline", default=None, help="Previous --output file to compare against")
+    parser.add_argument("--miss-rate-margin", type=float, default=0.02, help="Allowed miss rate increase over the baseline")
+    parser.add_argument("--error-margin", type=float, default=0.5, help="Allowed p95 center error increase over the baseline, in pixels")
+    parser.add_argument("--latency-margin", type=float, default=0.2, help="Allowed p50 latency increase over the baseline, as a fraction")
+    parser.add_argument("--max-miss-rate", type=float, default=None, help="Absolute miss rate limit")
+    parser.add_argument("--max-error-p95", type=float, default=None, help="Absolute p95 center error limit in pixels")
+    parser.add_argument("--max-latency-p95", type=float, default=None, help="Absolute p95 latency limit in ms")
+    parser.add_argument("--output", default=None, help="Write the report as JSON to this file")
+    parser.add_argument("--per-frame", action="store_true", help="Include per-frame results in the report")
+    args = parser.parse_args()
+
+    samples = load_dataset(args.images)
+    if not samples:
+        print("No saved frames with a detected position found in %s" % args.images)
+        return 2
+
+    models = args.model
+    if models is None:
+        models = sorted(f for f in os.listdir(".") if f.endswith((".onnx", ".tflite"))) or [_BLOB_ONLY]
+    runtime_overrides = json.loads(args.runtime)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+
+    report = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "images": os.path.abspath(args.images),
+        "workers": args.workers,
+        "runtime_overrides": runtime_overrides,
+        "configs": {},
+    }
+    failures = []
+    context = multiprocessing.get_context("spawn")
+    for model in models:
+        name = os.path.basename(model)
+        with ProcessPoolExecutor(max_workers=args.workers, mp_context=context, initializer=init_worker, initargs=(model, runtime_overrides)) as executor:
+            results = list(executor.map(evaluate_sample, samples, chunksize=4))
+        summary = summarize(results)
+        report["configs"][name] = {"summary": summary}
+        if args.per_frame:
+            report["configs"][name]["frames"] = results
+
+        print("%-28s frames %4i  miss %5.1f%%  err p50 %5.2fpx p95 %5.2fpx  latency p50 %7.1fms p95 %7.1fms  %s" % (
+            name, summary["frames"], 100 * (summary["miss_rate"] or 0), summary.get("error_px_p50", float("nan")),
+            summary.get("error_px_p95", float("nan")), summary.get("latency_ms_p50", float("nan")),
+            summary.get("latency_ms_p95", float("nan")), summary["algorithms"]))
+
+        baseline_summary = None
+        if baseline is not None and name in baseline.get("configs", {}):
+            baseline_summary = baseline["configs"][name]["summary"]
+        failures += check_regressions(name, summary, baseline_summary, args)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Report written to %s" % args.output)
+
+    for failure in failures:
+        print("REGRESSION: %s" % failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,27 @@
+# Exports the frames of the dataset store (training_store: archive) as a YOLO dataset:
+# images/<name>.jpg and labels/<name>.txt, with the label box taken from the stored detection
+# (the AI box, or a square around the blob for blob detections).
+#
+# Usage: python export_dataset.py --output dataset/ [--images ../collected_images]
+import os, sys
+from argparse import ArgumentParser
+from taxy_server_dataset import Taxy_Server_Dataset_Store
+
+
+def main():
+    parser = ArgumentParser(description="Export the collected detection frames as YOLO images and labels")
+    parser.add_argument("--images", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "collected_images"), help="Folder of the dataset store")
+    parser.add_argument("--output", required=True, help="Folder to write images/ and labels/ to")
+    args = parser.parse_args()
+
+    store = Taxy_Server_Dataset_Store(args.images)
+    if store.stored == 0:
+        print("No stored frames found in %s" % args.images)
+        return 2
+    exported = store.export_yolo(args.output)
+    print("Exported %i of %i frames to %s" % (exported, store.stored, args.output))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
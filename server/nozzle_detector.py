@@ -2,39 +2,323 @@ import cv2
 import numpy as np
 import time
 import os
+import math
+import threading
+from dataclasses import dataclass, fields, asdict, replace
+
+# Tipi dei tensori di input/uscita ONNX supportati
+ONNX_TENSOR_TYPES = {
+    'tensor(float)': np.float32,
+    'tensor(float16)': np.float16,
+    'tensor(uint8)': np.uint8,
+    'tensor(int8)': np.int8,
+}
+# (scale, zero_point) degli input interi ONNX quando il modello non li indica: uint8 riceve i pixel
+# grezzi (normalizzazione nel grafo), int8 i pixel traslati di -128
+ONNX_DEFAULT_INPUT_QUANTIZATION = {
+    np.uint8: (1.0 / 255.0, 0),
+    np.int8: (1.0 / 255.0, -128),
+}
+
+# Stride massimo di YOLOv8: le dimensioni di input dei modelli dinamici devono esserne multipli
+MODEL_STRIDE = 32
+
+# Formati di uscita riconosciuti (vedi NozzleDetector.output_format_for)
+OUTPUT_FORMATS = ('auto', 'raw', 'objectness', 'end2end')
+# Numero massimo di righe di un'uscita end2end (max_det degli export con NMS)
+MAX_END2END_DETECTIONS = 1000
+
+# Livelli di ottimizzazione del grafo ONNX Runtime accettati in RuntimeConfig
+GRAPH_OPTIMIZATION_LEVELS = ('disable', 'basic', 'extended', 'all')
+
+@dataclass
+class RuntimeConfig:
+    """
+    Impostazioni del runtime di inferenza (thread, ottimizzazione grafo, provider, CPU).
+    I valori None/0 lasciano il default del runtime.
+    """
+    intra_op_threads: int = 0
+    inter_op_threads: int = 0
+    graph_optimization: str = 'all'
+    execution_providers: list = None
+    # Spin-wait dei thread ONNX Runtime: spento per non rubare CPU a klippy
+    allow_spinning: bool = False
+    tflite_num_threads: int = None
+    use_xnnpack: bool = True
+    # Lato lungo dell'input per modelli con dimensioni dinamiche (multiplo di MODEL_STRIDE)
+    dynamic_input_size: int = 640
+    # CPU e niceness dei thread che caricano il modello ed eseguono l'inferenza
+    cpu_affinity: list = None
+    niceness: int = None
+
+    @classmethod
+    def from_dict(cls, data, base=None):
+        """
+        Crea una configurazione da un dizionario (es. payload di set_server_cfg), partendo da base.
+        Solleva ValueError per chiavi o valori non validi.
+        """
+        base = base if base is not None else cls()
+        if not data:
+            return base
+        if not isinstance(data, dict):
+            raise ValueError("La configurazione runtime deve essere un oggetto JSON")
+        known = {f.name for f in fields(cls)}
+        unknown = set(data) - known
+        if unknown:
+            raise ValueError(f"Opzioni runtime sconosciute: {', '.join(sorted(unknown))}")
+        config = replace(base, **data)
+        config.validate()
+        return config
+
+    def validate(self):
+        for name in ('intra_op_threads', 'inter_op_threads'):
+            value = getattr(self, name)
+            if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+                raise ValueError(f"{name} deve essere un intero >= 0")
+        for name in ('allow_spinning', 'use_xnnpack'):
+            if not isinstance(getattr(self, name), bool):
+                raise ValueError(f"{name} deve essere true o false")
+        if self.tflite_num_threads is not None and (isinstance(self.tflite_num_threads, bool) or not isinstance(self.tflite_num_threads, int) or self.tflite_num_threads < 1):
+            raise ValueError("tflite_num_threads deve essere un intero >= 1")
+        if isinstance(self.dynamic_input_size, bool) or not isinstance(self.dynamic_input_size, int) or self.dynamic_input_size < MODEL_STRIDE or self.dynamic_input_size % MODEL_STRIDE:
+            raise ValueError(f"dynamic_input_size deve essere un multiplo di {MODEL_STRIDE}")
+        if self.graph_optimization not in GRAPH_OPTIMIZATION_LEVELS:
+            raise ValueError(f"graph_optimization deve essere uno di: {', '.join(GRAPH_OPTIMIZATION_LEVELS)}")
+        if self.execution_providers is not None and not isinstance(self.execution_providers, list):
+            raise ValueError("execution_providers deve essere una lista")
+        if self.cpu_affinity is not None:
+            if not isinstance(self.cpu_affinity, list) or not all(isinstance(c, int) and not isinstance(c, bool) and c >= 0 for c in self.cpu_affinity):
+                raise ValueError("cpu_affinity deve essere una lista di indici CPU")
+        if self.niceness is not None and (isinstance(self.niceness, bool) or not isinstance(self.niceness, int) or not -20 <= self.niceness <= 19):
+            raise ValueError("niceness deve essere un intero tra -20 e 19")
+
+    def to_dict(self):
+        return asdict(self)
+
+    def apply_to_current_thread(self):
+        """
+        Applica affinità CPU e niceness al thread corrente (Linux: sono attributi per thread).
+        I thread creati dopo (es. il pool di ONNX Runtime) li ereditano.
+        Alla prima modifica si salvano i valori originali del thread: senza cpu_affinity o niceness
+        il thread li riprende, così un valore tolto dalla configurazione non resta attivo.
+        Sui sistemi senza queste chiamate (macOS, Windows) l'impostazione viene ignorata.
+        """
+        if hasattr(os, "sched_setaffinity"):
+            if self.cpu_affinity:
+                if not hasattr(_thread_defaults, "affinity"):
+                    _thread_defaults.affinity = os.sched_getaffinity(0)
+                os.sched_setaffinity(0, self.cpu_affinity)
+            elif hasattr(_thread_defaults, "affinity"):
+                os.sched_setaffinity(0, _thread_defaults.affinity)
+        if hasattr(os, "setpriority"):
+            thread_id = threading.get_native_id()
+            if self.niceness is not None:
+                if not hasattr(_thread_defaults, "niceness"):
+                    _thread_defaults.niceness = os.getpriority(os.PRIO_PROCESS, thread_id)
+                os.setpriority(os.PRIO_PROCESS, thread_id, self.niceness)
+            elif hasattr(_thread_defaults, "niceness"):
+                # Abbassare la niceness richiede CAP_SYS_NICE, altrimenti solleva PermissionError
+                os.setpriority(os.PRIO_PROCESS, thread_id, _thread_defaults.niceness)
+
+# Affinità e niceness dei thread prima di apply_to_current_thread, per ripristinarle
+_thread_defaults = threading.local()
+
+class LetterboxBuffers:
+    """
+    Buffer preallocati per il preprocessing letterbox di un singolo thread.
+    batch: numero di frame nel tensore (1 per infer, N per infer_batch).
+    """
+    def __init__(self, input_height, input_width, layout, dtype=np.float32, batch=1):
+        # Canvas uint8 con padding grigio (114) come in YOLOv8, riusato per ogni frame del batch
+        self.canvas = np.full((input_height, input_width, 3), 114, dtype=np.uint8)
+        if layout == 'NHWC':
+            self.tensor = np.empty((batch, input_height, input_width, 3), dtype=dtype)
+            self.tensor_hwc = [self.tensor[i] for i in range(batch)]
+        else:
+            self.tensor = np.empty((batch, 3, input_height, input_width), dtype=dtype)
+            # Vista HWC sul tensore NCHW: la normalizzazione scrive già nel layout finale
+            self.tensor_hwc = [self.tensor[i].transpose((1, 2, 0)) for i in range(batch)]
+        # Geometria del letterbox attualmente nel canvas (new_w, new_h, top, left)
+        self.geometry = None
+
+def xywh_to_xyxy(candidates):
+    """
+    Converte (N, 4) da cx,cy,w,h a x1,y1,x2,y2 (nuovo array float32).
+    """
+    boxes = np.empty((candidates.shape[0], 4), dtype=np.float32)
+    half_size = candidates[:, 2:4] / 2
+    boxes[:, 0:2] = candidates[:, 0:2] - half_size
+    boxes[:, 2:4] = candidates[:, 0:2] + half_size
+    return boxes
+
+def nms(boxes, scores, iou_thres):
+    """
+    Non-Maximum Suppression in NumPy (class-agnostic).
+    boxes: (N, 4) in formato x1,y1,x2,y2. Ritorna gli indici da tenere, in ordine di punteggio.
+    """
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+    order = np.argsort(-scores, kind='stable')
+    
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(int(i))
+        if order.size == 1:
+            break
+        rest = order[1:]
+        # Intersezione del box migliore con tutti i rimanenti
+        w = np.maximum(np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]), 0)
+        h = np.maximum(np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]), 0)
+        inter = w * h
+        iou = inter / (areas[i] + areas[rest] - inter + 1e-9)
+        order = rest[iou <= iou_thres]
+    return keep
+
+def _import_tflite():
+    try:
+        import tflite_runtime.interpreter as tflite
+    except ImportError:
+        try:
+            import tensorflow.lite as tflite
+        except ImportError:
+            raise ImportError("Errore: Installa 'tflite-runtime' o 'tensorflow' per usare modelli .tflite")
+    return tflite
+
+def read_input_shape(model_path):
+    """
+    Legge la shape dell'input del modello senza creare una sessione di inferenza
+    (metadati dei modelli non caricati). Gli assi dinamici sono None.
+    """
+    ext = os.path.splitext(model_path)[1].lower()
+    if ext == '.tflite':
+        # Senza allocate_tensors l'interprete legge solo il grafo
+        details = _import_tflite().Interpreter(model_path=model_path, num_threads=1).get_input_details()[0]
+        shape = details.get('shape_signature', details['shape'])
+        return [int(d) if d > 0 else None for d in shape]
+    if ext != '.onnx':
+        raise ValueError(f"Formato modello non supportato: {ext}. Usa .tflite o .onnx")
+    try:
+        import onnx
+    except ImportError:
+        onnx = None
+    if onnx is not None:
+        model = onnx.load(model_path, load_external_data=False)
+        # I modelli con IR vecchio elencano anche i pesi tra gli input del grafo
+        initializers = {init.name for init in model.graph.initializer}
+        graph_input = next(i for i in model.graph.input if i.name not in initializers)
+        return [d.dim_value if d.dim_value > 0 else None for d in graph_input.type.tensor_type.shape.dim]
+    # Senza il pacchetto onnx: sessione minima, un thread e nessuna ottimizzazione del grafo
+    import onnxruntime as ort
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = 1
+    options.inter_op_num_threads = 1
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+    session = ort.InferenceSession(model_path, sess_options=options, providers=['CPUExecutionProvider'])
+    try:
+        shape = session.get_inputs()[0].shape
+    finally:
+        del session
+    return [d if isinstance(d, int) and d > 0 else None for d in shape]
+
+def _onnx_quantization(model_path, session, input_name, output_name):
+    """
+    (scale, zero_point) dell'input e dell'uscita di un modello ONNX quantizzato, None se non indicati.
+    Prima le chiavi input_scale/input_zero_point e output_scale/output_zero_point dei metadati del
+    modello, poi (con il pacchetto onnx) il DequantizeLinear che legge l'input e il QuantizeLinear
+    che produce l'uscita, se hanno parametri per-tensore.
+    """
+    metadata = session.get_modelmeta().custom_metadata_map
+    found = dict()
+    for name in ('input', 'output'):
+        if name + '_scale' in metadata:
+            found[name] = (float(metadata[name + '_scale']), int(metadata.get(name + '_zero_point', 0)))
+    if len(found) == 2:
+        return found['input'], found['output']
+    try:
+        import onnx
+        from onnx import numpy_helper
+    except ImportError:
+        return found.get('input'), found.get('output')
+
+    model = onnx.load(model_path, load_external_data=False)
+    initializers = {init.name: numpy_helper.to_array(init) for init in model.graph.initializer}
+
+    def parameters(node):
+        scale = initializers.get(node.input[1])
+        zero_point = initializers.get(node.input[2]) if len(node.input) > 2 and node.input[2] else np.zeros(1)
+        if scale is None or zero_point is None or scale.size != 1 or zero_point.size != 1:
+            return None
+        return float(scale.reshape(-1)[0]), int(zero_point.reshape(-1)[0])
+
+    for node in model.graph.node:
+        if 'input' not in found and node.op_type == 'DequantizeLinear' and node.input[0] == input_name:
+            found['input'] = parameters(node)
+        if 'output' not in found and node.op_type == 'QuantizeLinear' and node.output[0] == output_name:
+            found['output'] = parameters(node)
+    return found.get('input'), found.get('output')
+
+def input_layout(input_shape):
+    """
+    'NHWC' o 'NCHW' dalla shape dell'input (ONNX standard è NCHW, alcuni export sono NHWC).
+    """
+    return 'NHWC' if input_shape[-1] == 3 and input_shape[1] != 3 else 'NCHW'
 
 class NozzleDetector:
-    def __init__(self, model_path, conf_thres=0.25, iou_thres=0.45):
+    def __init__(self, model_path, conf_thres=0.25, iou_thres=0.45, top_k=300, runtime=None, output_format='auto'):
         """
         Inizializza il rilevatore di ugelli.
         Supporta modelli .tflite (consigliato per Orange Pi) e .onnx.
+        top_k: numero massimo di candidati passati all'NMS.
+        runtime: RuntimeConfig con thread e ottimizzazioni del runtime (default se None).
+        output_format: formato dell'uscita ('auto' per riconoscerlo dalla shape, vedi OUTPUT_FORMATS).
         """
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"output_format deve essere uno di: {', '.join(OUTPUT_FORMATS)}")
+        self.output_format = output_format
+        # Formato riconosciuto per ogni (shape uscita, geometria input)
+        self._output_formats = dict()
         self.model_path = model_path
         self.conf_thres = conf_thres
         self.iou_thres = iou_thres
+        self.top_k = top_k
+        self.runtime = runtime if runtime is not None else RuntimeConfig()
         self.ext = os.path.splitext(model_path)[1].lower()
+        # Buffer di input preallocati, uno per thread
+        self._local = threading.local()
         
         print(f"Caricamento modello: {model_path}...")
         
         if self.ext == '.tflite':
-            try:
-                import tflite_runtime.interpreter as tflite
-            except ImportError:
-                try:
-                    import tensorflow.lite as tflite
-                except ImportError:
-                    raise ImportError("Errore: Installa 'tflite-runtime' o 'tensorflow' per usare modelli .tflite")
+            tflite = _import_tflite()
             
-            self.interpreter = tflite.Interpreter(model_path=model_path)
+            interpreter_args = {'model_path': model_path}
+            if self.runtime.tflite_num_threads:
+                interpreter_args['num_threads'] = self.runtime.tflite_num_threads
+            if not self.runtime.use_xnnpack:
+                # XNNPACK è il delegate di default: si disattiva usando il resolver senza delegate
+                resolver_type = getattr(tflite, 'OpResolverType', None) or tflite.experimental.OpResolverType
+                interpreter_args['experimental_op_resolver_type'] = resolver_type.BUILTIN_WITHOUT_DEFAULT_DELEGATES
+            
+            self.interpreter = tflite.Interpreter(**interpreter_args)
             self.interpreter.allocate_tensors()
             self.input_details = self.interpreter.get_input_details()
             self.output_details = self.interpreter.get_output_details()
             
-            # Ottieni dimensioni input (es. 640x640)
+            # Ottieni dimensioni input (es. 640x640), -1 nella signature indica un asse dinamico
             self.input_shape = self.input_details[0]['shape']
-            self.input_height = self.input_shape[1]
-            self.input_width = self.input_shape[2]
-            self.input_type = self.input_details[0]['dtype']
+            self._tflite_input_shape = tuple(self.input_shape)
+            input_signature = self.input_details[0].get('shape_signature', self.input_shape)
+            self.input_type = np.dtype(self.input_details[0]['dtype'])
+            # Parametri di quantizzazione (scale, zero_point) per modelli INT8/UINT8, None se float
+            self.input_quantization = self._tflite_quantization(self.input_details[0])
+            self.output_quantization = self._tflite_quantization(self.output_details[0])
+            # Controlla se il modello vuole NHWC (1, 640, 640, 3) o NCHW (1, 3, 640, 640)
+            self.input_layout = 'NHWC' if self.input_shape[-1] == 3 else 'NCHW'
+            self._set_input_geometry(list(input_signature))
+            # Asse batch dinamico (-1): infer_batch può eseguire N frame in un solo run
+            self.batch_input = input_signature[0] == -1
+            self._interpreter_lock = threading.Lock()
             
         elif self.ext == '.onnx':
             try:
@@ -42,121 +326,465 @@ class NozzleDetector:
             except ImportError:
                 raise ImportError("Errore: Installa 'onnxruntime' per usare modelli .onnx")
                 
-            self.session = ort.InferenceSession(model_path)
+            self.session = ort.InferenceSession(
+                model_path,
+                sess_options=self._session_options(ort),
+                providers=self.runtime.execution_providers
+            )
             self.input_name = self.session.get_inputs()[0].name
             self.output_name = self.session.get_outputs()[0].name
-            self.input_height = 640 # Default YOLOv8
-            self.input_width = 640
+            self.input_type = np.dtype(ONNX_TENSOR_TYPES.get(self.session.get_inputs()[0].type, np.float32))
+            output_type = np.dtype(ONNX_TENSOR_TYPES.get(self.session.get_outputs()[0].type, np.float32))
+            # Input e uscite intere (uint8/int8) vengono (de)quantizzati con i parametri del modello;
+            # le uscite QDQ che terminano con un DequantizeLinear sono già float
+            self.input_quantization = self.output_quantization = None
+            if np.issubdtype(self.input_type, np.integer) or np.issubdtype(output_type, np.integer):
+                input_quantization, output_quantization = _onnx_quantization(model_path, self.session, self.input_name, self.output_name)
+                if np.issubdtype(self.input_type, np.integer):
+                    self.input_quantization = input_quantization or ONNX_DEFAULT_INPUT_QUANTIZATION[self.input_type.type]
+                if np.issubdtype(output_type, np.integer):
+                    if output_quantization is None:
+                        raise ValueError("Uscita ONNX intera senza parametri di quantizzazione: aggiungi output_scale/output_zero_point ai metadati del modello")
+                    self.output_quantization = output_quantization
+            # Geometria dell'input letta dal modello; gli assi dinamici sono stringhe o None
+            input_shape = self.session.get_inputs()[0].shape
+            self.input_layout = input_layout(input_shape)
+            self._set_input_geometry(input_shape)
+            # Asse batch dinamico (stringa o None): infer_batch può eseguire N frame in un solo run
+            self.batch_input = not isinstance(input_shape[0], int)
             
         else:
             raise ValueError(f"Formato modello non supportato: {self.ext}. Usa .tflite o .onnx")
             
-        print(f"Modello caricato. Input size: {self.input_width}x{self.input_height}")
+        # Tabella pixel (0-255) -> valore quantizzato, per input INT8/UINT8
+        self.input_lut = self._input_lut()
+        
+        print(f"Modello caricato. Input size: {self.input_width}x{self.input_height}{' (dinamico)' if self.dynamic_input else ''}, input type: {self.input_type}")
+
+    def _set_input_geometry(self, input_shape):
+        """
+        Legge altezza e larghezza dell'input dalla shape del modello.
+        Gli assi dinamici vengono scelti per frame da input_geometry; input_height/input_width
+        riportano allora la dimensione nominale (dynamic_input_size).
+        """
+        if self.input_layout == 'NHWC':
+            height, width = input_shape[1], input_shape[2]
+        else:
+            height, width = input_shape[2], input_shape[3]
+        self._fixed_height = int(height) if isinstance(height, (int, np.integer)) and height > 0 else None
+        self._fixed_width = int(width) if isinstance(width, (int, np.integer)) and width > 0 else None
+        self.dynamic_input = self._fixed_height is None or self._fixed_width is None
+        self.input_height = self._fixed_height or self.runtime.dynamic_input_size
+        self.input_width = self._fixed_width or self.runtime.dynamic_input_size
+
+    def input_geometry(self, img_height, img_width):
+        """
+        Ritorna (altezza, larghezza) dell'input del modello per un frame.
+        Modelli statici: quelle del modello. Assi dinamici: lato lungo pari a dynamic_input_size,
+        lato corto secondo l'aspect ratio del frame (niente padding quadrato), multipli di MODEL_STRIDE.
+        """
+        if not self.dynamic_input:
+            return self.input_height, self.input_width
+        size = self.runtime.dynamic_input_size
+        if img_width >= img_height:
+            height, width = size * img_height / img_width, size
+        else:
+            height, width = size, size * img_width / img_height
+        height = self._fixed_height or max(MODEL_STRIDE, math.ceil(height / MODEL_STRIDE) * MODEL_STRIDE)
+        width = self._fixed_width or max(MODEL_STRIDE, math.ceil(width / MODEL_STRIDE) * MODEL_STRIDE)
+        return height, width
+
+    @staticmethod
+    def _tflite_quantization(detail):
+        """
+        Ritorna (scale, zero_point) di un tensore TFLite quantizzato, None se il tensore è float.
+        """
+        if not np.issubdtype(np.dtype(detail['dtype']), np.integer):
+            return None
+        scale, zero_point = detail['quantization']
+        if scale == 0:
+            return None
+        return float(scale), int(zero_point)
+
+    def _input_lut(self):
+        """
+        Costruisce la tabella di quantizzazione dell'input: q = round(pixel / 255 / scale + zero_point).
+        None per input float; None anche se la tabella è l'identità (uint8 con scale 1/255), basta copiare.
+        """
+        if self.input_quantization is None:
+            return None
+        scale, zero_point = self.input_quantization
+        info = np.iinfo(self.input_type)
+        values = np.round(np.arange(256, dtype=np.float64) / 255.0 / scale + zero_point)
+        lut = np.clip(values, info.min, info.max).astype(self.input_type)
+        if self.input_type == np.uint8 and np.array_equal(lut, np.arange(256)):
+            return None
+        return lut
+
+    def _dequantize(self, output_data):
+        """
+        Converte l'uscita del modello in float32, dequantizzando le uscite INT8/UINT8.
+        """
+        if self.output_quantization is not None:
+            scale, zero_point = self.output_quantization
+            return (output_data.astype(np.float32) - zero_point) * np.float32(scale)
+        if output_data.dtype != np.float32:
+            return output_data.astype(np.float32)
+        return output_data
+
+    def _session_options(self, ort):
+        """
+        Crea le SessionOptions ONNX Runtime dalla RuntimeConfig.
+        """
+        options = ort.SessionOptions()
+        if self.runtime.intra_op_threads:
+            options.intra_op_num_threads = self.runtime.intra_op_threads
+        if self.runtime.inter_op_threads:
+            options.inter_op_num_threads = self.runtime.inter_op_threads
+            if self.runtime.inter_op_threads > 1:
+                options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        options.graph_optimization_level = {
+            'disable': ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+            'basic': ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+            'extended': ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+            'all': ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+        }[self.runtime.graph_optimization]
+        options.add_session_config_entry('session.intra_op.allow_spinning', '1' if self.runtime.allow_spinning else '0')
+        options.add_session_config_entry('session.inter_op.allow_spinning', '1' if self.runtime.allow_spinning else '0')
+        return options
+
+    def runtime_info(self):
+        """
+        Ritorna le impostazioni effettive del runtime caricato.
+        """
+        info = {
+            'backend': self.ext.lstrip('.'),
+            'config': self.runtime.to_dict(),
+            'output_format': self.output_format if self.output_format != 'auto' else sorted(set(self._output_formats.values())),
+        }
+        if self.ext == '.onnx' and self.session is not None:
+            options = self.session.get_session_options()
+            info['providers'] = self.session.get_providers()
+            info['intra_op_threads'] = options.intra_op_num_threads
+            info['inter_op_threads'] = options.inter_op_num_threads
+            info['graph_optimization_level'] = str(options.graph_optimization_level)
+        return info
 
     def preprocess(self, image):
         """
         Ridimensiona e normalizza l'immagine per il modello.
+        Scrive direttamente nei buffer preallocati del thread corrente (nessuna allocazione per frame).
+        Ritorna (input_data, scale, top, left): i parametri del letterbox non vengono salvati sull'istanza.
+        """
+        input_height, input_width = self.input_geometry(*image.shape[:2])
+        buffers = self._get_buffers(input_height, input_width)
+        scale, top, left = self._letterbox(image, buffers, 0)
+        return buffers.tensor, scale, top, left
+
+    def preprocess_batch(self, frames):
+        """
+        Come preprocess, ma scrive N frame (stessa dimensione) in un unico tensore batch.
+        Ritorna (input_data, [(scale, top, left), ...]).
+        """
+        input_height, input_width = self.input_geometry(*frames[0].shape[:2])
+        buffers = self._get_buffers(input_height, input_width, len(frames))
+        letterboxes = [self._letterbox(frame, buffers, i) for i, frame in enumerate(frames)]
+        return buffers.tensor, letterboxes
+
+    def _letterbox(self, image, buffers, index):
+        """
+        Letterbox di un frame nel canvas e normalizzazione nella posizione index del tensore.
+        Ritorna (scale, top, left).
         """
-        self.img_height, self.img_width = image.shape[:2]
+        img_height, img_width = image.shape[:2]
+        input_height, input_width = buffers.canvas.shape[:2]
         
         # Resize mantenendo aspect ratio (letterbox)
-        scale = min(self.input_width / self.img_width, self.input_height / self.img_height)
-        new_w = int(self.img_width * scale)
-        new_h = int(self.img_height * scale)
-        
-        resized = cv2.resize(image, (new_w, new_h))
-        
-        # Padding per arrivare a 640x640
-        canvas = np.full((self.input_height, self.input_width, 3), 114, dtype=np.uint8)
+        scale = min(input_width / img_width, input_height / img_height)
+        new_w = int(img_width * scale)
+        new_h = int(img_height * scale)
         
         # Centra l'immagine
-        top = (self.input_height - new_h) // 2
-        left = (self.input_width - new_w) // 2
-        canvas[top:top+new_h, left:left+new_w] = resized
+        top = (input_height - new_h) // 2
+        left = (input_width - new_w) // 2
         
-        # Normalizzazione (0-255 -> 0.0-1.0)
-        input_data = canvas.astype(np.float32) / 255.0
+        # Il padding (114) va riscritto solo se cambia la geometria del letterbox
+        geometry = (new_w, new_h, top, left)
+        if buffers.geometry != geometry:
+            buffers.canvas.fill(114)
+            buffers.geometry = geometry
         
-        # Gestione formato Input
-        if self.ext == '.tflite':
-            # Controlla se il modello vuole NHWC (1, 640, 640, 3) o NCHW (1, 3, 640, 640)
-            if self.input_shape[-1] == 3: # NHWC
-                input_data = np.expand_dims(input_data, axis=0)
-            else: # NCHW
-                input_data = input_data.transpose((2, 0, 1))
-                input_data = np.expand_dims(input_data, axis=0)
+        # Resize direttamente nella regione centrale del canvas
+        region = buffers.canvas[top:top+new_h, left:left+new_w]
+        if (new_w, new_h) == (img_width, img_height):
+            region[...] = image
+        else:
+            cv2.resize(image, (new_w, new_h), dst=region)
+        
+        # Normalizzazione (0-255 -> 0.0-1.0) o quantizzazione, e cambio layout (HWC -> NCHW/NHWC) in un solo passaggio
+        tensor_hwc = buffers.tensor_hwc[index]
+        if self.input_lut is not None:
+            np.take(self.input_lut, buffers.canvas, out=tensor_hwc, mode='clip')
+        elif np.issubdtype(self.input_type, np.integer):
+            # uint8 con scale 1/255: i pixel vanno passati così come sono
+            np.copyto(tensor_hwc, buffers.canvas)
         else:
-            # ONNX standard è NCHW
-            input_data = input_data.transpose((2, 0, 1))
-            input_data = np.expand_dims(input_data, axis=0)
+            np.multiply(buffers.canvas, np.float32(1.0 / 255.0), out=tensor_hwc, casting='unsafe')
         
-        return input_data, scale, top, left
+        return scale, top, left
 
-    def infer(self, image):
+    def _get_buffers(self, input_height, input_width, batch=1):
+        """
+        Ritorna i buffer di input del thread corrente per la geometria e il batch dati, creandoli al primo uso.
+        """
+        buffers_by_size = getattr(self._local, 'buffers', None)
+        if buffers_by_size is None:
+            buffers_by_size = self._local.buffers = dict()
+        buffers = buffers_by_size.get((batch, input_height, input_width))
+        if buffers is None:
+            buffers = LetterboxBuffers(input_height, input_width, self.input_layout, self.input_type, batch)
+            buffers_by_size[(batch, input_height, input_width)] = buffers
+        return buffers
+
+    def _run(self, input_data):
+        """
+        Esegue il modello su un tensore di input già preparato e ritorna l'uscita grezza.
+        """
+        if self.ext == '.tflite':
+            # L'interprete TFLite non è thread-safe
+            with self._interpreter_lock:
+                # Modelli dinamici: ridimensiona l'input solo quando cambia la geometria o il batch
+                if self._tflite_input_shape != input_data.shape:
+                    self.interpreter.resize_tensor_input(self.input_details[0]['index'], input_data.shape)
+                    self.interpreter.allocate_tensors()
+                    self._tflite_input_shape = input_data.shape
+                self.interpreter.set_tensor(self.input_details[0]['index'], input_data)
+                self.interpreter.invoke()
+                return self.interpreter.get_tensor(self.output_details[0]['index'])
+        return self.session.run([self.output_name], {self.input_name: input_data})[0]
+
+    def _input_size(self, input_data):
+        """
+        (altezza, larghezza) del tensore di input.
+        """
+        if self.input_layout == 'NHWC':
+            return input_data.shape[1:3]
+        return input_data.shape[2:4]
+
+    def infer(self, image, timings=None):
         """
         Esegue l'inferenza sull'immagine.
-        Ritorna una lista di dizionari: [{'box': [x1, y1, x2, y2], 'score': float, 'class_id': int}, ...]
+        Ritorna (results, inference_time, postprocess_time), tempi in ms.
+        results è una lista di dizionari: [{'box': [x1, y1, x2, y2], 'score': float, 'class_id': int}, ...]
+        timings: dizionario opzionale riempito con i tempi per fase in ms (preprocess, inference, decode, nms).
         """
+        start_time = time.time()
         input_data, scale, pad_top, pad_left = self.preprocess(image)
+        preprocess_time = (time.time() - start_time) * 1000
         
         start_time = time.time()
+        output_data = self._run(input_data)
+        inference_time = (time.time() - start_time) * 1000
         
-        if self.ext == '.tflite':
-            self.interpreter.set_tensor(self.input_details[0]['index'], input_data)
-            self.interpreter.invoke()
-            output_data = self.interpreter.get_tensor(self.output_details[0]['index'])
-        elif self.ext == '.onnx':
-            output_data = self.session.run([self.output_name], {self.input_name: input_data})[0]
-            
+        start_time = time.time()
+        output_data = self._dequantize(output_data)
+        input_height, input_width = self._input_size(input_data)
+        results = self.postprocess(output_data, scale, pad_top, pad_left, input_height, input_width, timings)
+        postprocess_time = (time.time() - start_time) * 1000
+        
+        if timings is not None:
+            timings['preprocess'] = preprocess_time
+            timings['inference'] = inference_time
+            timings['decode'] = postprocess_time - timings['nms']
+                
+        return results, inference_time, postprocess_time
+
+    def infer_batch(self, frames):
+        """
+        Esegue l'inferenza su N frame con un solo run del modello (tensore batch).
+        Se il modello ha batch fisso o i frame hanno dimensioni diverse, esegue N inferenze singole.
+        Ritorna ([results per frame], inference_time, postprocess_time), tempi totali in ms.
+        """
+        if not frames:
+            return [], 0.0, 0.0
+        if len(frames) == 1 or not self.batch_input or any(f.shape != frames[0].shape for f in frames):
+            outputs = [self.infer(frame) for frame in frames]
+            return [o[0] for o in outputs], sum(o[1] for o in outputs), sum(o[2] for o in outputs)
+        
+        input_data, letterboxes = self.preprocess_batch(frames)
+        
+        start_time = time.time()
+        output_data = self._run(input_data)
         inference_time = (time.time() - start_time) * 1000
         
-        # Post-processing YOLOv8
-        # Output shape: (1, 4 + num_classes, 8400) -> (1, 5, 8400) per 1 classe
-        output_data = np.squeeze(output_data) # (5, 8400)
-        output_data = output_data.T # (8400, 5)
+        start_time = time.time()
+        output_data = self._dequantize(output_data)
+        input_height, input_width = self._input_size(input_data)
+        batch_results = []
+        for i, (scale, pad_top, pad_left) in enumerate(letterboxes):
+            batch_results.append(self.postprocess(output_data[i:i+1], scale, pad_top, pad_left, input_height, input_width))
+        postprocess_time = (time.time() - start_time) * 1000
         
-        boxes = []
-        scores = []
-        class_ids = []
+        return batch_results, inference_time, postprocess_time
+
+    def output_format_for(self, output_shape, input_height, input_width):
+        """
+        Riconosce il formato dell'uscita dalla sua shape (senza asse batch):
+        - 'raw': testa YOLOv8 (4 + C, N) o trasposta, N = ancore della griglia a stride 8/16/32
+        - 'objectness': testa stile YOLOv5 (3 * N, 5 + C) con colonna di objectness
+        - 'end2end': export con NMS nel grafo, (D, 6) = [x1, y1, x2, y2, score, class_id]
+        Il formato può essere forzato con output_format nel costruttore.
+        """
+        if self.output_format != 'auto':
+            return self.output_format
+        key = (tuple(output_shape), input_height, input_width)
+        output_format = self._output_formats.get(key)
+        if output_format is None:
+            anchors = sum((input_height // stride) * (input_width // stride) for stride in (8, 16, 32))
+            rows, cols = output_shape
+            if anchors in (rows, cols):
+                output_format = 'raw'
+            elif rows == 3 * anchors:
+                output_format = 'objectness'
+            elif cols == 6 and rows <= MAX_END2END_DETECTIONS:
+                output_format = 'end2end'
+            else:
+                output_format = 'raw'
+            self._output_formats[key] = output_format
+            print(f"Formato uscita {tuple(output_shape)}: {output_format}")
+        return output_format
+
+    def postprocess(self, output_data, scale, pad_top, pad_left, input_height, input_width, timings=None):
+        """
+        Decodifica l'uscita del modello con operazioni vettoriali (niente loop per ancora),
+        scegliendo il decoder in base al formato dell'uscita.
+        Ritorna la stessa struttura di infer: [{'box': [x1, y1, x2, y2], 'score': float, 'class_id': int}, ...]
+        timings: dizionario opzionale in cui scrivere il tempo dell'NMS in ms ('nms').
+        """
+        if timings is not None:
+            timings['nms'] = 0.0
+        output_data = np.squeeze(output_data, axis=0)
+        output_format = self.output_format_for(output_data.shape, input_height, input_width)
         
-        # Filtra per confidenza
-        # Row format: [x_center, y_center, width, height, class1_conf, class2_conf, ...]
+        if output_format == 'end2end':
+            decoded = self._decode_end2end(output_data)
+        elif output_format == 'objectness':
+            decoded = self._decode_objectness(output_data)
+        else:
+            decoded = self._decode_raw(output_data)
+        if decoded is None:
+            return []
+        boxes, scores, class_ids = decoded
         
-        # Per YOLOv8 detection, le prime 4 colonne sono bbox, le restanti sono le classi
-        # Se abbiamo 1 classe, shape è (8400, 5)
+        # Alcuni export (es. TFLite di Ultralytics) danno coordinate normalizzate 0-1
+        if boxes.max() <= 1.5:
+            boxes *= np.array([input_width, input_height, input_width, input_height], dtype=np.float32)
         
-        for i in range(output_data.shape[0]):
-            row = output_data[i]
-            classes_scores = row[4:]
-            class_id = np.argmax(classes_scores)
-            score = classes_scores[class_id]
-            
-            if score > self.conf_thres:
-                # Converti da cx,cy,w,h a x1,y1,x2,y2 (coordinate nel canvas 640x640)
-                cx, cy, w, h = row[0], row[1], row[2], row[3]
-                
-                x1 = int((cx - w/2) - pad_left) / scale
-                y1 = int((cy - h/2) - pad_top) / scale
-                x2 = int((cx + w/2) - pad_left) / scale
-                y2 = int((cy + h/2) - pad_top) / scale
-                
-                boxes.append([x1, y1, x2, y2])
-                scores.append(float(score))
-                class_ids.append(int(class_id))
-                
-        # Non-Maximum Suppression (NMS)
-        indices = cv2.dnn.NMSBoxes(boxes, scores, self.conf_thres, self.iou_thres)
+        # Rimuovi il letterbox (coordinate nell'immagine originale)
+        boxes -= np.array([pad_left, pad_top, pad_left, pad_top], dtype=np.float32)
+        boxes /= scale
+        
+        # Non-Maximum Suppression (NMS), già fatta nel grafo per gli export end2end
+        start_time = time.time()
+        if output_format == 'end2end':
+            keep = np.argsort(-scores, kind='stable')
+        else:
+            keep = nms(boxes, scores, self.iou_thres)
+        if timings is not None:
+            timings['nms'] = (time.time() - start_time) * 1000
         
         results = []
-        if len(indices) > 0:
-            for i in indices.flatten():
-                results.append({
-                    "box": boxes[i], # [x1, y1, x2, y2]
-                    "score": scores[i],
-                    "class_id": class_ids[i]
-                })
+        for i in keep:
+            results.append({
+                "box": boxes[i].tolist(), # [x1, y1, x2, y2]
+                "score": float(scores[i]),
+                "class_id": int(class_ids[i])
+            })
                 
-        return results, inference_time
+        return results
+
+    def _decode_raw(self, output_data):
+        """
+        Testa YOLOv8: (4 + num_classes, N), N ancore dipende dalla dimensione di input (8400 a 640x640).
+        Row format (per colonna): [x_center, y_center, width, height, class1_conf, class2_conf, ...]
+        Ritorna (boxes x1,y1,x2,y2, scores, class_ids) o None se nessun candidato supera la soglia.
+        """
+        # Alcuni export sono trasposti (N, 4 + num_classes): le ancore sono sempre l'asse più lungo
+        if output_data.shape[0] > output_data.shape[1]:
+            output_data = output_data.T
+        class_scores = output_data[4:]
+        
+        # Selezione classe e punteggio su tutte le ancore in un colpo solo
+        scores, class_ids = self._best_class(class_scores)
+        
+        # Filtra per confidenza
+        mask = scores > self.conf_thres
+        if not np.any(mask):
+            return None
+        return self._top_k(xywh_to_xyxy(output_data[:4, mask].T), scores[mask], class_ids[mask])
+
+    def _decode_objectness(self, output_data):
+        """
+        Testa stile YOLOv5: (N, 5 + num_classes) = [x_center, y_center, width, height, objectness, class1_conf, ...].
+        Punteggio = objectness * confidenza della classe (solo objectness se il modello non ha colonne di classe).
+        """
+        objectness = output_data[:, 4]
+        # Scarta subito le ancore con objectness sotto soglia: il punteggio finale non può superarla
+        mask = objectness > self.conf_thres
+        if not np.any(mask):
+            return None
+        candidates = output_data[mask]
+        if candidates.shape[1] > 5:
+            scores, class_ids = self._best_class(candidates[:, 5:].T)
+            scores = scores * candidates[:, 4]
+        else:
+            scores = candidates[:, 4]
+            class_ids = np.zeros(scores.shape[0], dtype=np.int64)
+        
+        mask = scores > self.conf_thres
+        if not np.any(mask):
+            return None
+        return self._top_k(xywh_to_xyxy(candidates[mask, :4]), scores[mask], class_ids[mask])
+
+    def _decode_end2end(self, output_data):
+        """
+        Export con NMS incluso: (D, 6) = [x1, y1, x2, y2, score, class_id], righe vuote con score 0.
+        """
+        scores = output_data[:, 4]
+        mask = scores > self.conf_thres
+        if not np.any(mask):
+            return None
+        detections = output_data[mask]
+        return detections[:, :4].astype(np.float32), detections[:, 4], detections[:, 5].astype(np.int64)
+
+    @staticmethod
+    def _best_class(class_scores):
+        """
+        class_scores: (num_classes, N). Ritorna (punteggio migliore, indice classe) per ogni ancora.
+        """
+        if class_scores.shape[0] == 1:
+            return class_scores[0], np.zeros(class_scores.shape[1], dtype=np.int64)
+        class_ids = np.argmax(class_scores, axis=0)
+        return class_scores[class_ids, np.arange(class_scores.shape[1])], class_ids
+
+    def _top_k(self, boxes, scores, class_ids):
+        """
+        Pre-filtro top-k: l'NMS lavora al massimo su top_k candidati.
+        """
+        if scores.shape[0] > self.top_k:
+            top = np.argpartition(-scores, self.top_k)[:self.top_k]
+            return boxes[top], scores[top], class_ids[top]
+        return boxes, scores, class_ids
+
+    def close(self):
+        """
+        Rilascia la sessione ONNX o l'interprete TFLite.
+        """
+        if self.ext == '.tflite':
+            with self._interpreter_lock:
+                self.interpreter = None
+        else:
+            self.session = None
 
     def draw_results(self, image, results):
         """
@@ -1,13 +1,15 @@
 # import the Flask module, the MJPEGResponse class, and the os module
 import datetime, io, time, random, os, numpy as np, threading
-from flask import Flask, jsonify, request, send_file #, send_from_directory
+from flask import Flask, jsonify, request, send_file, g, abort #, send_from_directory
 from PIL import Image, ImageDraw, ImageFont  #, ImageFile
 from argparse import ArgumentParser
 import matplotlib.font_manager as fm
 from waitress import serve
-import logging, json, traceback
+import logging, json, traceback, re
 from dataclasses import dataclass, field
-from taxy_server_dm import Taxy_Server_Detection_Manager as dm
+from taxy_server_dm import Taxy_Server_Detection_Manager as dm, draw_detection
+from taxy_server_ds import Taxy_Server_Detection_Service as ds
+from taxy_server_io import get_training_writer, Training_Image_Writer, READ_CHUNK_SIZE, Frame_Grabber, stream_url_for
 
 __logdebug = ""
 # If no nozzle found in this time, timeout the function
@@ -20,16 +22,12 @@ _FRAME_HEIGHT = 720
 
 # FPS to use when running the preview (higher for smoother AI visualization)
 __PREVIEW_FPS = 20
-
-# If the nozzle position is within this many pixels when comparing frames, it's considered a match. Only whole numbers are supported.
-__detection_tolerance = 0
-# Wheather to update the image at next request
-__update_static_image = True
-# Error message to show on the image
-__error_message_to_image = ""
-
-# Indicates if preview is running
-__preview_running = False
+# Context used by the endpoints without a /context/<name> prefix
+DEFAULT_CONTEXT = "default"
+# Context names allowed in the URL
+_CONTEXT_NAME = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+# Upper bound on the contexts one server keeps, each holds frames and request results
+_MAX_CONTEXTS = 16
 
 # Create logs folder if it doesn't exist and configure logging
 if not os.path.exists("./logs"):
@@ -47,20 +45,13 @@ logging.basicConfig(
 app = Flask(__name__)
 
 
-# Define a global variable to store the processed frame in form of an image
-__processed_frame_as_image = None
-# Define a global variable to store the processed frame in form of bytes
-__processed_frame_as_bytes = None
 # The loaded standby image
 __standby_image = None
-# Define a global variable to store the camera path.
-_camera_url = None
-# Whether to send the frame to the cloud
-__save_training_images = False
-# Define a global variable to store a key-value pair of the request id and the result
-request_results = dict()
-# The transform matrix calculated from the calibration points
-_transformMatrix = None
+# The long-lived detection service holding the loaded model, shared by all contexts
+_detection_service = None
+# Context name -> Taxy_Server_Context
+_contexts = dict()
+_contexts_lock = threading.Lock()
 
 
 @dataclass
@@ -70,12 +61,131 @@ class Ktay8_Request_Result:
     runtime: float = None
     statuscode: int = None
     statusmessage: str = None
-    
+    stats: dict = None # Measurement details, e.g. consensus spread and sample count
+
+
+# State of one camera/printer served by this server: camera, calibration, detection settings,
+# preview and request results. All contexts share the detection service and its inference workers.
+class Taxy_Server_Context:
+    def __init__(self, name):
+        self.name = name
+        # The camera path
+        self.camera_url = None
+        # The transform matrix calculated from the calibration points
+        self.transform_matrix = None
+        # Key-value pairs of the request id and the result
+        self.request_results = dict()
+        # Indicates if preview is running
+        self.preview_running = False
+
+        # Latest frame and detection result, the overlay is only drawn when /image is requested
+        self.pending_frame = None
+        # The processed frame in form of an image and in form of bytes
+        self.processed_frame_as_image = None
+        self.processed_frame_as_bytes = None
+        # Wheather to update the image at next request
+        self.update_static_image = True
+        # Error message to show on the image
+        self.error_message_to_image = ""
+
+        # Whether to save the frames for training
+        self.save_training_images = False
+        # If the nozzle position is within this many pixels when comparing frames, it's considered a match. Only whole numbers are supported.
+        self.detection_tolerance = 0
+        # How to confirm the nozzle position: "sequential" (min_matches consecutive frames), "batch" (one batched burst) or "converge"
+        self.detection_mode = "sequential"
+        # Number of frames captured per burst in batch mode
+        self.batch_size = 5
+        # Confidence interval (px) the position must reach in converge mode
+        self.convergence_target = 0.25
+        # Frame difference below which the image counts as still after a move, None keeps the default
+        self.settle_threshold = None
+        # Full detections per second in the preview, the nozzle is tracked in between. 0 detects on every frame.
+        self.preview_inference_fps = 2.0
+        # Search a window around the last confident detection before the full frame
+        self.roi_detection = False
+        # Decode the measurement frames for the model at reduced resolution, the full frame only when needed
+        self.reduced_decode = False
+        # Bytes read from the camera per chunk
+        self.camera_chunk_size = READ_CHUNK_SIZE
+        # Read frames from one long-lived MJPEG stream connection instead of a request per frame
+        self.camera_stream = False
+        # MJPEG stream URL, None derives it from the camera url
+        self.camera_stream_url = None
+        # The Frame_Grabber of the stream while camera_stream is on
+        self.grabber = None
+
+    # Called from DetectionManager to keep the frame so it can be sent to the web browser
+    # result: the frame's detection result, its overlay is drawn when the image is requested
+    def put_frame(self, frame, result=None):
+        try:
+            if frame is None:
+                return
+            self.pending_frame = (frame, result)
+            self.update_static_image = True
+        except Exception as e:
+            log("Error: " + str(e) + "<br>" + str(traceback.format_exc()))
+
+    # Start, restart or stop the stream grabber to match the camera settings
+    def update_grabber(self):
+        url = None
+        if self.camera_stream and self.camera_url is not None:
+            url = self.camera_stream_url or stream_url_for(self.camera_url)
+        grabber = self.grabber
+        if grabber is not None and (url != grabber.stream_url or self.camera_chunk_size != grabber.chunk_size):
+            grabber.stop()
+            self.grabber = grabber = None
+        if url is not None and grabber is None:
+            self.grabber = Frame_Grabber(log, url, self.camera_chunk_size)
+
+    def show_error_message_to_image(self, message : str):
+        self.error_message_to_image = message
+        self.update_static_image = True
+
+    def status(self):
+        return {
+            "camera_url": self.camera_url,
+            "calibrated": self.transform_matrix is not None,
+            "preview_running": self.preview_running,
+            "detection_mode": self.detection_mode,
+            "requests": len(self.request_results),
+            "stream": self.grabber.status() if self.grabber is not None else None,
+        }
+
+
+# Registers a view under its path for the default context and under /context/<name>/ for a named one
+def context_route(rule, **options):
+    def decorator(view):
+        app.add_url_rule("/context/<context_name>" + rule, view_func=view, **options)
+        return app.route(rule, **options)(view)
+    return decorator
+
+
+# Resolves the context of the request before the view runs, creating it on first use
+@app.url_value_preprocessor
+def pop_context_name(endpoint, values):
+    name = (values.pop("context_name", None) if values else None) or DEFAULT_CONTEXT
+    with _contexts_lock:
+        context = _contexts.get(name)
+        if context is None:
+            if not _CONTEXT_NAME.match(name):
+                abort(400, "Context names may only contain letters, digits, '_' and '-'")
+            if len(_contexts) >= _MAX_CONTEXTS:
+                abort(400, "Too many contexts, at most %i are allowed" % _MAX_CONTEXTS)
+            context = _contexts[name] = Taxy_Server_Context(name)
+    g.context = context
+
+
+# Returns the context of the current request
+def get_context():
+    return g.context
+
 
 # Returns the transposed matrix calculated from the calibration points
-@app.route("/calculate_camera_to_space_matrix", methods=["POST"])
+@context_route("/calculate_camera_to_space_matrix", methods=["POST"])
 def calculate_camera_to_space_matrix():
-    show_error_message_to_image("")
+    context = get_context()
+    context.show_error_message_to_image("")
     try:
         log("*** calling calculate_camera_to_space_matrix ***")
         # Get the camera path from the JSON object
@@ -98,113 +208,198 @@ def calculate_camera_to_space_matrix():
                 x, y = pixel_coords[:, 0], pixel_coords[:, 1]
                 A = np.vstack([x**2, y**2, x * y, x, y, np.ones(n)]).T
                 transform = np.linalg.lstsq(A, real_coords, rcond=None)
-                global _transformMatrix
-                _transformMatrix = transform[0].T
+                context.transform_matrix = transform[0].T
                 return "OK", 200
     except Exception as e:
-        show_error_message_to_image("Error: Could not calculate image to space matrix.")
+        context.show_error_message_to_image("Error: Could not calculate image to space matrix.")
         log("Error: " + str(e) + "<br>" + str(traceback.format_exc()))
         return ""
 
-@app.route("/calculate_offset_from_matrix", methods=["POST"])
+@context_route("/calculate_offset_from_matrix", methods=["POST"])
 def calculate_offset_from_matrix():
-    show_error_message_to_image("")
+    context = get_context()
+    context.show_error_message_to_image("")
     try:
         log("*** calling calculate_offset ***")
         try:
             data = json.loads(request.data)
             _v = data.get("_v")
             log("_v: " + str(_v))
-            log("_transformMatrix: " + str(_transformMatrix))
-            # _transformMatrix = data.get("transformMatrix")
+            log("_transformMatrix: " + str(context.transform_matrix))
         except json.JSONDecodeError:
             log("JSON Decode Error")
             return "JSON Decode Error", 400
         
-        offsets = -1 * (0.55 * _transformMatrix @ _v)
+        offsets = -1 * (0.55 * context.transform_matrix @ _v)
         return jsonify(offsets.tolist())
     except Exception as e:
-        show_error_message_to_image("Error: Could not calculate offset from matrix.")
+        context.show_error_message_to_image("Error: Could not calculate offset from matrix.")
         log("Error: " + str(e) + "<br>" + str(traceback.format_exc()))
 
-@app.route("/set_server_cfg", methods=["POST"])
+@context_route("/set_server_cfg", methods=["POST"])
 def set_server_cfg():
-    show_error_message_to_image("")
+    context = get_context()
+    context.show_error_message_to_image("")
     try:
         log("*** calling set_server_cfg ***")
-        camera_url = None
         response = ""
 
-        # Stoping preview if running
-        global __preview_running, __detection_tolerance, __save_training_images
-        __preview_running = False
-        
-        # Get the camera path from the JSON object
+        # Get the settings from the JSON object
         try:
             data = json.loads(request.data)
-            camera_url = data.get("camera_url")
         except json.JSONDecodeError:
-            show_error_message_to_image("Error: Could not set camera URL.")
+            context.show_error_message_to_image("Error: Could not set camera URL.")
             return "JSON Decode Error", 400
-        
-        try:
-            data = json.loads(request.data)
-            save_training_images = data.get("save_training_images")
-        except:
-            pass
-
-        if save_training_images is not None:
-            if save_training_images == True:
-                __save_training_images = True
-                response += "save_training_images set to True\n"
-            else:
-                __save_training_images = False
-                response += "save_training_images set to False\n"
-
-        try:
-            data = json.loads(request.data)
-            __detection_tolerance = data.get("detection_tolerance")
-        except:
-            pass
-
+        if not isinstance(data, dict):
+            context.show_error_message_to_image("Error: Could not set camera URL.")
+            return "JSON object expected", 400
+
+        camera_url = data.get("camera_url")
+        save_training_images = data.get("save_training_images")
+        detection_tolerance = data.get("detection_tolerance")
+        detection_mode = data.get("detection_mode")
+        batch_size = data.get("batch_size")
+        convergence_target = data.get("convergence_target")
+        settle_threshold = data.get("settle_threshold")
+        preview_inference_fps = data.get("preview_inference_fps")
+        roi_detection = data.get("roi_detection")
+        reduced_decode = data.get("reduced_decode")
+        camera_chunk_size = data.get("camera_chunk_size")
+        camera_stream = data.get("camera_stream")
+        camera_stream_url = data.get("camera_stream_url")
+        blob_workers = data.get("blob_workers")
+        inference_workers = data.get("inference_workers")
+        training_store = data.get("training_store")
+        training_filter = data.get("training_filter")
+        runtime = data.get("runtime")
+        model = data.get("model")
+
+        # Every setting is validated before any is applied, so a rejected request changes nothing
         if camera_url is None:
-            show_error_message_to_image("Error: Could not set camera URL.")
+            context.show_error_message_to_image("Error: Could not set camera URL.")
             return "Camera path not found in JSON", 400
-        else:
-            if camera_url.casefold().startswith(
-                "http://"
-            ) or camera_url.casefold().startswith("https://"):
-                global _camera_url
-                _camera_url = camera_url
-                # Return code 200 to web browser
-                log(f"*** end of set_server_cfg (set to {_camera_url}) ***<br>")
-                show_error_message_to_image("Camera url set.")
-                return response + "Camera path set to " + _camera_url, 200
-            else:
-                show_error_message_to_image("Error: Invalid nozzle_cam_url.")
-                log("*** end of set_server_cfg (not set) ***<br>")
-                return "Camera path must start with http:// or https://", 400
-    except Exception as e:
-        show_error_message_to_image("Error: Could not set camera URL.")
-        log("Error: " + str(e) + "<br>" + str(traceback.format_exc()))
+        if not isinstance(camera_url, str) or not camera_url.casefold().startswith(("http://", "https://")):
+            context.show_error_message_to_image("Error: Invalid nozzle_cam_url.")
+            log("*** end of set_server_cfg (not set) ***<br>")
+            return "Camera path must start with http:// or https://", 400
+        if detection_mode is not None and detection_mode not in ("sequential", "batch", "converge"):
+            context.show_error_message_to_image("Error: Invalid detection mode.")
+            return "detection_mode must be sequential, batch or converge", 400
+        if batch_size is not None and (isinstance(batch_size, bool) or not isinstance(batch_size, int) or batch_size < 1):
+            return "batch_size must be a positive integer", 400
+        if convergence_target is not None and (isinstance(convergence_target, bool) or not isinstance(convergence_target, (int, float)) or convergence_target <= 0):
+            return "convergence_target must be a positive number", 400
+        if settle_threshold is not None and (isinstance(settle_threshold, bool) or not isinstance(settle_threshold, (int, float)) or settle_threshold <= 0):
+            return "settle_threshold must be a positive number", 400
+        if preview_inference_fps is not None and (isinstance(preview_inference_fps, bool) or not isinstance(preview_inference_fps, (int, float)) or preview_inference_fps < 0):
+            return "preview_inference_fps must be a non-negative number", 400
+        if camera_chunk_size is not None and (isinstance(camera_chunk_size, bool) or not isinstance(camera_chunk_size, int) or camera_chunk_size < 1024):
+            return "camera_chunk_size must be an integer of at least 1024", 400
+        if camera_stream_url is not None and (not isinstance(camera_stream_url, str) or camera_stream_url != "" and not camera_stream_url.casefold().startswith(("http://", "https://"))):
+            return "camera_stream_url must start with http:// or https://", 400
+        model = model or None
+        try:
+            Training_Image_Writer.validate(training_store, training_filter)
+            if blob_workers is not None or inference_workers is not None or runtime or model is not None:
+                get_detection_service().validate_settings(blob_workers, inference_workers, runtime, model)
+        except ValueError as e:
+            if runtime:
+                context.show_error_message_to_image("Error: Invalid inference runtime settings.")
+            elif model is not None:
+                context.show_error_message_to_image("Error: Could not set model.")
+            return str(e), 400
+
+        # Server-wide settings first: loading the model is the only step that can still fail
+        if runtime:
+            try:
+                get_detection_service().configure_runtime(runtime)
+                response += "runtime set to " + json.dumps(get_detection_service().runtime.to_dict()) + "\n"
+            except ValueError as e:
+                context.show_error_message_to_image("Error: Invalid inference runtime settings.")
+                return str(e), 400
+            except Exception as e:
+                context.show_error_message_to_image("Error: Could not load model.")
+                log("Error: " + str(e) + "<br>" + str(traceback.format_exc()))
+                return "Could not load model with the runtime settings: " + str(e), 500
+        if model is not None:
+            try:
+                get_detection_service().select_model(model)
+                response += "model set to " + model + "\n"
+            except ValueError as e:
+                context.show_error_message_to_image("Error: Could not set model.")
+                return str(e), 400
+            except Exception as e:
+                context.show_error_message_to_image("Error: Could not load model.")
+                log("Error: " + str(e) + "<br>" + str(traceback.format_exc()))
+                return response + "Could not load model: " + str(e), 500
+        if blob_workers is not None:
+            get_detection_service().configure_blob_workers(blob_workers)
+            response += "blob_workers set to " + str(blob_workers) + "\n"
+        if inference_workers is not None:
+            get_detection_service().inference_pool.configure(inference_workers)
+            response += "inference_workers set to " + str(inference_workers) + "\n"
+        if training_store is not None or training_filter is not None:
+            writer = get_training_writer(log)
+            writer.configure(training_store, training_filter)
+            response += "training_store set to " + writer.store + ", training_filter set to " + writer.filter + "\n"
 
+        # Stoping preview if running
+        context.preview_running = False
 
-# Called from DetectionManager to put the frame in the global variable so it can be sent to the web browser
-def put_frame(frame):
-    try:
-        global __processed_frame_as_image, __update_static_image
-        # Convert the frame to a PIL Image
-        __processed_frame_as_image = Image.fromarray(frame)
-        __update_static_image = True
-        
+        if save_training_images is not None:
+            context.save_training_images = save_training_images == True
+            response += "save_training_images set to " + str(context.save_training_images) + "\n"
+        if detection_tolerance is not None:
+            context.detection_tolerance = detection_tolerance
+        if detection_mode is not None:
+            context.detection_mode = detection_mode
+            response += "detection_mode set to " + detection_mode + "\n"
+        if batch_size is not None:
+            context.batch_size = batch_size
+            response += "batch_size set to " + str(batch_size) + "\n"
+        if convergence_target is not None:
+            context.convergence_target = float(convergence_target)
+            response += "convergence_target set to " + str(convergence_target) + "\n"
+        if settle_threshold is not None:
+            context.settle_threshold = float(settle_threshold)
+            response += "settle_threshold set to " + str(settle_threshold) + "\n"
+        if preview_inference_fps is not None:
+            context.preview_inference_fps = float(preview_inference_fps)
+            response += "preview_inference_fps set to " + str(preview_inference_fps) + "\n"
+        if roi_detection is not None:
+            context.roi_detection = roi_detection == True
+            response += "roi_detection set to " + str(context.roi_detection) + "\n"
+        if reduced_decode is not None:
+            context.reduced_decode = reduced_decode == True
+            response += "reduced_decode set to " + str(context.reduced_decode) + "\n"
+        if camera_chunk_size is not None:
+            context.camera_chunk_size = camera_chunk_size
+            response += "camera_chunk_size set to " + str(camera_chunk_size) + "\n"
+        if camera_stream is not None:
+            context.camera_stream = camera_stream == True
+            response += "camera_stream set to " + str(context.camera_stream) + "\n"
+        if camera_stream_url is not None:
+            context.camera_stream_url = camera_stream_url or None
+            response += "camera_stream_url set to " + str(context.camera_stream_url) + "\n"
+
+        context.camera_url = camera_url
+        context.update_grabber()
+        if context.grabber is not None:
+            response += "Camera stream " + context.grabber.stream_url + "\n"
+        # Return code 200 to web browser
+        log(f"*** end of set_server_cfg ({context.name} set to {context.camera_url}) ***<br>")
+        context.show_error_message_to_image("Camera url set.")
+        return response + "Camera path set to " + context.camera_url, 200
     except Exception as e:
+        context.show_error_message_to_image("Error: Could not set camera URL.")
         log("Error: " + str(e) + "<br>" + str(traceback.format_exc()))
+        return "Could not set the server configuration: " + str(e), 500
 
 
-@app.route("/getAllReqests")
+@context_route("/getAllReqests")
 def getAllReqests():
     try:
-        return jsonify(request_results)
+        return jsonify(get_context().request_results)
     except Exception as e:
         log("Error: " + str(e) + "<br>" + str(traceback.format_exc()))
 
@@ -235,7 +430,7 @@ def index():
         return content + "Log file not found"
 
 
-@app.route("/getReqest", methods=["GET", "POST"])
+@context_route("/getReqest", methods=["GET", "POST"])
 def getReqest():
     try:
         # Get the request id from the URL
@@ -243,7 +438,7 @@ def getReqest():
 
         # Return the request result if it exists, otherwise return a 404
         try:
-            return jsonify(request_results[request_id])
+            return jsonify(get_context().request_results[request_id])
         except KeyError:
             return jsonify(
                 Ktay8_Request_Result(
@@ -254,12 +449,12 @@ def getReqest():
         log("Error: " + str(e) + "<br>" + str(traceback.format_exc()))
 
 
-@app.route("/getNozzlePosition")
+@context_route("/getNozzlePosition")
 def getNozzlePosition():
-    show_error_message_to_image("")
+    context = get_context()
+    context.show_error_message_to_image("")
     # Stoping preview if running
-    global __preview_running
-    __preview_running = False
+    context.preview_running = False
 
     try:
         log("*** calling getNozzlePosition ***")
@@ -267,8 +462,11 @@ def getNozzlePosition():
 
         # Get a random request id
         request_id = random.randint(0, 1000000)
+        # Active tool sent by the extension, used to order the blob detection stages
+        tool = request.args.get("tool", default=None)
 
-        if _camera_url is None:
+        request_results = context.request_results
+        if context.camera_url is None:
             request_results[request_id] = Ktay8_Request_Result(
                 request_id, None, time.time() - start_time, 502, "Camera URL not set"
             )
@@ -284,12 +482,26 @@ def getNozzlePosition():
         def do_work():
             log("*** calling do_work ***")
             detection_manager = dm(
-                log, _camera_url, __save_training_images
-            )
-
-            position = detection_manager.recursively_find_nozzle_position(
-                put_frame, __CV_MIN_MATCHES, __CV_TIMEOUT, __detection_tolerance
+                log, context.camera_url, context.save_training_images, get_detection_service(), tool, context=context.name,
+                chunk_size=context.camera_chunk_size, grabber=context.grabber
             )
+            if context.settle_threshold is not None:
+                detection_manager.settle_threshold = context.settle_threshold
+            detection_manager.roi_detection = context.roi_detection
+            detection_manager.reduced_decode = context.reduced_decode
+
+            if context.detection_mode == "batch":
+                position = detection_manager.find_nozzle_position_batch(
+                    context.put_frame, __CV_MIN_MATCHES, __CV_TIMEOUT, context.detection_tolerance, context.batch_size
+                )
+            elif context.detection_mode == "converge":
+                position = detection_manager.find_nozzle_position_converge(
+                    context.put_frame, __CV_MIN_MATCHES, __CV_TIMEOUT, context.detection_tolerance, context.convergence_target
+                )
+            else:
+                position = detection_manager.recursively_find_nozzle_position(
+                    context.put_frame, __CV_MIN_MATCHES, __CV_TIMEOUT, context.detection_tolerance
+                )
 
             log("position: " + str(position))
 
@@ -297,17 +509,17 @@ def getNozzlePosition():
                 request_result_object = Ktay8_Request_Result(
                     request_id, None, time.time() - start_time, 404, "No nozzle found"
                 )
-                show_error_message_to_image("Error: No nozzle found.")
+                context.show_error_message_to_image("Error: No nozzle found.")
             else:
                 request_result_object = Ktay8_Request_Result(
                     request_id,
                     json.dumps(position),
                     time.time() - start_time,
                     200,
-                    "OK"
+                    "OK",
+                    detection_manager.last_stats
                 )
 
-            global request_results
             request_results[request_id] = request_result_object
 
             log("*** end of do_work ***")
@@ -318,92 +530,169 @@ def getNozzlePosition():
         log("*** end of getNozzlePosition ***<br>")
         return jsonify(request_results[request_id])
     except Exception as e:
-        show_error_message_to_image("Error: Could not get nozzle position.")
+        context.show_error_message_to_image("Error: Could not get nozzle position.")
         log("Error: " + str(e) + "<br>" + str(traceback.format_exc()))
 
-@app.route("/preview", methods=["POST"])
+@context_route("/preview", methods=["POST"])
 def preview():
-    show_error_message_to_image("")
+    context = get_context()
+    context.show_error_message_to_image("")
     try:
         log("*** calling preview ***")
         start_time = time.time()  # Get the current time
-        global __preview_running
 
         try:
             data = json.loads(request.data)
             action = data.get("action")
         except json.JSONDecodeError:
-            show_error_message_to_image("Error: Could not get action.")
+            context.show_error_message_to_image("Error: Could not get action.")
             return "JSON Decode Error", 400
 
         def do_preview():
             log("*** calling do_preview ***")
             # Do not save images during preview
             detection_manager = dm(
-                log, _camera_url, send_to_cloud = False
+                log, context.camera_url, save_training = False, detection_service = get_detection_service(), context = context.name,
+                chunk_size = context.camera_chunk_size, grabber = context.grabber
             )
 
-            while __preview_running:
-                dm.get_preview_frame(detection_manager, put_frame)
+            while context.preview_running:
+                frame_start = time.time()
+                # Full detection at preview_inference_fps, tracking on the frames in between
+                inference_interval = 1 / context.preview_inference_fps if context.preview_inference_fps > 0 else 0
+                dm.get_preview_frame(detection_manager, context.put_frame, inference_interval)
 
-                # Wait for 1s/FPS for a maximum FPS.
+                # Wait for the rest of 1s/FPS for a maximum FPS.
                 # This is to avoid overloading the server
-                time.sleep(1 / __PREVIEW_FPS)
+                time.sleep(max(0, 1 / __PREVIEW_FPS - (time.time() - frame_start)))
 
             log("*** end of do_preview ***")
 
         # Handle the action
         if action == "stop":
-            __preview_running = False
+            context.preview_running = False
             return "Stopped preview.", 200
         elif action == "start":
-            if _camera_url is None:
+            if context.camera_url is None:
                 log("*** end of preview - Camera URL not set ***<br>")
                 return "Camera URL not set", 502
             else:
-                __preview_running = True
+                context.preview_running = True
                 thread = threading.Thread(target=do_preview)
                 thread.start()
                 return "Started preview.", 200
         else:
             return "Invalid action.", 400
     except Exception as e:
-        show_error_message_to_image("Error: Could not do preview.")
+        context.show_error_message_to_image("Error: Could not do preview.")
+        log("Error: " + str(e) + "<br>" + str(traceback.format_exc()))
+
+@context_route("/detector_status")
+def detector_status():
+    try:
+        status = get_detection_service().status()
+        status["training_writer"] = get_training_writer(log).status()
+        return jsonify(status)
+    except Exception as e:
+        log("Error: " + str(e) + "<br>" + str(traceback.format_exc()))
+
+
+@context_route("/models")
+def models():
+    try:
+        service = get_detection_service()
+        return jsonify({"selected": service.model_name, "models": service.registry.list_models()})
+    except Exception as e:
+        log("Error: " + str(e) + "<br>" + str(traceback.format_exc()))
+
+
+# Hot-swaps the AI model without restarting the server. Running detections finish on the old model.
+@context_route("/select_model", methods=["POST"])
+def select_model():
+    context = get_context()
+    context.show_error_message_to_image("")
+    try:
+        log("*** calling select_model ***")
+        try:
+            data = json.loads(request.data)
+            model = data.get("model")
+        except json.JSONDecodeError:
+            return "JSON Decode Error", 400
+
+        try:
+            metadata = get_detection_service().select_model(model)
+        except ValueError as e:
+            context.show_error_message_to_image("Error: Could not set model.")
+            return str(e), 400
+
+        log("*** end of select_model (set to %s) ***<br>" % model)
+        return jsonify(metadata)
+    except Exception as e:
+        context.show_error_message_to_image("Error: Could not load model.")
+        log("Error: " + str(e) + "<br>" + str(traceback.format_exc()))
+        return "Could not load model: " + str(e), 500
+
+
+# Lists the contexts (cameras/printers) served by this server
+@app.route("/contexts")
+def contexts():
+    try:
+        with _contexts_lock:
+            return jsonify({name: context.status() for name, context in _contexts.items()})
+    except Exception as e:
         log("Error: " + str(e) + "<br>" + str(traceback.format_exc()))
 
+
+# Returns the shared detection service, creating it and starting the model load on first use
+def get_detection_service():
+    global _detection_service
+    if _detection_service is None:
+        _detection_service = ds(log)
+        _detection_service.start()
+    return _detection_service
+
 ###
 # Returns the image to the web browser to act as a webcam
 ###
-@app.route("/image")
+@context_route("/image")
 def image():
     try:
-        global __processed_frame_as_bytes, __update_static_image, __standby_image, __processed_frame_as_image
+        context = get_context()
+
+        # Draw the overlay of the latest detection, only now that someone is looking
+        pending = context.pending_frame
+        if pending is not None:
+            context.pending_frame = None
+            # Convert the frame to a PIL Image, a frame that cannot be decoded keeps the previous image
+            frame = draw_detection(*pending)
+            if frame is not None:
+                context.processed_frame_as_image = Image.fromarray(frame)
 
         # If no image has been recieved since start, load a standby image
-        if __processed_frame_as_image is None:
-            __processed_frame_as_image = Image.open("standby.jpg", mode="r")
+        if context.processed_frame_as_image is None:
+            context.processed_frame_as_image = Image.open("standby.jpg", mode="r")
 
             # read the file content as bytes
-            __processed_frame_as_image.load()
+            context.processed_frame_as_image.load()
             
             # Update text on the image
-            __update_static_image = True
+            context.update_static_image = True
 
-        if __update_static_image:
-            __update_static_image = False
+        if context.update_static_image:
+            context.update_static_image = False
 
             # Draw the text on the image
-            __processed_frame_as_image = drawOnFrame(__processed_frame_as_image)
+            context.processed_frame_as_image = drawOnFrame(context, context.processed_frame_as_image)
 
             # Save the image to a byte array of JPEG format
             img_io = io.BytesIO()
-            __processed_frame_as_image.save(img_io, "JPEG")
+            context.processed_frame_as_image.save(img_io, "JPEG")
             img_io.seek(0)
-            __processed_frame_as_bytes = img_io.read()
+            context.processed_frame_as_bytes = img_io.read()
             
 
         # Get a byte stream of the image
-        processed_frame_file = io.BytesIO(__processed_frame_as_bytes)
+        processed_frame_file = io.BytesIO(context.processed_frame_as_bytes)
         processed_frame_file.seek(0)
 
         # Send the image to the web browser
@@ -412,7 +701,7 @@ def image():
         log("Error: " + str(e) + "<br>" + str(traceback.format_exc()))
 
 
-def drawOnFrame(usedFrame):
+def drawOnFrame(context, usedFrame):
     # Get a string with the current date and time
     current_datetime = datetime.datetime.now()
     current_datetime_str = current_datetime.strftime("%Y-%m-%d %H:%M:%S.%f")
@@ -422,17 +711,17 @@ def drawOnFrame(usedFrame):
         usedFrame, "Updated: " + current_datetime_str, row=1
     )
     
-    if _camera_url is None:
+    if context.camera_url is None:
         usedFrame = drawTextOnFrame(usedFrame, "TAXY Server Configuration not recieved.", row=2)
-    elif __processed_frame_as_image is None:
+    elif context.processed_frame_as_image is None:
         usedFrame = drawTextOnFrame(usedFrame, "No image recieved since start.", row=2)
-    elif _transformMatrix is None:
+    elif context.transform_matrix is None:
         usedFrame = drawTextOnFrame(usedFrame, "Camera not calibrated.", row=2)
 
-    if __error_message_to_image != "":
-        usedFrame = drawTextOnFrame(usedFrame, __error_message_to_image, row=3)
+    if context.error_message_to_image != "":
+        usedFrame = drawTextOnFrame(usedFrame, context.error_message_to_image, row=3)
         
-    if __preview_running:
+    if context.preview_running:
         usedFrame = drawTextOnFrame(usedFrame, "Preview running.", row=-1, row_width=270)
                 
     return usedFrame
@@ -480,11 +769,6 @@ def log_get():
     global __logdebug
     return __logdebug
 
-def show_error_message_to_image(message : str):
-    global __error_message_to_image, __update_static_image
-    __error_message_to_image = message
-    __update_static_image = True
-
 # Run the app on the specified port
 if __name__ == "__main__":
     logger = logging.getLogger(__name__)
@@ -496,6 +780,9 @@ if __name__ == "__main__":
     # Parse the command-line arguments
     args = parser.parse_args()
 
+    # Load and warm up the detection model once, before the first request arrives
+    get_detection_service()
+
     # Run the app with the specified port
     # app.run(host="0.0.0.0", port=args.port, debug=True)
     # app.run(host='0.0.0.0', port=args.port, debug=False)
@@ -0,0 +1,238 @@
+import os, io, json, time, tarfile, threading, cv2, numpy as np
+
+# Index of the stored frames, one JSON record per line, appended as frames are stored
+_INDEX_FILE = "index.jsonl"
+# Append-only tar archives holding the frames (.jpg) and their metadata (.json)
+_SHARD_NAME = "shard-%05i.tar"
+# A new shard is started once the current one reaches this size. Finished shards never change,
+# so syncing the folder only copies the last shard and the index.
+_SHARD_SIZE = 64 * 1024 * 1024
+
+# Frames of the same tool whose perceptual hashes differ in at most this many of the 64 bits are
+# near-duplicates, only the first one is stored
+DEDUP_DISTANCE = 6
+# "uncertain" filter: keep AI detections below this confidence and every blob fallback detection
+LOW_CONFIDENCE = 0.7
+# all: every frame that is not a near-duplicate, uncertain: only the frames worth retraining on
+FILTERS = ("all", "uncertain")
+
+# YOLO class id of the nozzle
+_NOZZLE_CLASS = 0
+# Label box side in pixels for detections without a box or radius
+_DEFAULT_BOX_SIZE = 40
+
+
+# 64-bit DCT perceptual hash as 16 hex digits: the low frequencies of a 32x32 grayscale
+# thumbnail against their median, so noise and small exposure changes keep the same hash
+def perceptual_hash(frame):
+    gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    thumbnail = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(thumbnail)[:8, :8].flatten()
+    # The DC term is the mean brightness, leave it out of the median
+    return np.packbits(low > np.median(low[1:])).tobytes().hex()
+
+
+def _hash_bits(phash):
+    return np.frombuffer(bytes.fromhex(phash), dtype=np.uint8)
+
+
+# YOLO label line (class cx cy w h, normalized) of a stored detection, None without a position
+def yolo_label(record):
+    position = record.get("detected_position") or {}
+    width, height = record.get("frame_size") or (None, None)
+    if position.get("x") is None or position.get("y") is None or not width or not height:
+        return None
+    box = record.get("box")
+    if box is not None:
+        x1, y1, x2, y2 = box
+        cx, cy, w, h = (x1 + x2) / 2, (y1 + y2) / 2, x2 - x1, y2 - y1
+    else:
+        side = 2 * record["radius"] if record.get("radius") else _DEFAULT_BOX_SIZE
+        cx, cy, w, h = position["x"], position["y"], side, side
+    return "%i %.6f %.6f %.6f %.6f" % (_NOZZLE_CLASS, cx / width, cy / height, w / width, h / height)
+
+
+class Taxy_Server_Dataset_Store:
+    """
+    Stores the collected detection frames in sharded append-only tar archives with a JSON-lines
+    index, instead of one .jpg and one .json file per frame. Near-duplicates of an already stored
+    frame of the same tool are rejected, and the "uncertain" filter keeps only the frames a
+    retraining learns from (low-confidence AI detections and blob fallbacks).
+    """
+    def __init__(self, directory, filter="all", dedup_distance=DEDUP_DISTANCE, low_confidence=LOW_CONFIDENCE, shard_size=_SHARD_SIZE):
+        if filter not in FILTERS:
+            raise ValueError("training_filter must be one of: " + ", ".join(FILTERS))
+        self.directory = directory
+        self.filter = filter
+        self.dedup_distance = dedup_distance
+        self.low_confidence = low_confidence
+        self.shard_size = shard_size
+        self.__lock = threading.Lock()
+        # tool -> (N, 8) array of the stored perceptual hashes
+        self.__hashes = dict()
+        self.__shard_number = 0
+        self.__shard = None
+        self.stored = 0
+        self.duplicates = 0
+        self.filtered = 0
+        self.__load_index()
+
+    def __load_index(self):
+        hashes = dict()
+        for record in self.records():
+            hashes.setdefault(str(record.get("tool")), []).append(_hash_bits(record["phash"]))
+            self.__shard_number = max(self.__shard_number, int(record["shard"][6:11]))
+            self.stored += 1
+        self.__hashes = {tool: np.array(bits, dtype=np.uint8) for tool, bits in hashes.items()}
+
+    # The stored records, in the order they were stored
+    def records(self):
+        path = os.path.join(self.directory, _INDEX_FILE)
+        if not os.path.isfile(path):
+            return []
+        records = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # A line cut short by a power loss
+                    continue
+        return records
+
+    # JPEG bytes of a stored frame
+    def read_image(self, record):
+        with open(os.path.join(self.directory, record["shard"]), "rb") as f:
+            f.seek(record["offset"])
+            return f.read(record["size"])
+
+    # Whether the filter keeps a detection
+    def keep(self, metadata):
+        if self.filter == "all":
+            return True
+        if metadata.get("algorithm") != "AI_YOLO":
+            return True
+        confidence = (metadata.get("detected_position") or {}).get("confidence")
+        return confidence is None or confidence < self.low_confidence
+
+    # Store a frame with its metadata. Returns the index record, or None when the frame was
+    # filtered out or is a near-duplicate.
+    def add(self, frame, metadata):
+        if not self.keep(metadata):
+            self.filtered += 1
+            return None
+        phash = perceptual_hash(frame)
+        tool = str(metadata.get("tool"))
+        bits = _hash_bits(phash)
+        with self.__lock:
+            stored = self.__hashes.get(tool)
+            if stored is not None and len(stored):
+                distances = np.unpackbits(np.bitwise_xor(stored, bits), axis=1).sum(axis=1)
+                if distances.min() <= self.dedup_distance:
+                    self.duplicates += 1
+                    return None
+
+            ok, encoded = cv2.imencode(".jpg", frame)
+            if not ok:
+                raise ValueError("could not encode the frame")
+            record = dict(metadata, phash=phash, frame_size=[int(frame.shape[1]), int(frame.shape[0])])
+            self.__append(record, encoded.tobytes())
+            self.__hashes[tool] = np.vstack([stored, bits]) if stored is not None else bits[None, :]
+            self.stored += 1
+            return record
+
+    def __append(self, record, jpeg):
+        os.makedirs(self.directory, exist_ok=True)
+        shard = self.__open_shard()
+        name = os.path.splitext(record["image_file"])[0]
+        record.update(shard=_SHARD_NAME % self.__shard_number, size=len(jpeg))
+
+        info = tarfile.TarInfo(name + ".jpg")
+        info.size, info.mtime = len(jpeg), time.time()
+        # The image data starts right after its header
+        record["offset"] = shard.offset + len(info.tobuf(shard.format, shard.encoding, shard.errors))
+        shard.addfile(info, io.BytesIO(jpeg))
+        data = json.dumps(record, indent=2).encode("utf-8")
+        info = tarfile.TarInfo(name + ".json")
+        info.size, info.mtime = len(data), time.time()
+        shard.addfile(info, io.BytesIO(data))
+        shard.fileobj.flush()
+        os.fsync(shard.fileobj.fileno())
+
+        # The index line is written last, so it only ever points at complete data
+        with open(os.path.join(self.directory, _INDEX_FILE), "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def __open_shard(self):
+        if self.__shard is not None and self.__shard.offset >= self.shard_size:
+            self.__shard.close()
+            self.__shard = None
+            self.__shard_number += 1
+        while self.__shard is None:
+            path = os.path.join(self.directory, _SHARD_NAME % self.__shard_number)
+            if os.path.isfile(path) and (os.path.getsize(path) >= self.shard_size or not self.__repair_shard(path)):
+                self.__shard_number += 1
+                continue
+            self.__shard = tarfile.open(path, "a", format=tarfile.USTAR_FORMAT)
+        return self.__shard
+
+    # A shard left open by a crash has no end-of-archive blocks, and may end in a partly written
+    # member. Cuts it back to the end of its last indexed frame and closes the archive again.
+    # False when that frame cannot be found, the shard is then left as it is.
+    def __repair_shard(self, path):
+        name = os.path.basename(path)
+        stored = [r for r in self.records() if r["shard"] == name]
+        end = 0
+        if stored:
+            metadata_name = os.path.splitext(stored[-1]["image_file"])[0] + ".json"
+            end = None
+            try:
+                with tarfile.open(path, "r:") as shard:
+                    for member in shard:
+                        if member.name == metadata_name:
+                            end = member.offset_data + -(-member.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            except tarfile.ReadError:
+                pass
+            if end is None or end > os.path.getsize(path):
+                return False
+        with open(path, "r+b") as f:
+            f.truncate(end)
+            f.seek(end)
+            f.write(tarfile.NUL * tarfile.BLOCKSIZE * 2)
+        return True
+
+    def close(self):
+        with self.__lock:
+            if self.__shard is not None:
+                self.__shard.close()
+                self.__shard = None
+
+    # Write the stored frames as a YOLO dataset: images/<name>.jpg and labels/<name>.txt.
+    # Returns the number of frames exported.
+    def export_yolo(self, output_dir):
+        os.makedirs(os.path.join(output_dir, "images"), exist_ok=True)
+        os.makedirs(os.path.join(output_dir, "labels"), exist_ok=True)
+        exported = 0
+        for record in self.records():
+            label = yolo_label(record)
+            if label is None:
+                continue
+            name = os.path.splitext(record["image_file"])[0]
+            with open(os.path.join(output_dir, "images", name + ".jpg"), "wb") as f:
+                f.write(self.read_image(record))
+            with open(os.path.join(output_dir, "labels", name + ".txt"), "w") as f:
+                f.write(label + "\n")
+            exported += 1
+        return exported
+
+    def status(self):
+        return {
+            "directory": os.path.abspath(self.directory),
+            "filter": self.filter,
+            "stored": self.stored,
+            "duplicates": self.duplicates,
+            "filtered": self.filtered,
+            "shard": _SHARD_NAME % self.__shard_number,
+        }
@@ -1,10 +1,8 @@
-import copy, time, cv2, numpy as np, os, requests, threading
-from taxy_server_io import Taxy_Server_Io as io
-try:
-    from nozzle_detector import NozzleDetector
-    YOLO_AVAILABLE = True
-except ImportError:
-    YOLO_AVAILABLE = False
+import time, collections, cv2, numpy as np, os, requests, threading
+from concurrent.futures import Future
+from dataclasses import dataclass, replace
+from taxy_server_io import Taxy_Server_Io as io, Frame_Motion_Monitor, Camera_Frame, frame_image, SETTLE_THRESHOLD, READ_CHUNK_SIZE
+from taxy_server_ds import Taxy_Server_Detection_Service as ds
 
 # --- CONFIGURAZIONE DATA COLLECTION (TELEGRAM) ---
 # Configurazione opzionale per la raccolta dati.
@@ -13,6 +11,223 @@ TELEGRAM_BOT_TOKEN = ""
 TELEGRAM_CHAT_ID = ""   
 # -------------------------------------------------
 
+# Pause before asking the camera again after it delivered no frame
+_FRAME_RETRY_INTERVAL = 0.1
+
+# ROI detection: side of the window for the blob cascade when no model is loaded (the model uses its own
+# input size), and the AI confidence a detection needs to center the next window on it
+_BLOB_ROI_SIZE = 320
+_ROI_MIN_SCORE = 0.6
+
+# Preview tracker: margin around the nozzle kept in the template, how far the nozzle may move between
+# preview frames, and the match score below which the track is lost
+_TRACK_TEMPLATE_MARGIN = 8
+_TRACK_SEARCH_MARGIN = 32
+_TRACK_MIN_SCORE = 0.6
+
+# Convergence mode: number of recent detections kept, outlier cut in robust standard deviations
+# and the z value of the reported confidence interval (95%)
+_CONVERGENCE_WINDOW = 30
+_CONVERGENCE_OUTLIER_SIGMAS = 3.0
+_CONVERGENCE_Z = 1.96
+
+@dataclass
+class Nozzle_Detection_Result:
+    """
+    Outcome of one nozzle detection, without any image data. Overlays are drawn from it with
+    draw_detection only when someone looks at the frame.
+    """
+    center: tuple = None      # (x, y) in pixels, None if no nozzle was found
+    algorithm: object = None  # "AI_YOLO" or the number of the blob stage
+    box: tuple = None         # AI bounding box (x1, y1, x2, y2)
+    score: float = None       # AI confidence
+    radius: int = None        # blob radius in pixels
+    color: tuple = None       # overlay color of the blob stage
+    tracked: bool = False     # moved by the preview tracker instead of a full detection
+
+    @property
+    def found(self):
+        return self.center is not None
+
+# Static crosshair layers (layer, mask), rendered once per frame size
+_CROSSHAIR_LAYERS = dict()
+
+def _crosshair_layer(height, width):
+    layer = _CROSSHAIR_LAYERS.get((height, width))
+    if layer is None:
+        cx, cy = width // 2, height // 2
+        image = np.zeros((height, width, 3), dtype=np.uint8)
+        mask = np.zeros((height, width), dtype=np.uint8)
+        for target, black, white in ((image, (0,0,0), (255,255,255)), (mask, 255, 255)):
+            cv2.line(target, (cx,0), (cx,height), black, 2)
+            cv2.line(target, (0,cy), (width,cy), black, 2)
+            cv2.line(target, (cx,0), (cx,height), white, 1)
+            cv2.line(target, (0,cy), (width,cy), white, 1)
+        layer = (image, mask)
+        _CROSSHAIR_LAYERS[(height, width)] = layer
+    return layer
+
+# Returns a copy of image with the detection overlay and the crosshair drawn on it.
+# result None returns the image unchanged. image may be a Camera_Frame, None if it cannot be decoded.
+def draw_detection(image, result):
+    image = frame_image(image)
+    if image is None or result is None:
+        return image
+    frame = image.copy()
+    height, width = frame.shape[:2]
+    if result.box is not None:
+        x1, y1, x2, y2 = map(int, result.box)
+        cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
+        cv2.circle(frame, (int(result.center[0]), int(result.center[1])), 5, (0, 0, 255), -1)
+        cv2.putText(frame, f"Nozzle: {result.score:.2f}", (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+    elif result.center is not None:
+        x, y = result.center
+        cv2.circle(img=frame, center=(x,y), radius=result.radius, color=result.color, thickness=-1, lineType=cv2.LINE_AA)
+        cv2.circle(img=frame, center=(x,y), radius=result.radius, color=(0,0,0), thickness=1, lineType=cv2.LINE_AA)
+        cv2.line(frame, (x-5,y), (x+5, y), (255,255,255), 2)
+        cv2.line(frame, (x,y-5), (x, y+5), (255,255,255), 2)
+    else:
+        # no nozzle, draw a 3 outline circle in the middle of the frame
+        keypointRadius = 17
+        cv2.circle(img=frame, center=(width // 2, height // 2), radius=keypointRadius, color=(0,0,0), thickness=3, lineType=cv2.LINE_AA)
+        cv2.circle(img=frame, center=(width // 2, height // 2), radius=keypointRadius+1, color=(0,0,255), thickness=1, lineType=cv2.LINE_AA)
+    layer, mask = _crosshair_layer(height, width)
+    cv2.copyTo(layer, mask, frame)
+    return frame
+
+# AI results with their boxes scaled by (x scale, y scale)
+def _scale_results(results, scale):
+    if not results or scale == (1.0, 1.0):
+        return results
+    sx, sy = scale
+    return [dict(res, box=(res['box'][0] * sx, res['box'][1] * sy, res['box'][2] * sx, res['box'][3] * sy)) for res in results]
+
+class Nozzle_Tracker:
+    """
+    Follows a detected nozzle between full detections by matching a grayscale template of it in a
+    small window around its last position. Used by the preview to move the overlay without running
+    the model on every frame.
+    """
+    def __init__(self, frame, result):
+        self.result = result
+        x, y = result.center
+        if result.box is not None:
+            x1, y1, x2, y2 = result.box
+            half_w, half_h = (x2 - x1) / 2, (y2 - y1) / 2
+        else:
+            half_w = half_h = result.radius
+        self.half_w = int(round(half_w)) + _TRACK_TEMPLATE_MARGIN
+        self.half_h = int(round(half_h)) + _TRACK_TEMPLATE_MARGIN
+        self.template = self.__gray(frame, x, y, self.half_w, self.half_h)[0]
+        self.score = 1.0
+
+    @staticmethod
+    def __gray(frame, x, y, half_w, half_h):
+        # Grayscale crop around (x, y), clipped to the frame, with the offset of its top-left corner
+        height, width = frame.shape[:2]
+        left, top = max(int(round(x)) - half_w, 0), max(int(round(y)) - half_h, 0)
+        right, bottom = min(int(round(x)) + half_w + 1, width), min(int(round(y)) + half_h + 1, height)
+        return cv2.cvtColor(frame[top:bottom, left:right], cv2.COLOR_BGR2GRAY), left, top
+
+    # Returns the result moved to the nozzle's position in frame, None when the track is lost
+    def update(self, frame):
+        x, y = self.result.center
+        window, left, top = self.__gray(frame, x, y, self.half_w + _TRACK_SEARCH_MARGIN, self.half_h + _TRACK_SEARCH_MARGIN)
+        if window.shape[0] < self.template.shape[0] or window.shape[1] < self.template.shape[1]:
+            return None
+        response = cv2.matchTemplate(window, self.template, cv2.TM_CCOEFF_NORMED)
+        _, self.score, _, (mx, my) = cv2.minMaxLoc(response)
+        if self.score < _TRACK_MIN_SCORE:
+            return None
+
+        # Sub-pixel peak from a parabola through the neighbours of the best match
+        def refine(r_minus, r_center, r_plus):
+            denominator = r_minus - 2 * r_center + r_plus
+            return 0.5 * (r_minus - r_plus) / denominator if denominator < 0 else 0.0
+        dx = refine(response[my, mx-1], response[my, mx], response[my, mx+1]) if 0 < mx < response.shape[1] - 1 else 0.0
+        dy = refine(response[my-1, mx], response[my, mx], response[my+1, mx]) if 0 < my < response.shape[0] - 1 else 0.0
+
+        # The template is centered on the nozzle, so its center follows the match position
+        new_x = left + mx + dx + self.template.shape[1] // 2
+        new_y = top + my + dy + self.template.shape[0] // 2
+        shift_x, shift_y = new_x - x, new_y - y
+        box = None
+        if self.result.box is not None:
+            x1, y1, x2, y2 = self.result.box
+            box = (x1 + shift_x, y1 + shift_y, x2 + shift_x, y2 + shift_y)
+        center = (new_x, new_y) if self.result.box is not None else (int(round(new_x)), int(round(new_y)))
+        self.result = replace(self.result, center=center, box=box, tracked=True)
+        return self.result
+
+class Position_Convergence:
+    """
+    Running robust estimate of the nozzle position over the recent detections. Outliers are rejected
+    by their distance to the median in MADs, the position is the confidence-weighted mean of the
+    inliers, and it has converged once the confidence interval of that mean is below target_px on
+    both axes with at least min_samples inliers.
+    """
+    def __init__(self, target_px, min_samples=3, xy_tolerance=0, window=_CONVERGENCE_WINDOW):
+        self.target_px = target_px
+        self.min_samples = min_samples
+        # Deviations up to the detection tolerance (at least one pixel) are never outliers,
+        # so whole-pixel blob centers are not rejected when the MAD is zero
+        self.min_outlier_distance = max(float(xy_tolerance), 1.0)
+        self.__samples = collections.deque(maxlen=window)
+
+    def add(self, center, weight=1.0):
+        self.__samples.append((float(center[0]), float(center[1]), max(float(weight), 1e-6)))
+
+    def estimate(self):
+        if not self.__samples:
+            return None
+        samples = np.array(self.__samples, dtype=np.float64)
+        points, weights = samples[:, :2], samples[:, 2]
+
+        median = np.median(points, axis=0)
+        mad = np.median(np.abs(points - median), axis=0)
+        limit = np.maximum(_CONVERGENCE_OUTLIER_SIGMAS * 1.4826 * mad, self.min_outlier_distance)
+        inliers = np.all(np.abs(points - median) <= limit, axis=1)
+        points, weights = points[inliers], weights[inliers]
+
+        position = np.average(points, axis=0, weights=weights)
+        # Confidence interval of the weighted mean, from the weighted variance and the effective sample size
+        variance = np.average((points - position) ** 2, axis=0, weights=weights)
+        effective = weights.sum() ** 2 / np.sum(weights ** 2)
+        ci = _CONVERGENCE_Z * np.sqrt(variance / (effective - 1)) if effective > 1 else np.full(2, np.inf)
+
+        return {
+            "position": (float(position[0]), float(position[1])),
+            "samples": int(samples.shape[0]),
+            "inliers": int(inliers.sum()),
+            "spread": float(np.max(np.abs(points - position))),
+            "mad": float(np.max(mad)),
+            "ci": float(np.max(ci)),
+            "converged": bool(inliers.sum() >= self.min_samples and np.max(ci) <= self.target_px),
+        }
+
+class Blob_Buffers:
+    """
+    Preallocated single-channel planes for the blob cascade of one frame size: the luma plane, its
+    gamma-corrected version, a blur scratch plane and the output of each preprocessor.
+    """
+    def __init__(self, height, width):
+        self.shape = (height, width)
+        self.gray = np.empty(self.shape, dtype=np.uint8)
+        self.gamma = np.empty(self.shape, dtype=np.uint8)
+        self.scratch = np.empty(self.shape, dtype=np.uint8)
+        self.preprocessed = [np.empty(self.shape, dtype=np.uint8) for _ in range(3)]
+
+# Gamma lookup tables, built once per gamma value
+_GAMMA_TABLES = dict()
+
+def _gamma_table(gamma):
+    table = _GAMMA_TABLES.get(gamma)
+    if table is None:
+        # map the pixel values [0, 255] to their adjusted gamma values
+        table = (((np.arange(256) / 255.0) ** (1.0 / gamma)) * 255).astype('uint8')
+        _GAMMA_TABLES[gamma] = table
+    return table
+
 class Taxy_Server_Detection_Manager:
     uv = [None, None]
     __algorithm = None
@@ -20,7 +235,7 @@ class Taxy_Server_Detection_Manager:
     
     ##### Setup functions
     # init function
-    def __init__(self, log, camera_url, save_training = False, *args, **kwargs):
+    def __init__(self, log, camera_url, save_training = False, detection_service = None, tool = None, settle_threshold = SETTLE_THRESHOLD, context = None, chunk_size = READ_CHUNK_SIZE, grabber = None, *args, **kwargs):
         try:
             self.log = log
 
@@ -31,38 +246,48 @@ class Taxy_Server_Detection_Manager:
             self.save_training = save_training
 
             # The already initialized io object.
-            self.__io = io(log=log, camera_url=camera_url, save_image=False)
+            self.__io = io(log=log, camera_url=camera_url, save_image=False, chunk_size=chunk_size, grabber=grabber)
             
-            # This is the last successful algorithm used by the nozzle detection. Should be reset at tool change. Will have to change.
+            # This is the last successful algorithm used by the nozzle detection.
             self.__algorithm = None
 
-            # TAMV has 2 detectors, one for standard and one for relaxed
-            self.createDetectors()
-            
-            # --- YOLO / AI Integration ---
-            self.yolo_detector = None
-            if YOLO_AVAILABLE:
-                # Search for model files in current dir
-                model_files = [f for f in os.listdir('.') if f.endswith(('.tflite', '.onnx'))]
-                # Prefer tflite, then onnx
-                tflite_models = [f for f in model_files if f.endswith('.tflite')]
-                onnx_models = [f for f in model_files if f.endswith('.onnx')]
-                
-                model_path = None
-                if tflite_models:
-                    model_path = tflite_models[0]
-                elif onnx_models:
-                    model_path = onnx_models[0]
-                
-                if model_path:
-                    self.log(f"*** Loading AI Model: {model_path}")
-                    try:
-                        self.yolo_detector = NozzleDetector(model_path, conf_thres=0.5)
-                        self.log("*** AI Model loaded successfully (conf_thres=0.5).")
-                    except Exception as e:
-                        self.log(f"*** Failed to load AI Model: {e}")
-                else:
-                    self.log("*** No .tflite or .onnx model found. Falling back to Blob Detector.")
+            # The tool being detected (e.g. the extruder name), used to order the blob cascade stages
+            # by what worked for this tool before.
+            self.tool = tool
+
+            # The server context (camera/printer) of this manager, its inferences are queued under it
+            self.context = context
+
+            # Blob cascade buffers by frame size, reused for every frame of the same size
+            self.__blobBuffers = dict()
+
+            # Frame difference below which the image counts as still after a move (see Frame_Motion_Monitor)
+            self.settle_threshold = settle_threshold
+
+            # Statistics of the last position measurement (settle time, dropped frames, mode specific values)
+            self.last_stats = None
+
+            # ROI mode: after a confident detection, the next frames are searched in a window around it
+            self.roi_detection = False
+            self.__roiCenter = None
+
+            # Reduced decode: the measurement loops decode frames for the model straight at (about) its
+            # input size, the full frame is only decoded for a ROI search, the blob fallback or saving
+            self.reduced_decode = False
+
+            # Preview tracker, the time the last full preview detection finished, the detection running
+            # in the background (a Future of (frame, result)) and the last full detection result
+            self.__tracker = None
+            self.__lastPreviewDetection = 0
+            self.__previewDetection = None
+            self.__previewResult = None
+
+            # The shared detection service holding the AI model and the blob detectors.
+            # Only load a private one when none is given (standalone use).
+            if detection_service is None:
+                detection_service = ds(log)
+                detection_service.load()
+            self.detection_service = detection_service
             
             # send exiting to log
             self.log('*** exiting DetectionManager.__init__')
@@ -70,6 +295,11 @@ class Taxy_Server_Detection_Manager:
             self.log('*** exception in DetectionManager.__init__: %s' % str(e))
             raise e
 
+    # The algorithm used by the last successful nozzle detection ("AI_YOLO" or the blob stage number)
+    @property
+    def algorithm(self):
+        return self.__algorithm
+
     def send_data_to_telegram(self, image, result_data):
         """
         Invia l'immagine e i dati di rilevamento al bot Telegram in background.
@@ -80,7 +310,7 @@ class Taxy_Server_Detection_Manager:
         def _send():
             try:
                 # Encode image to jpg
-                _, img_encoded = cv2.imencode('.jpg', image)
+                _, img_encoded = cv2.imencode('.jpg', frame_image(image))
                 img_bytes = img_encoded.tobytes()
                 
                 url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendPhoto"
@@ -102,6 +332,31 @@ class Taxy_Server_Detection_Manager:
         # Run in thread to avoid blocking the printer
         threading.Thread(target=_send).start()
 
+    # Waits until the image stops moving after a move, so matches are only counted on still frames.
+    # Frames identical to the previous one are dropped by the io. Sets last_stats with the settle time.
+    def __waitForSettle(self, put_frame_func, deadline):
+        motion = Frame_Motion_Monitor(self.settle_threshold)
+        self.last_stats = {"settle_time": None}
+        while time.time() < deadline:
+            frame = self.__getNewFrame()
+            if frame is None:
+                continue
+            put_frame_func(frame, None)
+            if motion.update(frame):
+                self.last_stats["settle_time"] = motion.settle_time
+                if motion.timed_out:
+                    self.last_stats["settle_timed_out"] = True
+                    self.log("Image did not settle within %.1fs (difference %s), measuring anyway" % (motion.settle_time, str(motion.difference)))
+                else:
+                    self.log("Image settled after %.3fs" % motion.settle_time)
+                return
+
+    def __getNewFrame(self):
+        frame = self.__io.get_new_camera_frame() if self.reduced_decode else self.__io.get_new_frame()
+        if frame is None:
+            time.sleep(_FRAME_RETRY_INTERVAL)
+        return frame
+
     # timeout = 20: If no nozzle found in this time, timeout the function
     # min_matches = 3: Minimum amount of matches to confirm toolhead position after a move
     # xy_tolerance = 1: If the nozzle position is within this tolerance, it's considered a match. 1.0 would be 1 pixel. Only whole numbers are supported.
@@ -113,14 +368,20 @@ class Taxy_Server_Detection_Manager:
         pos_matches = 0
         pos = None
 
+        # Wait for the shared model to finish loading before measuring
+        if not self.detection_service.wait_ready(timeout):
+            self.log('recursively_find_nozzle_position: detection service not ready, using blob detection')
+        self.__waitForSettle(put_frame_func, start_time + timeout)
+
         while time.time() - start_time < timeout:
-            frame = self.__io.get_single_frame()
-            # Save raw frame for data collection before processing (deep copy to prevent corruption)
-            raw_frame = copy.deepcopy(frame) if (self.save_training or TELEGRAM_BOT_TOKEN) else None
+            frame = self.__getNewFrame()
+            if frame is None:
+                continue
 
-            positions, processed_frame = self.nozzleDetection(frame)
-            if processed_frame is not None:
-                put_frame_func(processed_frame)
+            # Detection does not draw on the frame, so it stays the raw frame for data collection
+            result = self.detectNozzle(frame)
+            put_frame_func(frame, result)
+            positions = result.center
 
             self.log('recursively_find_nozzle_position positions: %s' % str(positions))
 
@@ -135,12 +396,12 @@ class Taxy_Server_Detection_Manager:
                     self.log("recursively_find_nozzle_position found %i matches and returning" % pos_matches)
                     # Save the frame and detection locally for training if enabled.
                     if self.save_training:
-                        self.__io.save_frame_locally(frame, pos, self.__algorithm)
+                        self.__io.save_frame_locally(frame, pos, self.__algorithm, result, self.tool)
 
                     # --- DATA COLLECTION (TELEGRAM) ---
                     # Send the RAW frame + detection info
-                    if raw_frame is not None:
-                        self.send_data_to_telegram(raw_frame, f"Pos: {pos}")
+                    if TELEGRAM_BOT_TOKEN:
+                        self.send_data_to_telegram(frame, f"Pos: {pos}")
                     # ----------------------------------
 
                     break
@@ -150,309 +411,440 @@ class Taxy_Server_Detection_Manager:
                 pos_matches = 0
 
             last_pos = pos
-            # Wait 0.3s to leave time for the webcam server to catch up
-            # Crowsnest usually caches 0.3 seconds of frames
-            time.sleep(0.3)
 
+        self.last_stats.update({"matches": pos_matches, "stale_frames": self.__io.stale_frames})
         self.log("recursively_find_nozzle_position found: %s" % str(last_pos))
         self.log('*** exiting recursively_find_nozzle_position')
         return pos
 
-    def get_preview_frame(self, put_frame_func):
+    # Convergence mode: keeps a robust running estimate over the recent detections (see Position_Convergence)
+    # and returns as soon as its confidence interval is below target_px, instead of waiting for
+    # min_matches consecutive detections within xy_tolerance.
+    # Sets last_stats with the sample count, spread and confidence interval of the result.
+    def find_nozzle_position_converge(self, put_frame_func, min_matches, timeout, xy_tolerance, target_px):
+        self.log('*** calling find_nozzle_position_converge')
+        start_time = time.time()  # Get the current time
+        convergence = Position_Convergence(target_px, min_matches, xy_tolerance)
+        estimate = None
+
+        # Wait for the shared model to finish loading before measuring
+        if not self.detection_service.wait_ready(timeout):
+            self.log('find_nozzle_position_converge: detection service not ready, using blob detection')
+        self.__waitForSettle(put_frame_func, start_time + timeout)
+
+        while time.time() - start_time < timeout:
+            frame = self.__getNewFrame()
+            if frame is None:
+                continue
+            result = self.detectNozzle(frame)
+            put_frame_func(frame, result)
+
+            if result.found:
+                # AI detections are weighted by their confidence, blob detections count as 1
+                convergence.add(result.center, result.score if result.score is not None else 1.0)
+                estimate = convergence.estimate()
+                self.log("find_nozzle_position_converge: %s, estimate %s" % (str(result.center), str(estimate)))
+                if estimate["converged"]:
+                    break
+
+        self.last_stats["stale_frames"] = self.__io.stale_frames
+        if estimate is None:
+            pos = None
+        else:
+            pos = estimate.pop("position")
+            self.last_stats.update(estimate)
+            if estimate["converged"]:
+                # Save the last frame for training if enabled, it agrees with the estimate
+                if self.save_training:
+                    self.__io.save_frame_locally(frame, pos, self.__algorithm, result, self.tool)
+                if TELEGRAM_BOT_TOKEN:
+                    self.send_data_to_telegram(frame, f"Pos: {pos}")
+            else:
+                self.log("find_nozzle_position_converge: not converged before timeout")
+
+        self.log("find_nozzle_position_converge found: %s" % str(pos))
+        self.log('*** exiting find_nozzle_position_converge')
+        return pos
+
+    # Batched consensus mode: capture a burst of burst_size frames, run them through the model as one
+    # batched tensor and confirm the position from the agreement inside the burst, instead of
+    # min_matches consecutive single-frame rounds.
+    # A detection agrees when it is within xy_tolerance pixels of the burst median after rounding to
+    # whole pixels (so 0 means the same pixel), at least min_matches detections must agree.
+    def find_nozzle_position_batch(self, put_frame_func, min_matches, timeout, xy_tolerance, burst_size):
+        self.log('*** calling find_nozzle_position_batch')
+        start_time = time.time()  # Get the current time
+        pos = None
+        burst_size = max(burst_size, min_matches)
+
+        # Wait for the shared model to finish loading before measuring
+        if not self.detection_service.wait_ready(timeout):
+            self.log('find_nozzle_position_batch: detection service not ready, using blob detection')
+        self.__waitForSettle(put_frame_func, start_time + timeout)
+
+        while time.time() - start_time < timeout:
+            frames = []
+            for i in range(burst_size):
+                # Repeated frames are dropped, so each frame of the burst is a new camera frame
+                frame = self.__getNewFrame()
+                if frame is not None:
+                    frames.append(frame)
+            if len(frames) < min_matches:
+                continue
+
+            batch_results = None
+            try:
+                inputs, scales = zip(*(self.__modelInput(frame) for frame in frames))
+                if all(image is not None for image in inputs):
+                    inference = self.detection_service.infer_batch(list(inputs), self.context)
+                    if inference is not None:
+                        batch_results = [_scale_results(results, scale) for results, scale in zip(inference[0], scales)]
+            except Exception as e:
+                self.log(f"AI Batch Detection Error: {e}")
+
+            positions = []
+            for i, frame in enumerate(frames):
+                yolo_results = batch_results[i] if batch_results is not None else None
+                result = self.nozzleDetection(frame, yolo_results=yolo_results)
+                if result.found:
+                    positions.append((result.center, frame, result.algorithm, result))
+            put_frame_func(frames[-1], result)
+
+            self.log('find_nozzle_position_batch positions: %s' % str([p[0] for p in positions]))
+            if len(positions) < min_matches:
+                continue
+
+            centers = np.array([p[0][:2] for p in positions], dtype=np.float64)
+            median = np.median(centers, axis=0)
+            inliers = np.all(np.abs(np.round(centers) - np.round(median)) <= xy_tolerance, axis=1)
+            spread = float(np.max(np.abs(centers[inliers] - median))) if np.any(inliers) else None
+            self.log("find_nozzle_position_batch consensus: median %s, %i of %i agree, spread %s px" % (str(median), int(inliers.sum()), len(positions), str(spread)))
+
+            if inliers.sum() >= min_matches:
+                pos = tuple(float(v) for v in np.median(centers[inliers], axis=0))
+                self.last_stats.update({"samples": len(positions), "agreeing": int(inliers.sum()), "spread": spread})
+                # Save the frame closest to the consensus for training if enabled.
+                if self.save_training:
+                    closest = int(np.argmin(np.linalg.norm(centers - median, axis=1)))
+                    self.__io.save_frame_locally(positions[closest][1], positions[closest][0], positions[closest][2], positions[closest][3], self.tool)
+                if TELEGRAM_BOT_TOKEN:
+                    self.send_data_to_telegram(positions[-1][1], f"Pos: {pos}")
+                break
+
+        self.last_stats["stale_frames"] = self.__io.stale_frames
+        self.log("find_nozzle_position_batch found: %s" % str(pos))
+        self.log('*** exiting find_nozzle_position_batch')
+        return pos
+
+    # inference_interval: seconds from the end of one full detection to the start of the next. Full
+    # detections run in the background, the nozzle is tracked on the frames shown meanwhile (see
+    # Nozzle_Tracker) and the tracker is re-seeded from each detection when it lands.
+    # 0 runs the detection on every frame, on this thread.
+    def get_preview_frame(self, put_frame_func, inference_interval=0):
         import time as perf_time
         t_start = perf_time.time()
 
         t1 = perf_time.time()
         frame = self.__io.get_single_frame()
         t2 = perf_time.time()
+        if frame is None:
+            return
 
-        _, processed_frame = self.nozzleDetection(frame, fast_preview=True)
+        if inference_interval <= 0:
+            result = self.nozzleDetection(frame)
+            self.__tracker = None
+        else:
+            self.__collectPreviewDetection()
+            result = None
+            if self.__tracker is not None:
+                result = self.__tracker.update(frame)
+                if result is None:
+                    self.log("Preview tracker lost the nozzle (score %.2f)" % self.__tracker.score)
+                    self.__tracker = None
+                    # Shown as not found until the next detection, which starts right away
+                    self.__previewResult = Nozzle_Detection_Result()
+                    self.__lastPreviewDetection = 0
+            if result is None:
+                result = self.__previewResult
+            if self.__previewDetection is None and t2 - self.__lastPreviewDetection >= inference_interval:
+                self.__startPreviewDetection(frame)
         t3 = perf_time.time()
 
-        if processed_frame is not None:
-            put_frame_func(processed_frame)
+        put_frame_func(frame, result)
         t4 = perf_time.time()
 
-        self.log(f'PERF: Camera:{(t2-t1)*1000:.0f}ms Detection:{(t3-t2)*1000:.0f}ms Put:{(t4-t3)*1000:.0f}ms Total:{(t4-t_start)*1000:.0f}ms')
+        mode = "Detection" if inference_interval <= 0 else ("Tracking" if result is not None and result.tracked else "Waiting")
+        self.log(f'PERF: Camera:{(t2-t1)*1000:.0f}ms {mode}:{(t3-t2)*1000:.0f}ms Put:{(t4-t3)*1000:.0f}ms Total:{(t4-t_start)*1000:.0f}ms')
         return
 
-# ----------------- TAMV Nozzle Detection as tested in taxy_cv -----------------
+    # Runs a full detection of frame on a background thread, so the preview keeps showing frames
+    def __startPreviewDetection(self, frame):
+        detection = Future()
 
-    def createDetectors(self):
-        # Standard Parameters
-        if(True):
-            self.standardParams = cv2.SimpleBlobDetector_Params()
-            # Thresholds
-            self.standardParams.minThreshold = 1
-            self.standardParams.maxThreshold = 50
-            self.standardParams.thresholdStep = 1
-            # Area
-            self.standardParams.filterByArea = True
-            self.standardParams.minArea = 400
-            self.standardParams.maxArea = 900
-            # Circularity
-            self.standardParams.filterByCircularity = True
-            self.standardParams.minCircularity = 0.8
-            self.standardParams.maxCircularity= 1
-            # Convexity
-            self.standardParams.filterByConvexity = True
-            self.standardParams.minConvexity = 0.3
-            self.standardParams.maxConvexity = 1
-            # Inertia
-            self.standardParams.filterByInertia = True
-            self.standardParams.minInertiaRatio = 0.3
-
-        # Relaxed Parameters
-        if(True):
-            self.relaxedParams = cv2.SimpleBlobDetector_Params()
-            # Thresholds
-            self.relaxedParams.minThreshold = 1
-            self.relaxedParams.maxThreshold = 50
-            self.relaxedParams.thresholdStep = 1
-            # Area
-            self.relaxedParams.filterByArea = True
-            self.relaxedParams.minArea = 600
-            self.relaxedParams.maxArea = 15000
-            # Circularity
-            self.relaxedParams.filterByCircularity = True
-            self.relaxedParams.minCircularity = 0.6
-            self.relaxedParams.maxCircularity= 1
-            # Convexity
-            self.relaxedParams.filterByConvexity = True
-            self.relaxedParams.minConvexity = 0.1
-            self.relaxedParams.maxConvexity = 1
-            # Inertia
-            self.relaxedParams.filterByInertia = True
-            self.relaxedParams.minInertiaRatio = 0.3
-
-        # Super Relaxed Parameters
-            t1=20
-            t2=200
-            all=0.5
-            area=200
-            
-            self.superRelaxedParams = cv2.SimpleBlobDetector_Params()
-        
-            self.superRelaxedParams.minThreshold = t1
-            self.superRelaxedParams.maxThreshold = t2
-            
-            self.superRelaxedParams.filterByArea = True
-            self.superRelaxedParams.minArea = area
-            
-            self.superRelaxedParams.filterByCircularity = True
-            self.superRelaxedParams.minCircularity = all
-            
-            self.superRelaxedParams.filterByConvexity = True
-            self.superRelaxedParams.minConvexity = all
-            
-            self.superRelaxedParams.filterByInertia = True
-            self.superRelaxedParams.minInertiaRatio = all
-            
-            self.superRelaxedParams.filterByColor = False
+        def _detect():
+            try:
+                detection.set_result((frame, self.nozzleDetection(frame)))
+            except Exception as e:
+                detection.set_exception(e)
 
-            self.superRelaxedParams.minDistBetweenBlobs = 2
-            
-        # Create 3 detectors
-        self.detector = cv2.SimpleBlobDetector_create(self.standardParams)
-        self.relaxedDetector = cv2.SimpleBlobDetector_create(self.relaxedParams)
-        self.superRelaxedDetector = cv2.SimpleBlobDetector_create(self.superRelaxedParams)
-
-    def nozzleDetection(self, image, fast_preview=False):
-        # working frame object
-        # For preview: shallow copy is OK (10x faster, frame not reused)
-        # For detection: deep copy required (frame may be saved for training)
-        if fast_preview:
-            nozzleDetectFrame = image.copy()  # Shallow copy - fast
+        self.__previewDetection = detection
+        threading.Thread(target=_detect, daemon=True).start()
+
+    # Takes the result of a finished background detection: the tracker is re-seeded on the frame the
+    # detection ran on, and the interval to the next detection starts now
+    def __collectPreviewDetection(self):
+        detection = self.__previewDetection
+        if detection is None or not detection.done():
+            return
+        self.__previewDetection = None
+        self.__lastPreviewDetection = time.time()
+        try:
+            frame, result = detection.result()
+        except Exception as e:
+            self.log("Preview detection failed: %s" % str(e))
+            return
+        self.__previewResult = result
+        self.__tracker = Nozzle_Tracker(frame, result) if result.found else None
+
+# ----------------- TAMV Nozzle Detection as tested in taxy_cv -----------------
+
+    # Detection used by the measurement loops: with roi_detection, searches a window around the last
+    # confident detection first and falls back to the full frame when nothing is found there.
+    def detectNozzle(self, image):
+        result = None
+        if self.roi_detection and self.__roiCenter is not None:
+            result = self.nozzleDetection(image, roi=self.__roiWindow(image.shape, self.__roiCenter))
+            if not result.found:
+                self.log("Nothing found around %s, searching the full frame" % str(self.__roiCenter))
+                result = None
+        if result is None:
+            result = self.nozzleDetection(image)
+        confident = result.found and (result.score is None or result.score >= _ROI_MIN_SCORE)
+        self.__roiCenter = result.center if confident else None
+        return result
+
+    # Window (left, top, right, bottom) of the model's native input size (blob: _BLOB_ROI_SIZE) around center
+    def __roiWindow(self, shape, center):
+        height, width = shape[:2]
+        size = self.detection_service.native_input_size() or (_BLOB_ROI_SIZE, _BLOB_ROI_SIZE)
+        roi_h, roi_w = min(size[0], height), min(size[1], width)
+        left = min(max(int(round(center[0] - roi_w / 2)), 0), width - roi_w)
+        top = min(max(int(round(center[1] - roi_h / 2)), 0), height - roi_h)
+        return (left, top, left + roi_w, top + roi_h)
+
+    # Detects the nozzle in image and returns a Nozzle_Detection_Result. The image is not copied or
+    # drawn on, overlays are drawn by draw_detection when the frame is shown.
+    # yolo_results: AI results already computed for this image (e.g. by a batched inference),
+    # None to run the model here.
+    # roi: (left, top, right, bottom) window to search instead of the full image; the result is in
+    # full image coordinates.
+    def nozzleDetection(self, image, yolo_results=None, roi=None):
+        img_h, img_w = image.shape[:2]
+        if roi is not None:
+            image = frame_image(image)
+            if image is None:
+                return Nozzle_Detection_Result()
+            left, top, right, bottom = roi
+            search = image[top:bottom, left:right]
         else:
-            nozzleDetectFrame = copy.deepcopy(image)  # Deep copy - safe
-        center = (None, None)
-        
+            left, top = 0, 0
+            search = image
+        # Detections closest to this point are preferred
+        target_x, target_y = left + search.shape[1] / 2, top + search.shape[0] / 2
+
         # --- AI / YOLO Detection ---
-        if self.yolo_detector:
+        results = yolo_results
+        if results is None:
             try:
-                results, _ = self.yolo_detector.infer(image)
+                model_input, scale = self.__modelInput(search)
+                inference = self.detection_service.infer(model_input, self.context) if model_input is not None else None
+                if inference is not None:
+                    results = _scale_results(inference[0], scale)
+            except Exception as e:
+                self.log(f"AI Detection Error: {e}")
+                # Fallback to standard detection
+
+        if results:
+            try:
+                # Find best result (closest to center)
+                best_res = None
+                min_dist = float('inf')
                 
-                if results:
-                    self.__algorithm = "AI_YOLO"
-                    # Find best result (closest to center)
-                    img_h, img_w = image.shape[:2]
-                    img_center_x, img_center_y = img_w // 2, img_h // 2
-                    
-                    best_res = None
-                    min_dist = float('inf')
-                    
-                    for res in results:
-                        x1, y1, x2, y2 = res['box']
-                        cx = (x1 + x2) / 2
-                        cy = (y1 + y2) / 2
-                        dist = np.sqrt((cx - img_center_x)**2 + (cy - img_center_y)**2)
-                        
-                        if dist < min_dist:
-                            min_dist = dist
-                            best_res = res
-                            center = (cx, cy)  # Sub-pixel precision (float)
-
-                    # Draw results
-                    x1, y1, x2, y2 = map(int, best_res['box'])
-                    cv2.rectangle(nozzleDetectFrame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                    cv2.circle(nozzleDetectFrame, (int(center[0]), int(center[1])), 5, (0, 0, 255), -1)
-                    label = f"Nozzle: {best_res['score']:.2f}"
-                    cv2.putText(nozzleDetectFrame, label, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
-                    
-                    # Draw crosshair
-                    cv2.line(nozzleDetectFrame, (img_center_x, 0), (img_center_x, img_h), (255, 255, 255), 1)
-                    cv2.line(nozzleDetectFrame, (0, img_center_y), (img_w, img_center_y), (255, 255, 255), 1)
-                    
-                    self.log(f"AI Detection successful: {center}")
-                    return (center, nozzleDetectFrame)
+                for res in results:
+                    x1, y1, x2, y2 = res['box']
+                    cx = (x1 + x2) / 2 + left
+                    cy = (y1 + y2) / 2 + top
+                    dist = np.sqrt((cx - target_x)**2 + (cy - target_y)**2)
                     
+                    if dist < min_dist:
+                        min_dist = dist
+                        best_res = res
+                        center = (cx, cy)  # Sub-pixel precision (float)
+
+                self.__algorithm = "AI_YOLO"
+                self.log(f"AI Detection successful: {center}")
+                x1, y1, x2, y2 = best_res['box']
+                return Nozzle_Detection_Result(center=center, algorithm=self.__algorithm, box=(x1 + left, y1 + top, x2 + left, y2 + top), score=float(best_res['score']))
+                
             except Exception as e:
                 self.log(f"AI Detection Error: {e}")
                 # Fallback to standard detection
         
         # --- Standard Blob Detection (Fallback) ---
-        # return value for keypoints
-        keypoints = None
-        # check which algorithm worked previously
-        if 1==1: #(self.__algorithm is None):
-            preprocessorImage0 = self.preprocessImage(frameInput=nozzleDetectFrame, algorithm=0)
-            preprocessorImage1 = self.preprocessImage(frameInput=nozzleDetectFrame, algorithm=1)
-            preprocessorImage2 = self.preprocessImage(frameInput=nozzleDetectFrame, algorithm=2)
-
-            # apply combo 1 (standard detector, preprocessor 0)
-            keypoints = self.detector.detect(preprocessorImage0)
-            keypointColor = (0,0,255)
-            if(len(keypoints) != 1):
-                # apply combo 2 (standard detector, preprocessor 1)
-                keypoints = self.detector.detect(preprocessorImage1)
-                keypointColor = (0,255,0)
-                if(len(keypoints) != 1):
-                    # apply combo 3 (relaxed detector, preprocessor 0)
-                    keypoints = self.relaxedDetector.detect(preprocessorImage0)
-                    keypointColor = (255,0,0)
-                    if(len(keypoints) != 1):
-                        # apply combo 4 (relaxed detector, preprocessor 1)
-                        keypoints = self.relaxedDetector.detect(preprocessorImage1)
-                        keypointColor = (39,127,255)
-
-                        if(len(keypoints) != 1):
-                            # apply combo 5 (superrelaxed detector, preprocessor 2)
-                            keypoints = self.superRelaxedDetector.detect(preprocessorImage2)
-                            keypointColor = (39,255,127)
-                            if(len(keypoints) != 1):
-                                # failed to detect a nozzle, correct return value object
-                                keypoints = None
-                            else:
-                                self.__algorithm = 5
-                        else:
-                            self.__algorithm = 4
-                    else:
-                        self.__algorithm = 3
-                else:
-                    self.__algorithm = 2
-            else:
-                self.__algorithm = 1
-        elif(self.__algorithm == 1):
-            preprocessorImage0 = self.preprocessImage(frameInput=nozzleDetectFrame, algorithm=0)
-            keypoints = self.detector.detect(preprocessorImage0)
-            keypointColor = (0,0,255)
-        elif(self.__algorithm == 2):
-            preprocessorImage1 = self.preprocessImage(frameInput=nozzleDetectFrame, algorithm=1)
-            keypoints = self.detector.detect(preprocessorImage1)
-            keypointColor = (0,255,0)
-        elif(self.__algorithm == 3):
-            preprocessorImage0 = self.preprocessImage(frameInput=nozzleDetectFrame, algorithm=0)
-            keypoints = self.relaxedDetector.detect(preprocessorImage0)
-            keypointColor = (255,0,0)
-        else:
-            preprocessorImage1 = self.preprocessImage(frameInput=nozzleDetectFrame, algorithm=1)
-            keypoints = self.relaxedDetector.detect(preprocessorImage1)
-            keypointColor = (39,127,255)
-            
-        if keypoints is not None:
-            self.log("Nozzle detected %i circles with algorithm: %s" % (len(keypoints), str(self.__algorithm)))
-        else:
+        search = frame_image(search)
+        if search is None:
+            return Nozzle_Detection_Result()
+        algorithm, keypoints, keypointColor = self.__blobCascade(search)
+        if algorithm is None:
             self.log("Nozzle detection failed.")
-            
-            
+            return Nozzle_Detection_Result()
+        self.__algorithm = algorithm
+        self.log("Nozzle detected %i circles with algorithm: %s" % (len(keypoints), str(algorithm)))
+
         # process keypoint
-        if(keypoints is not None and len(keypoints) >= 1):
-            # If multiple keypoints are found,
-            if len(keypoints) > 1:
-                # use the one closest to the center of the image.
-                closest_index = self.find_closest_keypoint(keypoints)
-                # create center object from centermost keypoint
-                (x,y) = np.around(keypoints[closest_index].pt)
-            else:
-                # create center object from first and only keypoint
-                (x,y) = np.around(keypoints[0].pt)
-
-            x,y = int(x), int(y)
-
-            # Sanity check: Reject keypoints too far from image center (likely false positives)
-            # Allow detections within 40% of image dimensions from center
-            img_h, img_w = nozzleDetectFrame.shape[:2]
-            img_cx, img_cy = img_w // 2, img_h // 2
-            max_dist_x = img_w * 0.4  # 40% = 512 pixels at 1280
-            max_dist_y = img_h * 0.4  # 40% = 288 pixels at 720
-
-            if abs(x - img_cx) > max_dist_x or abs(y - img_cy) > max_dist_y:
-                self.log(f"Blob rejected: ({x},{y}) too far from center ({img_cx},{img_cy})")
-                keypoints = None  # Treat as not found
-                center = None
-            else:
-                center = (x,y)
-                # create radius object and draw visualization
-                keypointRadius = np.around(keypoints[0].size/2)
-                keypointRadius = int(keypointRadius)
-                circleFrame = cv2.circle(img=nozzleDetectFrame, center=center, radius=keypointRadius,color=keypointColor,thickness=-1,lineType=cv2.LINE_AA)
-                nozzleDetectFrame = cv2.addWeighted(circleFrame, 0.4, nozzleDetectFrame, 0.6, 0)
-                nozzleDetectFrame = cv2.circle(img=nozzleDetectFrame, center=center, radius=keypointRadius, color=(0,0,0), thickness=1,lineType=cv2.LINE_AA)
-                nozzleDetectFrame = cv2.line(nozzleDetectFrame, (x-5,y), (x+5, y), (255,255,255), 2)
-                nozzleDetectFrame = cv2.line(nozzleDetectFrame, (x,y-5), (x, y+5), (255,255,255), 2)
-
-        if center is None:
-            # no keypoints, draw a 3 outline circle in the middle of the frame
-            keypointRadius = 17
-            nozzleDetectFrame = cv2.circle(img=nozzleDetectFrame, center=(640,360), radius=keypointRadius, color=(0,0,0), thickness=3,lineType=cv2.LINE_AA)
-            nozzleDetectFrame = cv2.circle(img=nozzleDetectFrame, center=(640,360), radius=keypointRadius+1, color=(0,0,255), thickness=1,lineType=cv2.LINE_AA)
-            center = None
-        # draw crosshair (1280x720 centered at 640,360)
-        nozzleDetectFrame = cv2.line(nozzleDetectFrame, (640,0), (640,720), (0,0,0), 2)
-        nozzleDetectFrame = cv2.line(nozzleDetectFrame, (0,360), (1280,360), (0,0,0), 2)
-        nozzleDetectFrame = cv2.line(nozzleDetectFrame, (640,0), (640,720), (255,255,255), 1)
-        nozzleDetectFrame = cv2.line(nozzleDetectFrame, (0,360), (1280,360), (255,255,255), 1)
-
-        # return(center, nozzleDetectFrame)
-        return(center, nozzleDetectFrame)
-
-    # Image detection preprocessors
-    def preprocessImage(self, frameInput, algorithm=0):
+        # If multiple keypoints are found, use the one closest to the center of the image.
+        closest_index = self.find_closest_keypoint(keypoints, search.shape) if len(keypoints) > 1 else 0
+        (x,y) = np.around(keypoints[closest_index].pt)
+        x,y = int(x) + left, int(y) + top
+
+        # Sanity check: Reject keypoints too far from image center (likely false positives)
+        # Allow detections within 40% of image dimensions from center
+        img_cx, img_cy = img_w // 2, img_h // 2
+        max_dist_x = img_w * 0.4  # 40% = 512 pixels at 1280
+        max_dist_y = img_h * 0.4  # 40% = 288 pixels at 720
+
+        if abs(x - img_cx) > max_dist_x or abs(y - img_cy) > max_dist_y:
+            self.log(f"Blob rejected: ({x},{y}) too far from center ({img_cx},{img_cy})")
+            return Nozzle_Detection_Result(algorithm=algorithm)
+
+        keypointRadius = int(np.around(keypoints[closest_index].size/2))
+        return Nozzle_Detection_Result(center=(x,y), algorithm=algorithm, radius=keypointRadius, color=keypointColor)
+
+    # Image for the model and the (x, y) scale of its pixels to frame pixels. A Camera_Frame is
+    # decoded at reduced resolution, just large enough for the model's native input size.
+    def __modelInput(self, frame):
+        if not isinstance(frame, Camera_Frame):
+            return frame, (1.0, 1.0)
+        size = self.detection_service.native_input_size()
+        if size is None:
+            return frame.image, (1.0, 1.0)
+        return frame.reduced(*size)
+
+    # Blob detection cascade, returns (algorithm, keypoints, keypoint color) of the first stage that
+    # found exactly one blob, or (None, None, None).
+    # Stages run in order of their recent success for this tool, each preprocessed image is
+    # only computed when a stage needs it. All stages work on single-channel planes derived from
+    # one luma conversion of the frame.
+    def __blobCascade(self, frame):
+        stages = self.detection_service.blob_stages(self.tool, self.context)
+        with self.detection_service.acquire_blob_executor() as executor:
+            if executor is not None:
+                result = self.__parallelBlobCascade(frame, stages, executor)
+                if result is not None:
+                    return result
+
+        intermediates = dict()
+        buffers = self.__getBlobBuffers(frame.shape[:2])
+        preprocessed = dict()
+        for algorithm, _, preprocessor, color in stages:
+            if preprocessor not in preprocessed:
+                preprocessed[preprocessor] = self.preprocessImage(frameInput=frame, algorithm=preprocessor, intermediates=intermediates, buffers=buffers)
+            keypoints = self.detection_service.stageDetectors[algorithm].detect(preprocessed[preprocessor])
+            found = len(keypoints) == 1
+            self.detection_service.record_blob_stage(self.tool, algorithm, found, self.context)
+            if found:
+                return algorithm, keypoints, color
+        return None, None, None
+
+    # Parallel mode: all stages are queued at once and the results are taken in priority order,
+    # so the outcome is the same as running them one after another.
+    # Returns None when the pool does not take the stages, the cascade then runs sequentially.
+    def __parallelBlobCascade(self, frame, stages, executor):
+        # Stages that are still running when this returns may outlive the call, so this mode
+        # allocates its planes per frame instead of reusing the buffers.
+        # The luma and gamma planes are computed up front so the preprocessors can share them without locking.
+        intermediates = dict()
+        self.__gammaPlane(frame, intermediates)
+        preprocessed = dict()
+        detections = []
         try:
-            outputFrame = self.adjust_gamma(image=frameInput, gamma=1.2)
-            height, width, channels = outputFrame.shape
-        except: outputFrame = copy.deepcopy(frameInput)
+            for _, _, preprocessor, _ in stages:
+                if preprocessor not in preprocessed:
+                    preprocessed[preprocessor] = executor.submit(self.preprocessImage, frame, preprocessor, intermediates)
+            # Queued after the preprocessors they wait on, so a busy pool cannot deadlock
+            for algorithm, _, preprocessor, _ in stages:
+                detections.append(executor.submit(self.__detectStage, algorithm, preprocessed[preprocessor]))
+        except RuntimeError as e:
+            # The pool was shut down (e.g. the interpreter is exiting)
+            self.log("Parallel blob cascade unavailable (%s), running the stages sequentially" % str(e))
+            for future in detections + list(preprocessed.values()):
+                future.cancel()
+            return None
+        try:
+            for (algorithm, _, _, color), detection in zip(stages, detections):
+                keypoints = detection.result()
+                found = len(keypoints) == 1
+                self.detection_service.record_blob_stage(self.tool, algorithm, found, self.context)
+                if found:
+                    return algorithm, keypoints, color
+            return None, None, None
+        finally:
+            # Drop the stages that did not start yet
+            for future in detections + list(preprocessed.values()):
+                future.cancel()
+
+    def __detectStage(self, algorithm, preprocessed):
+        return self.detection_service.stageDetectors[algorithm].detect(preprocessed.result())
+
+    def __getBlobBuffers(self, shape):
+        # Kept per size, so switching between ROI and full-frame search does not reallocate
+        buffers = self.__blobBuffers.get(shape)
+        if buffers is None:
+            buffers = self.__blobBuffers[shape] = Blob_Buffers(*shape)
+        return buffers
+
+    # Luma plane of the frame, converted once per frame
+    def __grayPlane(self, frameInput, intermediates, buffers=None):
+        gray = intermediates.get('gray')
+        if gray is None:
+            if frameInput.ndim == 2:
+                gray = frameInput
+            else:
+                gray = cv2.cvtColor(frameInput, cv2.COLOR_BGR2GRAY, dst=buffers.gray if buffers is not None else None)
+            intermediates['gray'] = gray
+        return gray
+
+    # Gamma-corrected luma plane, shared by preprocessors 0 and 1
+    def __gammaPlane(self, frameInput, intermediates, buffers=None):
+        gamma = intermediates.get('gamma')
+        if gamma is None:
+            gray = self.__grayPlane(frameInput, intermediates, buffers)
+            gamma = cv2.LUT(gray, _gamma_table(1.2), dst=buffers.gamma if buffers is not None else None)
+            intermediates['gamma'] = gamma
+        return gamma
+
+    # Image detection preprocessors, each returns a single-channel uint8 plane
+    # intermediates: dict shared by the preprocessors of the same frame, so the luma and gamma
+    # planes are only computed once
+    # buffers: Blob_Buffers to write into, None allocates new planes
+    def preprocessImage(self, frameInput, algorithm=0, intermediates=None, buffers=None):
+        if intermediates is None:
+            intermediates = dict()
+        output = buffers.preprocessed[algorithm] if buffers is not None else None
+        scratch = buffers.scratch if buffers is not None else None
         if(algorithm == 0):
-            yuv = cv2.cvtColor(outputFrame, cv2.COLOR_BGR2YUV)
-            yuvPlanes = cv2.split(yuv)
-            yuvPlanes_0 = cv2.GaussianBlur(yuvPlanes[0],(7,7),6)
-            yuvPlanes_0 = cv2.adaptiveThreshold(yuvPlanes_0,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,35,1)
-            outputFrame = cv2.cvtColor(yuvPlanes_0,cv2.COLOR_GRAY2BGR)
+            blurred = cv2.GaussianBlur(self.__gammaPlane(frameInput, intermediates, buffers), (7,7), 6, dst=scratch)
+            return cv2.adaptiveThreshold(blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 35, 1, dst=output)
         elif(algorithm == 1):
-            outputFrame = cv2.cvtColor(outputFrame, cv2.COLOR_BGR2GRAY )
-            thr_val, outputFrame = cv2.threshold(outputFrame, 127, 255, cv2.THRESH_BINARY|cv2.THRESH_TRIANGLE )
-            outputFrame = cv2.GaussianBlur( outputFrame, (7,7), 6 )
-            outputFrame = cv2.cvtColor( outputFrame, cv2.COLOR_GRAY2BGR )
-        elif(algorithm == 2):
-            gray = cv2.cvtColor(frameInput, cv2.COLOR_BGR2GRAY)
-            outputFrame = cv2.medianBlur(gray, 5)
-
-        return(outputFrame)
+            _, thresholded = cv2.threshold(self.__gammaPlane(frameInput, intermediates, buffers), 127, 255, cv2.THRESH_BINARY|cv2.THRESH_TRIANGLE, dst=scratch)
+            return cv2.GaussianBlur(thresholded, (7,7), 6, dst=output)
+        else:
+            return cv2.medianBlur(self.__grayPlane(frameInput, intermediates, buffers), 5, dst=output)
 
-    def find_closest_keypoint(keypoints):
+    def find_closest_keypoint(self, keypoints, image_shape=(720, 1280)):
         closest_index = None
         closest_distance = float('inf')
-        target_point = np.array([320, 240])
+        target_point = np.array([image_shape[1] / 2, image_shape[0] / 2])
 
         for i, keypoint in enumerate(keypoints):
             point = np.array(keypoint.pt)
@@ -465,11 +857,5 @@ class Taxy_Server_Detection_Manager:
         return closest_index
 
     def adjust_gamma(self, image, gamma=1.2):
-        # build a lookup table mapping the pixel values [0, 255] to
-        # their adjusted gamma values
-        invGamma = 1.0 / gamma
-        table = np.array([((i / 255.0) ** invGamma) * 255
-            for i in np.arange(0, 256)]).astype( 'uint8' )
-        # apply gamma correction using the lookup table
-        return cv2.LUT(image, table)
-
+        # apply gamma correction using the cached lookup table
+        return cv2.LUT(image, _gamma_table(gamma))
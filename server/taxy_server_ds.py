@@ -0,0 +1,645 @@
+import os, time, threading, hashlib, contextlib, collections, cv2, numpy as np
+from concurrent.futures import ThreadPoolExecutor, Future
+try:
+    from nozzle_detector import NozzleDetector, RuntimeConfig, read_input_shape, input_layout
+    YOLO_AVAILABLE = True
+except ImportError:
+    YOLO_AVAILABLE = False
+
+# Size of the frame used for the warmup inference (same as the camera frames)
+_WARMUP_FRAME_WIDTH = 1280
+_WARMUP_FRAME_HEIGHT = 720
+
+# Number of recent inferences used for the reported latency statistics
+_LATENCY_WINDOW = 100
+
+# Model file extensions the detector can load
+_MODEL_EXTENSIONS = ('.tflite', '.onnx')
+
+# Blob detection cascade: (algorithm number, detector attribute, preprocessor, keypoint color).
+# The list order is the default order; it is reordered per tool by recent success rate.
+BLOB_STAGES = (
+    (1, 'detector', 0, (0,0,255)),
+    (2, 'detector', 1, (0,255,0)),
+    (3, 'relaxedDetector', 0, (255,0,0)),
+    (4, 'relaxedDetector', 1, (39,127,255)),
+    (5, 'superRelaxedDetector', 2, (39,255,127)),
+)
+
+# Weight of the latest outcome in the per-tool success rate of a blob stage
+_BLOB_STAGE_SMOOTHING = 0.2
+# Success rate a stage starts from before it was tried for a tool
+_BLOB_STAGE_PRIOR = 0.5
+
+class Taxy_Server_Model_Registry:
+    """
+    Lists the model files available to the server with their metadata (format, size, hash, input size).
+    Metadata is cached per file and only recomputed when the file changes. The input size of a model
+    that is not loaded is read from its graph, without creating an inference session.
+    """
+    def __init__(self, log, model_dir='.'):
+        self.log = log
+        self.model_dir = model_dir
+        # name -> (mtime, size, metadata)
+        self.__cache = dict()
+        self.__lock = threading.Lock()
+
+    def names(self):
+        return sorted(f for f in os.listdir(self.model_dir) if f.endswith(_MODEL_EXTENSIONS))
+
+    def path(self, name):
+        # Only plain file names inside the model directory can be selected
+        if name is None or os.path.basename(name) != name or not name.endswith(_MODEL_EXTENSIONS):
+            raise ValueError("Invalid model name: %s" % str(name))
+        path = os.path.join(self.model_dir, name)
+        if not os.path.isfile(path):
+            raise ValueError("Model not found: %s" % name)
+        return path
+
+    # Prefer tflite, then onnx
+    def default_model(self):
+        names = self.names()
+        tflite_models = [f for f in names if f.endswith('.tflite')]
+        onnx_models = [f for f in names if f.endswith('.onnx')]
+
+        if tflite_models:
+            return tflite_models[0]
+        elif onnx_models:
+            return onnx_models[0]
+        return None
+
+    def list_models(self):
+        models = []
+        for name in self.names():
+            try:
+                models.append(self.metadata(name))
+            except Exception as e:
+                self.log(f"*** Could not read model metadata for {name}: {e}")
+        return models
+
+    # detector: the loaded detector of the model, its input size replaces the one read from the
+    # graph (dynamic axes then report the runtime's nominal size instead of None)
+    def metadata(self, name, detector=None):
+        path = self.path(name)
+        stat = os.stat(path)
+        with self.__lock:
+            cached = self.__cache.get(name)
+        if cached is not None and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+            metadata = cached[2]
+        else:
+            metadata = self.__read_metadata(name, path, stat)
+            with self.__lock:
+                self.__cache[name] = (stat.st_mtime, stat.st_size, metadata)
+
+        if detector is not None:
+            metadata = dict(metadata,
+                input_width=int(detector.input_width),
+                input_height=int(detector.input_height),
+                dynamic_input=bool(detector.dynamic_input))
+        return metadata
+
+    def __read_metadata(self, name, path, stat):
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha256.update(block)
+
+        height = width = dynamic = None
+        if YOLO_AVAILABLE:
+            shape = read_input_shape(path)
+            height, width = (shape[1], shape[2]) if input_layout(shape) == 'NHWC' else (shape[2], shape[3])
+            dynamic = height is None or width is None
+        return {
+            "name": name,
+            "format": os.path.splitext(name)[1].lower().lstrip('.'),
+            "size_bytes": stat.st_size,
+            "sha256": sha256.hexdigest(),
+            "input_width": width,
+            "input_height": height,
+            "dynamic_input": dynamic,
+        }
+
+class _Loaded_Model:
+    """
+    A loaded detector plus the number of detections currently running on it.
+    A replaced model is only closed once its last in-flight detection has finished.
+    """
+    def __init__(self, name, detector, metadata):
+        self.name = name
+        self.detector = detector
+        self.metadata = metadata
+        self.in_flight = 0
+        self.retired = False
+
+    def release(self):
+        self.detector.close()
+
+class _Blob_Pool:
+    """
+    The thread pool of the parallel blob cascade plus the number of cascades currently using it.
+    A replaced pool is only shut down once its last cascade has finished submitting to it.
+    """
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="blob")
+        self.in_flight = 0
+        self.retired = False
+
+    def release(self):
+        # Stages still running after their cascade returned finish in the background
+        self.executor.shutdown(wait=False)
+
+class Taxy_Server_Inference_Pool:
+    """
+    Runs the inferences of all server contexts (one per camera/printer) on a fixed number of
+    worker threads. Every context has its own queue and the workers serve the contexts in turn,
+    so a context sending a burst of frames cannot hold up the others.
+    """
+    def __init__(self, workers=1, thread_initializer=None):
+        self.workers = workers
+        self.__thread_initializer = thread_initializer
+        # context -> deque of pending (future, function, args), in serving order
+        self.__queues = collections.OrderedDict()
+        self.__condition = threading.Condition()
+        self.__threads = []
+        # context -> number of jobs run
+        self.served = collections.Counter()
+
+    def configure(self, workers):
+        if isinstance(workers, bool) or not isinstance(workers, int) or workers < 1:
+            raise ValueError("inference_workers must be a positive integer")
+        with self.__condition:
+            self.workers = workers
+            # Surplus workers exit once they are idle
+            self.__condition.notify_all()
+
+    # Queue function(*args) for a context and return its Future
+    def submit(self, context, function, *args):
+        future = Future()
+        with self.__condition:
+            self.__queues.setdefault(context, collections.deque()).append((future, function, args))
+            if len(self.__threads) < self.workers:
+                thread = threading.Thread(target=self.__work, name="inference-%i" % len(self.__threads), daemon=True)
+                self.__threads.append(thread)
+                thread.start()
+            self.__condition.notify()
+        return future
+
+    def run(self, context, function, *args):
+        return self.submit(context, function, *args).result()
+
+    # Next job of the first context with pending work, that context then goes to the back of the line
+    def __next_job(self):
+        for context, queue in self.__queues.items():
+            job = queue.popleft()
+            if queue:
+                self.__queues.move_to_end(context)
+            else:
+                del self.__queues[context]
+            self.served[context] += 1
+            return job
+        return None
+
+    def __work(self):
+        if self.__thread_initializer is not None:
+            self.__thread_initializer()
+        while True:
+            with self.__condition:
+                while not self.__queues and len(self.__threads) <= self.workers:
+                    self.__condition.wait()
+                if len(self.__threads) > self.workers:
+                    self.__threads.remove(threading.current_thread())
+                    return
+                future, function, args = self.__next_job()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def status(self):
+        with self.__condition:
+            return {
+                "workers": self.workers,
+                "queued": {str(context): len(queue) for context, queue in self.__queues.items()},
+                "served": {str(context): count for context, count in self.served.items()},
+            }
+
+class Taxy_Server_Detection_Service:
+    """
+    Long-lived holder of the loaded AI model and the blob detectors.
+    Created once at server startup and shared by all detection managers,
+    so a detection request goes straight to inference instead of reloading the model.
+    """
+    def __init__(self, log, conf_thres=0.5, model_dir='.', runtime=None):
+        self.log = log
+        self.log('*** calling DetectionService.__init__')
+
+        self.conf_thres = conf_thres
+        # Inference runtime settings (threads, graph optimization, CPU affinity, niceness)
+        self.runtime = runtime if runtime is not None else (RuntimeConfig() if YOLO_AVAILABLE else None)
+        # Threads that already got the runtime's CPU affinity and niceness
+        self.__thread_policy = threading.local()
+        # Recent (inference, postprocess) times in ms
+        self.__latencies = collections.deque(maxlen=_LATENCY_WINDOW)
+        self.registry = Taxy_Server_Model_Registry(log, model_dir)
+        self.warmup_time = None
+        self.error = None
+
+        # The model used by new detections, swapped atomically by select_model
+        self.__model = None
+        self.__model_lock = threading.Lock()
+
+        # Set when loading and warmup are done, even if no model was found.
+        self.__ready = threading.Event()
+        # Serializes initial load and model swaps
+        self.__load_lock = threading.Lock()
+
+        # (context, tool) -> {algorithm number: recent success rate} of the blob cascade stages
+        self.__blob_stage_rates = dict()
+        self.__blob_stage_lock = threading.Lock()
+        # Threads running the blob cascade stages concurrently, None runs them one after another
+        self.blob_workers = 0
+        self.__blob_pool = None
+        # Worker threads running the inferences of all contexts in turn
+        self.inference_pool = Taxy_Server_Inference_Pool(thread_initializer=self.__apply_thread_policy)
+
+        # TAMV has 2 detectors, one for standard and one for relaxed
+        self.createDetectors()
+
+        self.log('*** exiting DetectionService.__init__')
+
+    @property
+    def ready(self):
+        return self.__ready.is_set()
+
+    def wait_ready(self, timeout=None):
+        return self.__ready.wait(timeout)
+
+    # Load the model in a background thread so the server can answer requests meanwhile
+    def start(self):
+        thread = threading.Thread(target=self.load, daemon=True)
+        thread.start()
+        return thread
+
+    def load(self):
+        with self.__load_lock:
+            if self.ready:
+                return
+            try:
+                if YOLO_AVAILABLE:
+                    name = self.registry.default_model()
+                    if name:
+                        self.__swap(self.__load_model(name))
+                    else:
+                        self.log("*** No .tflite or .onnx model found. Falling back to Blob Detector.")
+            except Exception as e:
+                self.error = str(e)
+                self.log(f"*** Failed to load AI Model: {e}")
+            finally:
+                self.__ready.set()
+
+    # Load another model and hot-swap it in. In-flight detections finish on the old model.
+    def select_model(self, name):
+        if not YOLO_AVAILABLE:
+            raise ValueError("AI detection is not available, install onnxruntime or tflite-runtime")
+        # Validate before taking the lock so a bad name fails fast
+        self.registry.path(name)
+        with self.__load_lock:
+            if self.model_name == name:
+                return self.__model.metadata
+            loaded = self.__load_model(name)
+            self.__swap(loaded)
+            self.error = None
+            self.__ready.set()
+            return loaded.metadata
+
+    # Change the runtime settings and reload the current model with them
+    def configure_runtime(self, data):
+        if not YOLO_AVAILABLE:
+            raise ValueError("AI detection is not available, install onnxruntime or tflite-runtime")
+        with self.__load_lock:
+            runtime = RuntimeConfig.from_dict(data, self.runtime)
+            if runtime == self.runtime:
+                return self.runtime.to_dict()
+            self.log(f"*** Changing inference runtime to {runtime.to_dict()}")
+            previous, self.runtime = self.runtime, runtime
+            if self.model_name is not None:
+                try:
+                    loaded = self.__load_model(self.model_name)
+                except Exception:
+                    # The current model keeps running with the settings it was loaded with
+                    self.runtime = previous
+                    raise
+                self.__swap(loaded)
+                self.__latencies.clear()
+            return self.runtime.to_dict()
+
+    # Raises ValueError for settings that configure_blob_workers, inference_pool.configure,
+    # configure_runtime or select_model would reject, without applying any of them
+    def validate_settings(self, blob_workers=None, inference_workers=None, runtime=None, model=None):
+        if blob_workers is not None and (isinstance(blob_workers, bool) or not isinstance(blob_workers, int) or blob_workers < 0):
+            raise ValueError("blob_workers must be a non-negative integer")
+        if inference_workers is not None and (isinstance(inference_workers, bool) or not isinstance(inference_workers, int) or inference_workers < 1):
+            raise ValueError("inference_workers must be a positive integer")
+        if (runtime or model) and not YOLO_AVAILABLE:
+            raise ValueError("AI detection is not available, install onnxruntime or tflite-runtime")
+        if runtime:
+            RuntimeConfig.from_dict(runtime, self.runtime)
+        if model:
+            self.registry.path(model)
+
+    # The model is loaded in a dedicated thread: the runtime's worker threads inherit
+    # its CPU affinity and niceness, and the calling request thread is left untouched.
+    def __load_model(self, name):
+        result = dict()
+
+        def _load():
+            try:
+                self.__apply_thread_policy()
+                path = self.registry.path(name)
+                self.log(f"*** Loading AI Model: {path}")
+                detector = NozzleDetector(path, conf_thres=self.conf_thres, runtime=self.runtime)
+                self.log(f"*** AI Model loaded successfully (conf_thres={self.conf_thres}).")
+                metadata = self.registry.metadata(name, detector)
+                self.warmup(detector)
+                result["loaded"] = _Loaded_Model(name, detector, metadata)
+            except Exception as e:
+                result["error"] = e
+
+        thread = threading.Thread(target=_load, daemon=True)
+        thread.start()
+        thread.join()
+        if "error" in result:
+            raise result["error"]
+        return result["loaded"]
+
+    def __apply_thread_policy(self):
+        runtime = self.runtime
+        if runtime is None or getattr(self.__thread_policy, "runtime", None) is runtime:
+            return
+        self.__thread_policy.runtime = runtime
+        try:
+            runtime.apply_to_current_thread()
+        except OSError as e:
+            self.log(f"*** Could not apply CPU affinity/niceness: {e}")
+
+    # Run the current model on one image. Returns (results, inference_time, postprocess_time),
+    # or None when no model is loaded. context is the server context (camera) queueing the inference.
+    def infer(self, image, context=None):
+        return self.inference_pool.run(context, self.__infer, image)
+
+    # Run the current model on a burst of frames in one batched run when the model allows it.
+    # Returns ([results per frame], inference_time, postprocess_time), or None when no model is loaded.
+    def infer_batch(self, frames, context=None):
+        return self.inference_pool.run(context, self.__infer_batch, frames)
+
+    def __infer(self, image):
+        with self.acquire_detector() as detector:
+            if detector is None:
+                return None
+            self.__apply_thread_policy()
+            results, inference_time, postprocess_time = detector.infer(image)
+        self.__latencies.append((inference_time, postprocess_time))
+        return results, inference_time, postprocess_time
+
+    def __infer_batch(self, frames):
+        with self.acquire_detector() as detector:
+            if detector is None:
+                return None
+            self.__apply_thread_policy()
+            batch_results, inference_time, postprocess_time = detector.infer_batch(frames)
+        if frames:
+            # Keep the latency statistics per frame
+            self.__latencies.append((inference_time / len(frames), postprocess_time / len(frames)))
+        return batch_results, inference_time, postprocess_time
+
+    def latency_stats(self):
+        latencies = np.array(self.__latencies, dtype=np.float64)
+        if latencies.size == 0:
+            return {"samples": 0}
+        return {
+            "samples": int(latencies.shape[0]),
+            "last_ms": float(latencies[-1, 0]),
+            "mean_ms": float(latencies[:, 0].mean()),
+            "p50_ms": float(np.percentile(latencies[:, 0], 50)),
+            "p95_ms": float(np.percentile(latencies[:, 0], 95)),
+            "postprocess_mean_ms": float(latencies[:, 1].mean()),
+        }
+
+    # Blob cascade stages for a tool, most successful first. Stages with the same rate keep
+    # their default order, so a tool without history runs the cascade as listed in BLOB_STAGES.
+    # The success rates are kept per server context and tool: each camera has its own lighting,
+    # so one printer's history does not reorder the cascade of another
+    def blob_stages(self, tool=None, context=None):
+        with self.__blob_stage_lock:
+            rates = self.__blob_stage_rates.get((context, tool), {})
+            return sorted(BLOB_STAGES, key=lambda stage: -rates.get(stage[0], _BLOB_STAGE_PRIOR))
+
+    def record_blob_stage(self, tool, algorithm, success, context=None):
+        with self.__blob_stage_lock:
+            rates = self.__blob_stage_rates.setdefault((context, tool), {})
+            rate = rates.get(algorithm, _BLOB_STAGE_PRIOR)
+            rates[algorithm] = rate + _BLOB_STAGE_SMOOTHING * ((1.0 if success else 0.0) - rate)
+
+    # Number of threads running the blob cascade stages concurrently; 0 or 1 runs them in order
+    def configure_blob_workers(self, workers):
+        if isinstance(workers, bool) or not isinstance(workers, int) or workers < 0:
+            raise ValueError("blob_workers must be a non-negative integer")
+        with self.__blob_stage_lock:
+            if workers == self.blob_workers:
+                return
+            old = self.__blob_pool
+            self.__blob_pool = _Blob_Pool(workers) if workers > 1 else None
+            self.blob_workers = workers
+            if old is not None:
+                old.retired = True
+                release_old = old.in_flight == 0
+        if old is not None and release_old:
+            old.release()
+
+    # Use the blob thread pool for one cascade, keeping it alive until the cascade is done.
+    # Yields None when the stages run one after another.
+    @contextlib.contextmanager
+    def acquire_blob_executor(self):
+        with self.__blob_stage_lock:
+            pool = self.__blob_pool
+            if pool is not None:
+                pool.in_flight += 1
+        if pool is None:
+            yield None
+            return
+        try:
+            yield pool.executor
+        finally:
+            with self.__blob_stage_lock:
+                pool.in_flight -= 1
+                release = pool.retired and pool.in_flight == 0
+            if release:
+                pool.release()
+
+    def blob_stage_stats(self):
+        with self.__blob_stage_lock:
+            stats = dict()
+            for (context, tool), rates in self.__blob_stage_rates.items():
+                stats.setdefault(str(context), {})[str(tool)] = dict(rates)
+            return stats
+
+    def __swap(self, loaded):
+        with self.__model_lock:
+            old = self.__model
+            self.__model = loaded
+            if old is not None:
+                old.retired = True
+                release_old = old.in_flight == 0
+        if old is not None:
+            self.log(f"*** Switched AI Model from {old.name} to {loaded.name}")
+            if release_old:
+                old.release()
+
+    # Use the current model for one detection, keeping it alive until the detection is done.
+    # Yields None when no model is loaded.
+    @contextlib.contextmanager
+    def acquire_detector(self):
+        with self.__model_lock:
+            loaded = self.__model
+            if loaded is not None:
+                loaded.in_flight += 1
+        if loaded is None:
+            yield None
+            return
+        try:
+            yield loaded.detector
+        finally:
+            with self.__model_lock:
+                loaded.in_flight -= 1
+                release = loaded.retired and loaded.in_flight == 0
+            if release:
+                loaded.release()
+
+    @property
+    def yolo_detector(self):
+        loaded = self.__model
+        return loaded.detector if loaded is not None else None
+
+    # Crop size (height, width) the current model takes without rescaling, None when no model is loaded
+    def native_input_size(self):
+        detector = self.yolo_detector
+        if detector is None:
+            return None
+        if detector.dynamic_input:
+            size = detector.runtime.dynamic_input_size
+            return detector.input_geometry(size, size)
+        return int(detector.input_height), int(detector.input_width)
+
+    @property
+    def model_name(self):
+        loaded = self.__model
+        return loaded.name if loaded is not None else None
+
+    # Run one inference on a blank frame so the first real request does not pay for lazy initialization
+    def warmup(self, detector):
+        frame = np.zeros((_WARMUP_FRAME_HEIGHT, _WARMUP_FRAME_WIDTH, 3), dtype=np.uint8)
+        start_time = time.time()
+        detector.infer(frame)
+        self.warmup_time = (time.time() - start_time) * 1000
+        self.log(f"*** AI Model warmup done in {self.warmup_time:.0f}ms")
+
+    def status(self):
+        loaded = self.__model
+        return {
+            "ready": self.ready,
+            "model": loaded.name if loaded is not None else None,
+            "model_loaded": loaded is not None,
+            "model_metadata": loaded.metadata if loaded is not None else None,
+            "warmup_time": self.warmup_time,
+            "runtime": loaded.detector.runtime_info() if loaded is not None else (self.runtime.to_dict() if self.runtime is not None else None),
+            "latency": self.latency_stats(),
+            "blob_stages": self.blob_stage_stats(),
+            "blob_workers": self.blob_workers,
+            "inference_pool": self.inference_pool.status(),
+            "error": self.error,
+        }
+
+    def createDetectors(self):
+        # Standard Parameters
+        if(True):
+            self.standardParams = cv2.SimpleBlobDetector_Params()
+            # Thresholds
+            self.standardParams.minThreshold = 1
+            self.standardParams.maxThreshold = 50
+            self.standardParams.thresholdStep = 1
+            # Area
+            self.standardParams.filterByArea = True
+            self.standardParams.minArea = 400
+            self.standardParams.maxArea = 900
+            # Circularity
+            self.standardParams.filterByCircularity = True
+            self.standardParams.minCircularity = 0.8
+            self.standardParams.maxCircularity= 1
+            # Convexity
+            self.standardParams.filterByConvexity = True
+            self.standardParams.minConvexity = 0.3
+            self.standardParams.maxConvexity = 1
+            # Inertia
+            self.standardParams.filterByInertia = True
+            self.standardParams.minInertiaRatio = 0.3
+
+        # Relaxed Parameters
+        if(True):
+            self.relaxedParams = cv2.SimpleBlobDetector_Params()
+            # Thresholds
+            self.relaxedParams.minThreshold = 1
+            self.relaxedParams.maxThreshold = 50
+            self.relaxedParams.thresholdStep = 1
+            # Area
+            self.relaxedParams.filterByArea = True
+            self.relaxedParams.minArea = 600
+            self.relaxedParams.maxArea = 15000
+            # Circularity
+            self.relaxedParams.filterByCircularity = True
+            self.relaxedParams.minCircularity = 0.6
+            self.relaxedParams.maxCircularity= 1
+            # Convexity
+            self.relaxedParams.filterByConvexity = True
+            self.relaxedParams.minConvexity = 0.1
+            self.relaxedParams.maxConvexity = 1
+            # Inertia
+            self.relaxedParams.filterByInertia = True
+            self.relaxedParams.minInertiaRatio = 0.3
+
+        # Super Relaxed Parameters
+            t1=20
+            t2=200
+            all=0.5
+            area=200
+
+            self.superRelaxedParams = cv2.SimpleBlobDetector_Params()
+
+            self.superRelaxedParams.minThreshold = t1
+            self.superRelaxedParams.maxThreshold = t2
+
+            self.superRelaxedParams.filterByArea = True
+            self.superRelaxedParams.minArea = area
+
+            self.superRelaxedParams.filterByCircularity = True
+            self.superRelaxedParams.minCircularity = all
+
+            self.superRelaxedParams.filterByConvexity = True
+            self.superRelaxedParams.minConvexity = all
+
+            self.superRelaxedParams.filterByInertia = True
+            self.superRelaxedParams.minInertiaRatio = all
+
+            self.superRelaxedParams.filterByColor = False
+
+            self.superRelaxedParams.minDistBetweenBlobs = 2
+
+        # Create 3 detectors
+        self.detector = cv2.SimpleBlobDetector_create(self.standardParams)
+        self.relaxedDetector = cv2.SimpleBlobDetector_create(self.relaxedParams)
+        self.superRelaxedDetector = cv2.SimpleBlobDetector_create(self.superRelaxedParams)
+
+        # One detector per cascade stage, so stages sharing parameters can run concurrently
+        params = {'detector': self.standardParams, 'relaxedDetector': self.relaxedParams, 'superRelaxedDetector': self.superRelaxedParams}
+        self.stageDetectors = {algorithm: cv2.SimpleBlobDetector_create(params[name]) for algorithm, name, _, _ in BLOB_STAGES}
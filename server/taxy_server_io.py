@@ -1,22 +1,571 @@
-import cv2, numpy as np
+import cv2, time, threading, collections, atexit, numpy as np
 import requests
 from requests.exceptions import InvalidURL, ConnectionError # , HTTPError, RequestException
 
 import os
 import json
+from dataclasses import dataclass
 from datetime import datetime
+from taxy_server_dataset import Taxy_Server_Dataset_Store, FILTERS
 
 # Size of frame to use (1280x720 for better detection accuracy)
 _FRAME_WIDTH = 1280
 _FRAME_HEIGHT = 720
- 
+
+# Thumbnail used to fingerprint frames for the motion settle check
+_THUMBNAIL_WIDTH = 128
+_THUMBNAIL_HEIGHT = 72
+
+# Webcam servers like Crowsnest return the same cached JPEG for a while. A frame with the same bytes
+# as the previous one is dropped and fetched again once the camera's next frame is due, at most
+# _STALE_MAX_RETRIES times. A repeated frame older than _STALE_CACHE_FACTOR camera frame intervals
+# is outside any cache window (a static scene), it is returned right away.
+# The frame interval is measured from the repeats, starting from _STALE_DEFAULT_INTERVAL and kept
+# between _STALE_RETRY_INTERVAL and _STALE_TIMEOUT seconds.
+_STALE_TIMEOUT = 1.0
+_STALE_RETRY_INTERVAL = 0.02
+_STALE_DEFAULT_INTERVAL = 0.1
+_STALE_MAX_RETRIES = 3
+_STALE_CACHE_FACTOR = 2
+
+# Bytes read from the camera response per chunk; a 1280x720 snapshot is typically 100-300KB
+READ_CHUNK_SIZE = 64 * 1024
+
+# Stream grabber: frames kept in the ring buffer, reconnect backoff (doubling from min to max seconds),
+# connect/read timeouts, how long a reader waits for a newer frame, and idle seconds after which
+# the connection is closed until the next read
+_GRABBER_BUFFER_SIZE = 4
+_GRABBER_BACKOFF_MIN = 0.5
+_GRABBER_BACKOFF_MAX = 10.0
+_GRABBER_TIMEOUT = (3.0, 5.0)
+_GRABBER_FRAME_TIMEOUT = 2.0
+_GRABBER_IDLE_TIMEOUT = 60.0
+
+# JPEG markers: start of image, end of image, start of scan
+_SOI = b'\xff\xd8'
+_EOI = b'\xff\xd9'
+_SOS = 0xda
+# Start of frame markers (holding the image size): SOF0-SOF15 except DHT, JPG and DAC
+_SOF_MARKERS = set(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+
+# DCT-domain scaled decodes, largest reduction first
+_REDUCED_DECODES = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+# Motion settle: mean absolute difference (gray levels) between the thumbnails of consecutive frames
+# below which the image is still, how many consecutive still frames are needed, and how long to
+# wait for it before measuring anyway
+SETTLE_THRESHOLD = 1.0
+_SETTLE_FRAMES = 2
+_SETTLE_TIMEOUT = 3.0
+
+# Training frames waiting to be written; when full the oldest one is dropped (about 2.7MB per 1280x720 frame)
+_TRAINING_QUEUE_SIZE = 8
+# Number of recent writes used for the reported write latency
+_TRAINING_LATENCY_WINDOW = 100
+# Seconds to finish writing the queued frames at exit
+_TRAINING_FLUSH_TIMEOUT = 5.0
+# How training frames are stored: one .jpg/.json pair per frame, or the deduplicated dataset store
+TRAINING_STORES = ("files", "archive")
+
+class Frame_Motion_Monitor:
+    """
+    Tells when the image has stopped moving (e.g. the toolhead vibrating after a move) by comparing
+    small grayscale thumbnails of consecutive frames.
+    """
+    def __init__(self, threshold=SETTLE_THRESHOLD, frames=_SETTLE_FRAMES, timeout=_SETTLE_TIMEOUT):
+        self.threshold = threshold
+        self.frames = frames
+        self.timeout = timeout
+        self.start_time = time.time()
+        # Seconds from the start until the image settled, None while it is moving
+        self.settle_time = None
+        self.timed_out = False
+        self.difference = None
+        self.__still_frames = 0
+        self.__thumbnail = None
+
+    @property
+    def settled(self):
+        return self.settle_time is not None
+
+    # Feeds the next frame, returns True once the image has settled.
+    # A frame that cannot be decoded is skipped, it only counts toward the timeout.
+    def update(self, frame):
+        if self.settled:
+            return True
+        if isinstance(frame, Camera_Frame):
+            frame = frame.reduced(_THUMBNAIL_HEIGHT, _THUMBNAIL_WIDTH)[0]
+        if frame is not None:
+            thumbnail = cv2.cvtColor(cv2.resize(frame, (_THUMBNAIL_WIDTH, _THUMBNAIL_HEIGHT), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+            if self.__thumbnail is not None:
+                self.difference = float(cv2.norm(thumbnail, self.__thumbnail, cv2.NORM_L1)) / thumbnail.size
+                self.__still_frames = self.__still_frames + 1 if self.difference < self.threshold else 0
+            self.__thumbnail = thumbnail
+
+        elapsed = time.time() - self.start_time
+        if self.__still_frames >= self.frames:
+            self.settle_time = elapsed
+        elif elapsed >= self.timeout:
+            self.settle_time = elapsed
+            self.timed_out = True
+        return self.settled
+
+class Jpeg_Stream_Parser:
+    """
+    Extracts complete JPEG images from a byte stream fed in chunks, for single snapshots and
+    multipart MJPEG streams alike. Every byte is scanned once: the search resumes where the last
+    chunk ended. The headers are walked by their segment lengths, so an end marker inside
+    metadata (e.g. an EXIF thumbnail) does not cut the image short.
+    """
+    def __init__(self):
+        self.__buffer = bytearray()
+        # Offset of the start marker of the image being read, -1 while looking for one
+        self.__start = -1
+        # Where the search resumes
+        self.__position = 0
+        # Whether the position is in the entropy-coded data, where the next end marker ends the image
+        self.__in_scan = False
+
+    # Adds a chunk, returns the images it completed (usually none or one)
+    def feed(self, chunk):
+        self.__buffer += chunk
+        images = []
+        while self.__advance():
+            end = self.__position
+            images.append(bytes(self.__buffer[self.__start:end]))
+            del self.__buffer[:end]
+            self.__start, self.__position, self.__in_scan = -1, 0, False
+        return images
+
+    # Moves the search forward over the buffered bytes, True when an image is complete
+    def __advance(self):
+        buffer = self.__buffer
+        if self.__start < 0:
+            start = buffer.find(_SOI, self.__position)
+            if start < 0:
+                # Keep a trailing 0xff, it may be the first half of a start marker
+                del buffer[:max(0, len(buffer) - 1)]
+                self.__position = 0
+                return False
+            self.__start = start
+            self.__position = start + 2
+
+        while not self.__in_scan:
+            position = self.__position
+            if position + 4 > len(buffer):
+                return False
+            if buffer[position] != 0xff:
+                # Not a well-formed header, fall back to the first end marker
+                self.__in_scan = True
+                break
+            marker = buffer[position + 1]
+            if marker == 0xff:
+                # Fill byte
+                self.__position += 1
+                continue
+            if marker == 0xd9:
+                self.__position = position + 2
+                return True
+            self.__position = position + 2 + ((buffer[position + 2] << 8) | buffer[position + 3])
+            self.__in_scan = marker == _SOS
+
+        end = buffer.find(_EOI, self.__position)
+        if end < 0:
+            # The last byte may be the first half of the end marker
+            self.__position = max(self.__position, len(buffer) - 1)
+            return False
+        self.__position = end + 2
+        return True
+
+# Chunks of a streamed response. With urllib3 2 each chunk is whatever arrived, up to chunk_size,
+# so a large chunk size does not hold back a frame of a live MJPEG stream until the next one fills it.
+def iter_stream_chunks(response, chunk_size):
+    read1 = getattr(response.raw, 'read1', None)
+    if read1 is None or response.headers.get('Content-Encoding'):
+        yield from response.iter_content(chunk_size=chunk_size)
+        return
+    while True:
+        chunk = read1(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+# MJPEG stream URL of a snapshot URL: ?action=snapshot (mjpg-streamer/ustreamer) or a /snapshot path
+# (Crowsnest) become their stream counterparts, any other URL is used as it is
+def stream_url_for(camera_url):
+    if 'action=snapshot' in camera_url:
+        return camera_url.replace('action=snapshot', 'action=stream')
+    path, query = (camera_url.split('?', 1) + [None])[:2]
+    if path.rstrip('/').endswith('/snapshot'):
+        return path.rstrip('/')[:-len('snapshot')] + 'stream'
+    return camera_url
+
+@dataclass
+class Grabbed_Frame:
+    sequence: int       # increases by one for every frame received
+    timestamp: float    # time.time() when the frame had fully arrived
+    jpeg: bytes
+
+class Frame_Grabber:
+    """
+    Keeps one long-lived connection to the camera's MJPEG stream on a background thread and
+    holds the latest frames in a small ring buffer, tagged with their arrival time and a sequence
+    number. Readers take the newest frame, or wait for one newer than what they have, without an
+    HTTP request per frame. The connection is re-established with exponential backoff, and closed
+    while nobody reads frames.
+    """
+    def __init__(self, log, stream_url, chunk_size=READ_CHUNK_SIZE, capacity=_GRABBER_BUFFER_SIZE):
+        self.log = log
+        self.stream_url = stream_url
+        self.chunk_size = chunk_size
+        self.__frames = collections.deque(maxlen=capacity)
+        self.__condition = threading.Condition()
+        self.__sequence = 0
+        self.__thread = None
+        self.__stopped = False
+        self.__last_read = time.time()
+        self.connected = False
+        self.reconnects = 0
+        self.error = None
+
+    def __start(self):
+        # Called with the condition held
+        if self.__thread is None and not self.__stopped:
+            self.__thread = threading.Thread(target=self.__run, name="frame-grabber", daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify_all()
+
+    # The newest frame, None when none has arrived yet
+    def latest(self):
+        with self.__condition:
+            self.__last_read = time.time()
+            self.__start()
+            return self.__frames[-1] if self.__frames else None
+
+    # Wait for a frame with a higher sequence number than after_sequence that arrived after
+    # after_time, and return the newest such frame. None on timeout or when the grabber is stopped.
+    def wait_newer(self, after_sequence=0, after_time=0.0, timeout=_GRABBER_FRAME_TIMEOUT):
+        def newer():
+            frame = self.__frames[-1] if self.__frames else None
+            return frame is not None and frame.sequence > after_sequence and frame.timestamp > after_time
+        with self.__condition:
+            self.__last_read = time.time()
+            self.__start()
+            if not self.__condition.wait_for(lambda: self.__stopped or newer(), timeout) or self.__stopped:
+                return None
+            self.__last_read = time.time()
+            return self.__frames[-1]
+
+    def __idle(self):
+        return time.time() - self.__last_read > _GRABBER_IDLE_TIMEOUT
+
+    def __run(self):
+        backoff = _GRABBER_BACKOFF_MIN
+        session = requests.Session()
+        try:
+            while not self.__stopped and not self.__idle():
+                try:
+                    with session.get(self.stream_url, stream=True, timeout=_GRABBER_TIMEOUT) as stream:
+                        stream.raise_for_status()
+                        self.connected = True
+                        parser = Jpeg_Stream_Parser()
+                        for chunk in iter_stream_chunks(stream, self.chunk_size):
+                            for jpeg in parser.feed(chunk):
+                                self.__put(jpeg)
+                                backoff = _GRABBER_BACKOFF_MIN
+                            if self.__stopped or self.__idle():
+                                return
+                    self.error = "stream ended"
+                except Exception as e:
+                    self.error = str(e)
+                self.connected = False
+                self.reconnects += 1
+                self.log("Camera stream %s lost (%s), reconnecting in %.1fs" % (self.stream_url, self.error, backoff))
+                with self.__condition:
+                    self.__condition.wait_for(lambda: self.__stopped, backoff)
+                backoff = min(backoff * 2, _GRABBER_BACKOFF_MAX)
+        finally:
+            session.close()
+            self.connected = False
+            with self.__condition:
+                self.__thread = None
+                # A read that came in while the thread was ending starts a new one
+                if not self.__stopped and not self.__idle():
+                    self.__start()
+
+    def __put(self, jpeg):
+        with self.__condition:
+            self.__sequence += 1
+            self.__frames.append(Grabbed_Frame(self.__sequence, time.time(), jpeg))
+            self.__condition.notify_all()
+
+    def status(self):
+        with self.__condition:
+            latest = self.__frames[-1] if self.__frames else None
+        return {
+            "stream_url": self.stream_url,
+            "connected": self.connected,
+            "frames": latest.sequence if latest is not None else 0,
+            "last_frame_age": time.time() - latest.timestamp if latest is not None else None,
+            "reconnects": self.reconnects,
+            "error": self.error,
+        }
+
+# (height, width) of a JPEG from its start of frame header, None if it cannot be found
+def jpeg_size(jpeg):
+    position = 2
+    while position + 9 <= len(jpeg):
+        if jpeg[position] != 0xff:
+            return None
+        marker = jpeg[position + 1]
+        if marker == 0xff:
+            position += 1
+            continue
+        if marker in _SOF_MARKERS:
+            return (jpeg[position + 5] << 8) | jpeg[position + 6], (jpeg[position + 7] << 8) | jpeg[position + 8]
+        if marker == _SOS:
+            return None
+        position += 2 + ((jpeg[position + 2] << 8) | jpeg[position + 3])
+    return None
+
+class Camera_Frame:
+    """
+    A camera frame kept as received and decoded only as far as it is used. image is the full
+    frame at _FRAME_WIDTH x _FRAME_HEIGHT (blob detection, ROI refinement, shown image, training images);
+    reduced() is a DCT-domain scaled decode just large enough for a given size (inference, motion
+    check), without a full-resolution decode or resize. Both are decoded once and cached.
+    """
+    # The full frame is always resized to this shape
+    shape = (_FRAME_HEIGHT, _FRAME_WIDTH, 3)
+
+    def __init__(self, jpeg):
+        self.jpeg = jpeg
+        self.__image = None
+        self.__reduced = dict()
+
+    @property
+    def image(self):
+        if self.__image is None:
+            self.__image = decode_frame(self.jpeg)
+        return self.__image
+
+    # Decode at least height x width after fitting the frame's aspect ratio into it.
+    # Returns (image, (x scale, y scale)) mapping its pixels to full frame pixels, or (None, None).
+    def reduced(self, height, width):
+        if self.__image is not None:
+            return self.__image, (1.0, 1.0)
+        size = jpeg_size(self.jpeg)
+        flag = cv2.IMREAD_COLOR
+        if size is not None:
+            source_h, source_w = size
+            # The letterbox scales the camera image by this factor, a reduction may not go below it
+            fit = min(width / source_w, height / source_h)
+            for factor, reduced_flag in _REDUCED_DECODES:
+                if factor * fit <= 1:
+                    flag = reduced_flag
+                    break
+        if flag == cv2.IMREAD_COLOR:
+            # No reduction is small enough, the full frame is the closest
+            image = self.image
+            return (image, (1.0, 1.0)) if image is not None else (None, None)
+        image = self.__reduced.get(flag)
+        if image is None:
+            image = cv2.imdecode(np.frombuffer(self.jpeg, dtype=np.uint8), flag)
+            if image is None:
+                return None, None
+            self.__reduced[flag] = image
+        return image, (_FRAME_WIDTH / image.shape[1], _FRAME_HEIGHT / image.shape[0])
+
+# Full frame (ndarray) of a Camera_Frame, other frames as they are
+def frame_image(frame):
+    return frame.image if isinstance(frame, Camera_Frame) else frame
+
+# Decodes a JPEG to a _FRAME_WIDTH x _FRAME_HEIGHT BGR frame, None on failure
+def decode_frame(jpg):
+    if jpg is None:
+        return None
+    # Read the image from the byte array with OpenCV
+    image = cv2.imdecode(np.frombuffer(jpg, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return None
+    if image.shape[:2] == (_FRAME_HEIGHT, _FRAME_WIDTH):
+        return image
+    return cv2.resize(image, (_FRAME_WIDTH, _FRAME_HEIGHT), interpolation=cv2.INTER_AREA)
+
+class Training_Image_Writer:
+    """
+    Writes the training frames and their metadata in a background thread, so a slow SD card
+    never stalls a measurement. The queue is bounded: when it is full the oldest frame is dropped.
+    Frames go to loose .jpg/.json files or, with the "archive" store, to a Taxy_Server_Dataset_Store.
+    """
+    def __init__(self, log, capacity=_TRAINING_QUEUE_SIZE):
+        self.log = log
+        self.store = "files"
+        self.filter = "all"
+        # storage directory -> Taxy_Server_Dataset_Store, opened on first use
+        self.__stores = dict()
+        self.__queue = collections.deque(maxlen=capacity)
+        self.__condition = threading.Condition()
+        self.__writing = False
+        self.__latencies = collections.deque(maxlen=_TRAINING_LATENCY_WINDOW)
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.__thread = threading.Thread(target=self.__work, name="training-writer", daemon=True)
+        self.__thread.start()
+
+    # Raises ValueError for a store or filter configure would reject
+    @staticmethod
+    def validate(store=None, filter=None):
+        if store is not None and store not in TRAINING_STORES:
+            raise ValueError("training_store must be one of: " + ", ".join(TRAINING_STORES))
+        if filter is not None and filter not in FILTERS:
+            raise ValueError("training_filter must be one of: " + ", ".join(FILTERS))
+
+    def configure(self, store=None, filter=None):
+        self.validate(store, filter)
+        with self.__condition:
+            self.store = store if store is not None else self.store
+            self.filter = filter if filter is not None else self.filter
+            for dataset in self.__stores.values():
+                dataset.filter = self.filter
+
+    # Queue a frame and its metadata (see Taxy_Server_Io.save_frame_locally), returns at once
+    def submit(self, storage_dir, frame, metadata):
+        with self.__condition:
+            if len(self.__queue) == self.__queue.maxlen:
+                self.dropped += 1
+            self.__queue.append((storage_dir, frame, metadata))
+            self.max_depth = max(self.max_depth, len(self.__queue))
+            self.__condition.notify()
+
+    # Wait until the queued frames are written, False on timeout
+    def flush(self, timeout=None):
+        with self.__condition:
+            return self.__condition.wait_for(lambda: not self.__queue and not self.__writing, timeout)
+
+    def __work(self):
+        while True:
+            with self.__condition:
+                self.__condition.wait_for(lambda: self.__queue)
+                job = self.__queue.popleft()
+                self.__writing = True
+            start_time = time.time()
+            try:
+                image_path = self.__write(*job)
+                self.__latencies.append((time.time() - start_time) * 1000)
+                if image_path is not None:
+                    self.written += 1
+                    self.log(f' *** saved frame locally to {image_path} **** ')
+            except Exception as e:
+                self.failed += 1
+                self.log("Failed to save frame locally: %s" % str(e))
+            finally:
+                with self.__condition:
+                    self.__writing = False
+                    self.__condition.notify_all()
+
+    # Returns where the frame was written, None when the dataset store rejected it
+    def __write(self, storage_dir, frame, metadata):
+        frame = frame_image(frame)
+        if frame is None:
+            raise ValueError("could not decode the frame")
+        if self.store == "archive":
+            dataset = self.__stores.get(storage_dir)
+            if dataset is None:
+                dataset = self.__stores[storage_dir] = Taxy_Server_Dataset_Store(storage_dir, self.filter)
+            record = dataset.add(frame, metadata)
+            return None if record is None else "%s in %s" % (record["image_file"], record["shard"])
+
+        # Create storage directory if it doesn't exist
+        os.makedirs(storage_dir, exist_ok=True)
+
+        image_path = os.path.join(storage_dir, metadata['image_file'])
+        json_path = os.path.splitext(image_path)[0] + '.json'
+
+        ok, encoded = cv2.imencode('.jpg', frame)
+        if not ok:
+            raise ValueError("could not encode the frame")
+
+        # The image goes first: a .json is only there once its image is complete
+        self.__write_file(image_path, encoded.tobytes())
+        self.__write_file(json_path, json.dumps(metadata, indent=2).encode('utf-8'))
+        return image_path
+
+    # Write to a temporary file, sync it and rename it into place, so a power loss leaves no half-written file
+    @staticmethod
+    def __write_file(path, data):
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+    def status(self):
+        with self.__condition:
+            depth = len(self.__queue)
+        latencies = np.array(self.__latencies, dtype=np.float64)
+        status = {
+            "queued": depth,
+            "max_queued": self.max_depth,
+            "capacity": self.__queue.maxlen,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "store": self.store,
+        }
+        for dataset in list(self.__stores.values()):
+            status.setdefault("datasets", []).append(dataset.status())
+        if latencies.size:
+            status.update({
+                "write_ms_last": float(latencies[-1]),
+                "write_ms_mean": float(latencies.mean()),
+                "write_ms_p95": float(np.percentile(latencies, 95)),
+            })
+        return status
+
+# The writer shared by all detections, started on first use
+_training_writer = None
+_training_writer_lock = threading.Lock()
+
+def get_training_writer(log=print):
+    global _training_writer
+    with _training_writer_lock:
+        if _training_writer is None:
+            _training_writer = Training_Image_Writer(log)
+            atexit.register(_training_writer.flush, _TRAINING_FLUSH_TIMEOUT)
+        return _training_writer
+
 class Taxy_Server_Io:
-    def __init__(self, log, camera_url, save_image = False):
+    # grabber: a Frame_Grabber streaming the camera, frames are then taken from it instead of
+    # one HTTP request per frame
+    def __init__(self, log, camera_url, save_image = False, chunk_size = READ_CHUNK_SIZE, grabber = None):
         self.log = log
         self.log(' *** initializing Taxy_Server_Io **** ')
         self.camera_url = camera_url
         self.save_image = save_image
         self.session = requests.Session()
+        # JPEG bytes of the last frame returned by get_new_frame, and how many repeated frames were dropped
+        self.__last_jpeg = None
+        self.stale_frames = 0
+        # When the camera's current frame was first seen, whether it was fetched again since, and the
+        # measured camera frame interval
+        self.__last_change = None
+        self.__repeated = False
+        self.__frame_interval = _STALE_DEFAULT_INTERVAL
+        # Bytes read from the camera per chunk
+        self.chunk_size = chunk_size
+        self.grabber = grabber
+        # Sequence number of the last grabbed frame returned; only frames that arrived after this
+        # object was created are used, i.e. after the move that preceded the measurement
+        self.__last_sequence = 0
+        self.__since = time.time()
 
         # Local storage directory for training images
         self.storage_dir = os.path.join(os.path.dirname(__file__), '..', 'collected_images')
@@ -40,7 +589,62 @@ class Taxy_Server_Io:
 
     def get_single_frame(self):
         self.log(' *** calling get_single_frame **** ')
-        
+        if self.grabber is not None:
+            return self.__decode(self.__grab_jpeg())
+        return self.__decode(self.__read_jpeg())
+
+    # Like get_single_frame, but drops frames identical to the previous one returned, so every call
+    # gives a new camera frame without a fixed sleep. A repeated frame is still returned after
+    # _STALE_MAX_RETRIES retries, or right away once it is older than the camera's cache window.
+    def get_new_frame(self):
+        frame = self.get_new_camera_frame()
+        return frame.image if frame is not None else None
+
+    # get_new_frame as a Camera_Frame that is only decoded as far as it is used, None on failure
+    def get_new_camera_frame(self):
+        self.log(' *** calling get_new_frame **** ')
+        if self.grabber is not None:
+            # Grabbed frames are new by their sequence number, the stream never repeats one
+            jpg = self.__grab_jpeg()
+            return Camera_Frame(jpg) if jpg is not None else None
+        retries = 0
+        while True:
+            jpg = self.__read_jpeg()
+            if jpg is None:
+                return None
+            now = time.time()
+            if jpg != self.__last_jpeg:
+                if self.__repeated:
+                    # The previous frame was seen from its first fetch until now, about one frame interval
+                    self.__frame_interval = min(max(now - self.__last_change, _STALE_RETRY_INTERVAL), _STALE_TIMEOUT)
+                self.__last_change = now
+                self.__repeated = False
+                break
+            self.__repeated = True
+            age = now - self.__last_change
+            if retries >= _STALE_MAX_RETRIES or age >= _STALE_CACHE_FACTOR * self.__frame_interval:
+                break
+            retries += 1
+            self.stale_frames += 1
+            # Fetch again when the camera's next frame is due
+            time.sleep(max(self.__last_change + self.__frame_interval - now, _STALE_RETRY_INTERVAL))
+        self.__last_jpeg = jpg
+        return Camera_Frame(jpg)
+
+    def __decode(self, jpg):
+        return decode_frame(jpg)
+
+    # The next frame from the grabber, None if none arrives in time
+    def __grab_jpeg(self):
+        frame = self.grabber.wait_newer(self.__last_sequence, self.__since)
+        if frame is None:
+            self.log("No frame from camera stream %s" % self.grabber.stream_url)
+            return None
+        self.__last_sequence = frame.sequence
+        return frame.jpeg
+
+    # Reads the first complete JPEG from the camera URL, None on failure
+    def __read_jpeg(self):
         if self.session is None: 
             self.log("HTTP stream for reading jpeg is not running")
             raise Exception("HTTP stream for reading jpeg is not running")
@@ -49,19 +653,11 @@ class Taxy_Server_Io:
             with self.session.get(self.camera_url, stream=True) as stream:
                 self.log(' stream.ok = %s ' % stream.ok)
                 if stream.ok:
-                    chunk_size = 1024
-                    bytes_ = b''
-                    for chunk in stream.iter_content(chunk_size=chunk_size):
-                        bytes_ += chunk
-                        a = bytes_.find(b'\xff\xd8')
-                        b = bytes_.find(b'\xff\xd9')
-                        if a != -1 and b != -1:
-                            jpg = bytes_[a:b+2]
-                            # Read the image from the byte array with OpenCV
-                            image = cv2.imdecode(np.frombuffer(jpg, dtype=np.uint8), cv2.IMREAD_COLOR)
-                            image = cv2.resize(image, (_FRAME_WIDTH, _FRAME_HEIGHT), interpolation=cv2.INTER_AREA)
-                            # Return the image
-                            return image
+                    parser = Jpeg_Stream_Parser()
+                    for chunk in iter_stream_chunks(stream, self.chunk_size):
+                        images = parser.feed(chunk)
+                        if images:
+                            return images[0]
             return None
         except Exception as e:
             self.log("Failed to get single frame from stream %s" % str(e))
@@ -72,43 +668,33 @@ class Taxy_Server_Io:
             self.session.close()
             self.session = None
             
-    def save_frame_locally(self, frame, points, algorithm):
-        """Save detection frame locally for custom model training"""
+    def save_frame_locally(self, frame, points, algorithm, result=None, tool=None):
+        """Queue the detection frame for saving locally (custom model training), without waiting for the write"""
         try:
             self.log(' *** calling save_frame_locally **** ')
 
-            # Create storage directory if it doesn't exist
-            os.makedirs(self.storage_dir, exist_ok=True)
-
-            # Generate filename with timestamp
+            # Generate filename with timestamp, the capture time
             timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S-%f")[:-3]  # milliseconds
-            image_filename = f"{timestamp}.jpg"
-            json_filename = f"{timestamp}.json"
-
-            image_path = os.path.join(self.storage_dir, image_filename)
-            json_path = os.path.join(self.storage_dir, json_filename)
+            confidence = points[2] if len(points) > 2 else (result.score if result is not None else None)
 
-            # Save image
-            cv2.imwrite(image_path, frame)
-
-            # Save metadata (detection info for annotation reference)
+            # Metadata (detection info for annotation reference)
             metadata = {
                 'timestamp': timestamp,
                 'algorithm': algorithm,
+                'tool': tool,
                 'detected_position': {
                     'x': float(points[0]) if len(points) > 0 else None,
                     'y': float(points[1]) if len(points) > 1 else None,
-                    'confidence': float(points[2]) if len(points) > 2 else None
+                    'confidence': float(confidence) if confidence is not None else None
                 },
-                'image_file': image_filename
+                'box': [float(v) for v in result.box] if result is not None and result.box is not None else None,
+                'radius': int(result.radius) if result is not None and result.radius is not None else None,
+                'image_file': f"{timestamp}.jpg"
             }
 
-            with open(json_path, 'w') as f:
-                json.dump(metadata, f, indent=2)
-
-            self.log(f' *** saved frame locally to {image_path} **** ')
+            get_training_writer(self.log).submit(self.storage_dir, frame, metadata)
             return True
 
         except Exception as e:
             self.log("Failed to save frame locally: %s" % str(e))
-            return False    
+            return False